@@ -5,6 +5,7 @@ from requests.utils import quote
 import re
 
 from scripts.constants import OLS4_BASE_URL, ONTOLOGY_PREFIX, TERMS_PREFIX, GRAPH_PREFIX
+from scripts.ols import EFOGraph
 
 class slimSolrWalker(object):
     '''
@@ -112,13 +113,28 @@ def get_EFO_from_OLS(EFO_URL):
                 
     return(node_list)
 
+# Same nodes as the OLS graph (the term, its ancestors and children) from a local EFO release:
+def get_EFO_from_file(efoGraph, EFO_URL):
+    iri = efoGraph.get_iri(EFO_URL)
+    if iri is None: return([])
+
+    node_list = []
+    for node in [iri] + list(efoGraph.get_ancestors(iri)) + efoGraph.get_children(iri):
+        if node in efoGraph.terms and "#" not in node:
+            node_list.append(efoGraph.terms[node]['short_form'])
+
+    return(node_list)
+
 # Checkig trait documents:
-def trait_test(fatHost, identifiers):
+def trait_test(fatHost, identifiers, efoGraph = None):
     failed_identifiers = {}
     for identifier in tqdm(identifiers, desc='Testing EFO terms... '):
         
         # Get child terms:
-        efoNodes = get_EFO_from_OLS(identifier)
+        if efoGraph:
+            efoNodes = get_EFO_from_file(efoGraph, identifier)
+        else:
+            efoNodes = get_EFO_from_OLS(identifier)
         efoString = ",".join(efoNodes)
 
         # Query solr:
@@ -218,6 +234,7 @@ if __name__ == '__main__':
     parser.add_argument('--document', default='publication', choices=['publication', 'trait', 'variant', 'all'],
                         help='The document type to be checked (default: publication).')
     parser.add_argument('--limit', help='For debugging purposes! Testing only the first # document.', type = int, default = 0)
+    parser.add_argument('--efoFile', help='Local EFO release (efo.obo or efo.json) to use instead of OLS.', default = None)
     args = parser.parse_args()
 
     # Get the list of document types to create
@@ -237,10 +254,13 @@ if __name__ == '__main__':
         else:
             print('[Info] %s has failed with the follwing message:\n%s' % (solrHost, solrStatus))
 
+    # Loading local EFO release if given:
+    efoGraph = EFOGraph.EFOGraph(args.efoFile) if args.efoFile else None
+
     # select function
     dispatcher = {
         'publication' : [publication_test, 'pmid'],
-        'trait'       : [trait_test, 'mappedUri'],
+        'trait'       : [lambda fatHost, identifiers: trait_test(fatHost, identifiers, efoGraph), 'mappedUri'],
         'variant'     : [variant_test, 'rsID'],
     }
 
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import aiohttp
+
+from scripts.EnsemblREST.REST import REST, RateLimiter, backoff_delay
+
+
+class AsyncREST(object):
+    '''
+    Asynchronous version of the REST class for bulk workloads (many variants, loci etc.), with the same methods.
+
+    The number of requests in flight is bounded by max_in_flight. Requests follow the same rate limit and
+    retry rules as the REST class. Must be used as an async context manager:
+
+        async with AsyncREST(URL) as client:
+            variants = await client.postVariation(rsIDs)
+
+            # Results can be processed as they arrive:
+            async for rsID, LD in client.iter_results(client.getLD, rsIDs):
+                ...
+
+    Responses are not cached. Requires aiohttp, installed with the "async" extra (pip install gwas-solr-slim[async]).
+    '''
+
+    retry_status_codes = REST.retry_status_codes
+
+    def __init__(self, URL, max_in_flight = 10, timeout = 300, rate_limiter = None):
+        self.URL = URL
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self.session = None
+        self.__semaphore = None
+
+    async def __aenter__(self):
+        self.__semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.session = aiohttp.ClientSession(
+            connector = aiohttp.TCPConnector(limit = self.max_in_flight),
+            timeout = aiohttp.ClientTimeout(total = self.timeout),
+            headers = {'Accept-Encoding' : 'gzip, deflate'})
+        return(self)
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def getEnsemblRelease(self):
+        URL = ( "%s/info/data/?content-type=application/json" % self.URL)
+        response = await self.__get_submit(URL)
+        releases = response['releases']
+        releases.sort(reverse=True)
+        return(releases[0])
+
+    async def getLD(self, rsID, population = '1000GENOMES:phase_3:EUR', window = 500):
+        URL = ( "%s/ld/human/%s/%s?window_size=%s&content-type=application/json" % (self.URL,rsID,population,
+                window))
+        return(await self.__get_submit(URL))
+
+    async def getVariation(self, rsID, parameters = {}):
+        URL = ( "%s/variation/human/%s?%s&content-type=application/json" % (self.URL,rsID,
+                "&".join([str(x)+"="+str(parameters[x]) for x in parameters])))
+        return(await self.__get_submit(URL))
+
+    async def getOverlap(self, chromosome, start, end, features = [], parameters = {}):
+        featurestring = ";".join(["feature="+str(x) for x in features])
+        parameterstring = ";".join([str(x)+'='+str(parameters[x]) for x in parameters])
+        URL = ( "%s/overlap/region/human/%s:%s-%s?%s;%s&content-type=application/json" % (self.URL,chromosome,
+                start, end,  featurestring, parameterstring))
+        return(await self.__get_submit(URL))
+
+    async def getPhenotype(self, chromosome, start, end):
+        URL = ( "%s/phenotype/region/homo_sapiens/%s:%s-%s??content-type=application/json;feature_type=Variation" % (self.URL,
+            chromosome, start, end))
+        return(await self.__get_submit(URL))
+
+    async def getAssembly(self, feature = "all", species = "homo_sapiens"):
+        URL = ("%s/info/assembly/%s?content-type=application/json&bands=1" %(self.URL, species))
+        assemblyInfo = await self.__get_submit(URL)
+        return(REST.parse_assembly(assemblyInfo, feature))
+
+    async def postVariation(self, IDs, features = {}):
+        return(await self.__post_chunks('/variation/homo_sapiens', IDs, 200, features))
+
+    async def postID(self, IDs, features = {}):
+        return(await self.__post_chunks('/lookup/id', IDs, 1000, features))
+
+    def iter_postVariation(self, IDs, features = {}):
+        '''
+        Yields the returned dictionary of each chunk of 200 IDs as soon as it arrives.
+        '''
+        return(self.__iter_chunks('/variation/homo_sapiens', IDs, 200, features))
+
+    def iter_postID(self, IDs, features = {}):
+        '''
+        Yields the returned dictionary of each chunk of 1000 IDs as soon as it arrives.
+        '''
+        return(self.__iter_chunks('/lookup/id', IDs, 1000, features))
+
+    async def iter_results(self, method, arguments):
+        '''
+        Calls the method for each argument (or tuple of arguments) concurrently and yields
+        (argument, result) pairs in the order they arrive, eg. iter_results(client.getOverlap, regions).
+        '''
+        async def call(argument):
+            if isinstance(argument, tuple):
+                return(argument, await method(*argument))
+            return(argument, await method(argument))
+
+        for result in asyncio.as_completed([call(argument) for argument in arguments]):
+            yield(await result)
+
+    @staticmethod
+    def __chunk_data(IDs, chunk_size, features):
+        '''
+        Returns the request body of each chunk of IDs.
+        '''
+        chunks = []
+        for i in range(0, len(IDs), chunk_size):
+            data = {'ids' : IDs[ i : i + chunk_size ]}
+            data.update(features)
+            chunks.append(json.dumps(data))
+        return(chunks)
+
+    async def __post_chunks(self, ext, IDs, chunk_size, features):
+        '''
+        Posts the chunks concurrently. The returned dictionaries are merged in the order of the chunks.
+        '''
+        responses = await asyncio.gather(*[self.__post_submit(ext, data) for data in self.__chunk_data(IDs, chunk_size, features)])
+
+        return_list = {}
+        for response in responses:
+            return_list.update(response)
+        return(return_list)
+
+    async def __iter_chunks(self, ext, IDs, chunk_size, features):
+        async for data, response in self.iter_results(lambda data: self.__post_submit(ext, data),
+                                                      self.__chunk_data(IDs, chunk_size, features)):
+            yield(response)
+
+    async def __submit(self, method, URL, **kwargs):
+        '''
+        Sends a request with the rate limit and retry rules of the REST class. Returns the last response
+        with its body already read.
+        '''
+        max_try = 10
+        for current_try in range(max_try + 1):
+            wait = self.rate_limiter.try_acquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.rate_limiter.try_acquire()
+
+            try:
+                async with self.__semaphore:
+                    async with self.session.request(method, URL, **kwargs) as response:
+                        await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if current_try == max_try:
+                    raise
+                print("[Warning] Request to %s failed: %s" % (URL, e))
+                await asyncio.sleep(backoff_delay(current_try))
+                continue
+
+            self.rate_limiter.update(response.headers)
+            if response.ok or response.status not in self.retry_status_codes or current_try == max_try:
+                return(response)
+            await asyncio.sleep(backoff_delay(current_try))
+
+    async def __post_submit(self, ext, data,
+                            headers={ "Content-Type" : "application/json", "Accept" : "application/json"} ):
+        response = await self.__submit('POST', self.URL+ext, headers=headers, data=data)
+
+        if not response.ok:
+            print ("[Error] request failed! Code: %s, Text: %s" % (response.status, await response.text()))
+            print ("[Error] Reason: %s" % response.reason)
+            print ("[Error] submitted data: %s" % data)
+
+        try:
+            return(await response.json(content_type = None))
+        except ValueError:
+            print('[Error] The returned data was not a json.... ')
+            print('[Info] Endpoint: ' + ext)
+            print('[Info] Data: ' + data)
+            return([])
+
+    async def __get_submit(self, URL):
+        response = await self.__submit('GET', URL, headers={ "Content-Type" : "application/json"})
+        response.raise_for_status()
+
+        try:
+            return(await response.json(content_type = None))
+        except ValueError:
+            print('[Error] The returned data was not a json.... ')
+            print('[Info] URL: ' + URL)
@@ -1,26 +1,186 @@
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import math
 import time
+import random
+import threading
+import concurrent.futures
 from tqdm import tqdm
 
+from scripts.cache import DiskCache
+
+
+def backoff_delay(current_try, base = 1, cap = 60):
+    '''
+    Exponential backoff with jitter: returns the seconds to wait before the next try.
+    '''
+    delay = min(cap, base * 2 ** current_try)
+    return(random.uniform(delay / 2.0, delay))
+
+
+class RateLimiter(object):
+    '''
+    Token bucket limiting the rate of the requests sent to the server.
+
+    Starts with the given rate (requests per second), then follows the X-RateLimit-* headers of the responses:
+    the rate is set to limit/period, the bucket never holds more tokens than the remaining requests, and
+    no requests are sent until the reset if the limit is used up, or while a Retry-After is in force.
+    '''
+
+    def __init__(self, rate = 15, capacity = 15):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.__tokens = float(capacity)
+        self.__updated = time.monotonic()
+        self.__blocked_until = 0
+        self.__lock = threading.Lock()
+
+    def try_acquire(self):
+        '''
+        Takes a token if a request can be sent now and returns 0. Otherwise returns the seconds to wait.
+        '''
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+
+            wait = self.__blocked_until - now
+            if wait <= 0 and self.__tokens >= 1:
+                self.__tokens -= 1
+                return(0)
+            return(max(wait, (1 - self.__tokens) / self.rate))
+
+    def acquire(self):
+        '''
+        Waits until a request can be sent.
+        '''
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    def update(self, headers):
+        '''
+        Updates the limiter from the headers of a response.
+        '''
+        def header(name):
+            try:
+                return(float(headers[name]))
+            except (KeyError, TypeError, ValueError):
+                return(None)
+
+        limit = header('X-RateLimit-Limit')
+        period = header('X-RateLimit-Period')
+        remaining = header('X-RateLimit-Remaining')
+        reset = header('X-RateLimit-Reset')
+        retry_after = header('Retry-After')
+
+        with self.__lock:
+            now = time.monotonic()
+            if limit and period:
+                self.rate = limit / period
+            if remaining is not None:
+                self.__tokens = min(self.__tokens, remaining)
+                if remaining < 1 and reset:
+                    self.__blocked_until = max(self.__blocked_until, now + reset)
+            if retry_after:
+                self.__blocked_until = max(self.__blocked_until, now + retry_after)
+
+
 class REST(object):
     '''
     This class will be responsible to return data from Ensembl.
     It will be initialized by the URL of the server. So in theory it is easy to
     switch to alternative or to the GRCh37 server.
+
+    All requests go through one session, so the connections to the server are kept alive and reused:
+        * pool_size: number of connections kept open to the server.
+        * timeout: connect and read timeout of the requests in seconds.
+        * workers: number of chunks posted in parallel by postID and postVariation.
+        * rate_limiter: RateLimiter shared by all requests (default: 15 requests per second, as allowed by Ensembl).
+
+    Responses can be cached on disk (cache_file) for the current Ensembl release, so repeated runs don't
+    send the same requests again. Lookups of IDs are cached one by one:
+        * cache_ttl: responses older than this many seconds are requested again (None: no expiry).
+        * cache_size: maximum number of cached responses, least recently used ones are removed.
+        * cache_only: no requests are sent, only cached responses are returned (offline mode).
     '''
 
-    def __init__(self, URL):
+    # Responses worth retrying:
+    retry_status_codes = [408, 429, 500, 502, 503, 504]
+
+    def __init__(self, URL, pool_size = 10, timeout = (10, 300), workers = 4, rate_limiter = None,
+                 cache_file = None, cache_ttl = None, cache_size = None, cache_only = False):
         self.URL = URL
+        self.timeout = timeout
+        self.workers = workers
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+
+        # Response cache, opened once the Ensembl release is known:
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache_only = cache_only
+        self.__cache = None
+        self.__release = None
+        self.__cache_lock = threading.Lock()
+        self.__cache_hits = 0
+        self.__cache_misses = 0
+
+        if cache_only and not cache_file:
+            raise(ValueError("[Error] Cache-only mode requires a cache file."))
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding' : 'gzip, deflate'})
+        self.__adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount('http://', self.__adapter)
+        self.session.mount('https://', self.__adapter)
+
+    def get_connection_stats(self):
+        '''
+        Returns the number of requests sent and connections opened by the session.
+        Requests over already open connections are counted as reused.
+        '''
+        pools = self.__adapter.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        requests_count = sum(pool.num_requests for pool in pools)
+        connections = sum(pool.num_connections for pool in pools)
+        return({
+            'requests' : requests_count,
+            'connections' : connections,
+            'reused' : requests_count - connections
+        })
 
     # https://rest.ensembl.org/info/data/?content-type=application/json
     def getEnsemblRelease(self):
         URL = ( "%s/info/data/?content-type=application/json" % self.URL)
-        response = self.__get_submit(URL)
+
+        # The release is always requested, unless the server is not reachable or only the cache can be used:
+        if self.cache_file:
+            release_cache = DiskCache(self.cache_file, 'release:%s' % self.URL)
+            response = None
+            if not self.cache_only:
+                try:
+                    response = self.__get_submit(URL, cached = False)
+
+                    # Only parsed responses replace the cached release:
+                    if response is not None:
+                        release_cache.put(URL, response)
+                except requests.RequestException as e:
+                    print("[Warning] Ensembl release could not be retrieved, using cached release: %s" % e)
+            if response is None:
+                response = release_cache.get(URL)
+            release_cache.close()
+            if response is None:
+                raise(ValueError("[Error] Ensembl release is not available from %s or from the cache." % self.URL))
+        else:
+            response = self.__get_submit(URL, cached = False)
+
         releases = response['releases']
         releases.sort(reverse=True)
+        self.__release = releases[0]
         return(releases[0])
 
     # https://rest.ensembl.org/ld/human/rs1042779/1000GENOMES:phase_3:EUR?content-type=application/json
@@ -79,7 +239,13 @@ class REST(object):
 
         URL = ("%s/info/assembly/%s?content-type=application/json&bands=1" %(self.URL, species))
         assemblyInfo = self.__get_submit(URL)
+        return(self.parse_assembly(assemblyInfo, feature))
 
+    @staticmethod
+    def parse_assembly(assemblyInfo, feature = "all"):
+        '''
+        Extracts the chromosomes or the cytobands from the assembly information.
+        '''
         # Now we have to parse the returned data:
         if feature == "all" :
             return(assemblyInfo)
@@ -120,30 +286,59 @@ class REST(object):
     
     def postVariation(self, IDs, features = {}):
         ext = '/variation/homo_sapiens'
-        return_list = {}
 
         # The data has to be chunked by 200:
-        for i in range(int(math.ceil(len(IDs)/200.0))):
-            IDs_chunk = IDs[ i * 200 : (i + 1) * 200 ]
-            data = {'ids' : IDs_chunk}
-            data.update(features)
-            return_list.update(self.__post_submit(ext, json.dumps(data)))
-        
-        return(return_list)
+        return(self.__post_chunks(ext, IDs, 200, features))
 
     def postID(self, IDs, features = {}):
         '''
         Posts a list of IDs to the rEST API
         '''
         ext = '/lookup/id'
-        return_list = {}
-        
+
         # The data has to be chunked by 1000:
-        for i in tqdm(range(int(math.ceil(len(IDs)/1000.0))), desc = 'Submitting IDs to Ensembl'):
-            IDs_chunk = IDs[ i * 1000 : (i + 1) * 1000 ]
+        return(self.__post_chunks(ext, IDs, 1000, features, desc = 'Submitting IDs to Ensembl'))
+
+    def __post_chunks(self, ext, IDs, chunk_size, features, desc = None):
+        '''
+        Posts the IDs in chunks, in parallel. The returned dictionaries are merged in the order of the chunks,
+        so the result doesn't depend on which request finishes first.
+
+        Cached IDs are not posted, the responses of the posted IDs are added to the cache.
+        '''
+        cache = self.__get_cache()
+        if cache is not None:
+            request = '%s|%s|' % (ext, json.dumps(features, sort_keys = True))
+            cached = self.__read_cache(cache, [request + ID for ID in IDs])
+            return_list = {ID : cached[request + ID] for ID in IDs if request + ID in cached}
+            IDs = [ID for ID in IDs if request + ID not in cached]
+
+            if self.cache_only or len(IDs) == 0:
+                return(return_list)
+
+            posted = self.__post_chunks_uncached(ext, IDs, chunk_size, features, desc)
+            cache.put_many({request + ID : posted[ID] for ID in IDs if ID in posted})
+            return_list.update(posted)
+            return(return_list)
+
+        return(self.__post_chunks_uncached(ext, IDs, chunk_size, features, desc))
+
+    def __post_chunks_uncached(self, ext, IDs, chunk_size, features, desc = None):
+        def post_chunk(IDs_chunk):
             data = {'ids' : IDs_chunk}
             data.update(features)
-            return_list.update(self.__post_submit(ext, json.dumps(data)))
+            return(self.__post_submit(ext, json.dumps(data)))
+
+        chunks = [IDs[ i * chunk_size : (i + 1) * chunk_size ] for i in range(int(math.ceil(len(IDs)/float(chunk_size))))]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers) as executor:
+            futures = [executor.submit(post_chunk, IDs_chunk) for IDs_chunk in chunks]
+            for future in tqdm(concurrent.futures.as_completed(futures), total = len(futures), desc = desc, disable = desc is None):
+                pass
+
+        return_list = {}
+        for future in futures:
+            return_list.update(future.result())
 
         return(return_list)
 
@@ -153,12 +348,22 @@ class REST(object):
         Posting data to server
         '''
         max_try = 10
-        current_try = 0
-        response = requests.post(self.URL+ext, headers=headers, data=data)
-        while not response.ok and current_try <= max_try:
-            current_try += 1
-            time.sleep(2)
-            response = requests.post(self.URL+ext, headers=headers, data=data)
+        for current_try in range(max_try + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.post(self.URL+ext, headers=headers, data=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if current_try == max_try:
+                    raise
+                print("[Warning] Request to %s failed: %s" % (ext, e))
+                time.sleep(backoff_delay(current_try))
+                continue
+
+            # The rate limit headers are followed by all requests:
+            self.rate_limiter.update(response.headers)
+            if response.ok or response.status_code not in self.retry_status_codes or current_try == max_try:
+                break
+            time.sleep(backoff_delay(current_try))
 
         if not response.ok:
             print ("[Error] request failed! Code: %s, Text: %s" % (response.status_code, response.text))
@@ -171,15 +376,64 @@ class REST(object):
             print('[Error] The returned data was not a json.... ')
             print('[Info] Endpoint: ' + ext)
             print('[Info] Data: ' + data)
-            print('[Info] Response: ' + response.content)
+            print('[Info] Response: ' + response.text)
             return([])
 
     # Submitting request:
-    def __get_submit(self, URL):
+    def __get_cache(self):
+        '''
+        Returns the response cache of the current Ensembl release, or None if responses are not cached.
+        '''
+        if not self.cache_file:
+            return(None)
+
+        with self.__cache_lock:
+            if self.__cache is None:
+                release = self.__release if self.__release is not None else self.getEnsemblRelease()
+                self.__cache = DiskCache(self.cache_file, '%s:e%s' % (self.URL, release),
+                                         ttl = self.cache_ttl, max_entries = self.cache_size)
+
+                # Responses of earlier releases are not used anymore:
+                self.__cache.remove_other_namespaces('%s:e' % self.URL)
+        return(self.__cache)
+
+    def __read_cache(self, cache, keys):
+        cached = cache.get_many(keys)
+        with self.__cache_lock:
+            self.__cache_hits += len(cached)
+            self.__cache_misses += len(keys) - len(cached)
+        return(cached)
+
+    def get_cache_stats(self):
+        '''
+        Returns the hit/miss counters of the response cache.
+        '''
+        return({
+            'hits' : self.__cache_hits,
+            'misses' : self.__cache_misses,
+        })
+
+    def __get_submit(self, URL, cached = True):
         '''
         This method needs to be improved, but let's assume everyting works just fine.
         '''
-        response = requests.get(URL, headers={ "Content-Type" : "application/json"})
+        cache = self.__get_cache() if cached else None
+        if cache is not None:
+            response = self.__read_cache(cache, [URL])
+            if URL in response:
+                return(response[URL])
+            if self.cache_only:
+                raise(ValueError("[Error] Response for %s is not cached." % URL))
+
+            # Only parsed responses are cached:
+            response = self.__get_submit(URL, cached = False)
+            if response is not None:
+                cache.put(URL, response)
+            return(response)
+
+        self.rate_limiter.acquire()
+        response = self.session.get(URL, headers={ "Content-Type" : "application/json"}, timeout=self.timeout)
+        self.rate_limiter.update(response.headers)
         if not response.ok:
             return(response.raise_for_status())
         
@@ -188,6 +442,6 @@ class REST(object):
         except ValueError:
             print('[Error] The returned data was not a json.... ')
             print('[Info] URL: ' + URL)
-            print('[Info] Response: ' + response.content)
+            print('[Info] Response: ' + response.text)
 
 
@@ -0,0 +1,207 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class DiskCache(object):
+    '''
+    A key-value store saved in an SQLite file, so the cached data survives between runs.
+
+    Entries are kept in separate namespaces (eg. database name and data version), so data
+    from an outdated source is never returned. Values are stored as JSON.
+        * ttl: entries older than this many seconds are considered missing (None: no expiry).
+        * max_entries: once the namespace holds more entries, the least recently used ones are removed.
+
+    Expired and least recently used entries are only removed from the own namespace, so several caches
+    can share a file. Outdated namespaces are removed explicitly with remove_other_namespaces.
+    '''
+
+    def __init__(self, filename, namespace, ttl = None, max_entries = None):
+        self.filename = filename
+        self.namespace = str(namespace)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+
+        # Creating folder and database table if needed:
+        folder = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(folder, exist_ok = True)
+
+        self.__connection = sqlite3.connect(filename, check_same_thread = False)
+        with self.__connection:
+            self.__connection.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    stored REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )''')
+            self.__connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    def get(self, key):
+        '''
+        Returns the cached value or None if the key is missing or expired.
+        '''
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        '''
+        Returns a dictionary with the cached values of the found keys.
+        '''
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        oldest = now - self.ttl if self.ttl else 0
+
+        with self.__lock:
+            # SQLite limits the number of variables in a query, so keys are looked up in chunks:
+            for i in range(0, len(keys), 500):
+                chunk = {str(key): key for key in keys[i : i + 500]}
+                in_vars = ','.join('?' * len(chunk))
+                rows = self.__connection.execute(
+                    'SELECT key, value FROM cache WHERE namespace = ? AND stored >= ? AND key IN (%s)' % in_vars,
+                    [self.namespace, oldest] + list(chunk.keys())).fetchall()
+                for key, value in rows:
+                    found[chunk[key]] = json.loads(value)
+
+            # Updating access time of the returned entries:
+            with self.__connection:
+                self.__connection.executemany('UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                                              [(now, self.namespace, str(key)) for key in found])
+
+        return(found)
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        '''
+        Stores a dictionary of values, then evicts the least recently used entries if the namespace is full.
+        '''
+        now = time.time()
+        with self.__lock:
+            with self.__connection:
+                self.__connection.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                              [(self.namespace, str(key), json.dumps(value), now, now) for key, value in items.items()])
+            self.__evict()
+
+    def __evict(self):
+        with self.__connection:
+            if self.ttl:
+                self.__connection.execute('DELETE FROM cache WHERE namespace = ? AND stored < ?',
+                                          (self.namespace, time.time() - self.ttl))
+
+            if self.max_entries:
+                self.__connection.execute('''
+                    DELETE FROM cache WHERE rowid IN (
+                        SELECT rowid FROM cache WHERE namespace = ? ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                    )''', (self.namespace, self.max_entries))
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute('SELECT COUNT(*) FROM cache WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+
+    def clear(self):
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute('DELETE FROM cache WHERE namespace = ?', (self.namespace,))
+
+    def remove_other_namespaces(self, prefix):
+        '''
+        Removes the entries of the other namespaces starting with prefix, eg. the outdated versions of the same data.
+        '''
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute('DELETE FROM cache WHERE substr(namespace, 1, ?) = ? AND namespace != ?',
+                                          (len(prefix), prefix, self.namespace))
+
+    def close(self):
+        self.__connection.close()
+
+
+class LRUCache(object):
+    '''
+    A bounded in-memory cache: once maxsize entries are stored, the least recently used entry is dropped.
+
+    If a DiskCache is given as backend, values not found in memory are looked up on disk and new values
+    are written to disk as well. Hits and misses are counted for reporting.
+    '''
+
+    def __init__(self, maxsize = 100000, backend = None):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.RLock()
+
+    def get(self, key, default = None):
+        values = self.get_many([key])
+        return values[key] if key in values else default
+
+    def get_many(self, keys):
+        '''
+        Returns a dictionary with the cached values of the found keys.
+        '''
+        found = {}
+        missing = []
+
+        with self.__lock:
+            for key in keys:
+                if key in self.__data:
+                    self.__data.move_to_end(key)
+                    found[key] = self.__data[key]
+                else:
+                    missing.append(key)
+
+            # Falling back to the disk:
+            if missing and self.backend is not None:
+                stored = self.backend.get_many(missing)
+                for key, value in stored.items():
+                    self.__store(key, value)
+                found.update(stored)
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return(found)
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        with self.__lock:
+            for key, value in items.items():
+                self.__store(key, value)
+
+            if self.backend is not None:
+                self.backend.put_many(items)
+
+    def __store(self, key, value):
+        self.__data[key] = value
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last = False)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get_stats(self):
+        '''
+        Returns the hit/miss counters of the cache.
+        '''
+        lookups = self.hits + self.misses
+        return({
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hitRate' : float(self.hits) / lookups if lookups else 0.0,
+            'size' : len(self.__data)
+        })
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+
+class CytobandIndex(object):
+    '''
+    Interval index to find the cytobands of genomic regions.
+
+    Built once from a table of cytobands (chromosome, start, end, id columns, eg. from REST.getAssembly('cytobands')).
+    A region is assigned to every band on the same chromosome that contains it fully
+    (band start <= region start and band end >= region end). Multiple bands are joined with "/".
+    '''
+
+    def __init__(self, cytobands_df, separator = '/'):
+        self.separator = separator
+        self.__index = {}
+
+        cytobands_df = cytobands_df.sort_values(by = ['chromosome', 'start'], kind = 'mergesort')
+        for chromosome, bands in cytobands_df.groupby('chromosome', sort = False):
+            starts = bands.start.to_numpy(dtype = np.int64)
+            ends = bands.end.to_numpy(dtype = np.int64)
+
+            # If the bands don't overlap, only the last band starting before the region can contain it:
+            disjoint = bool((starts[1:] > ends[:-1]).all())
+            self.__index[str(chromosome)] = (starts, ends, bands.id.to_numpy(dtype = object), disjoint)
+
+    def lookup(self, chromosome, start, end):
+        '''
+        Returns the cytobands of a single region.
+        '''
+        return(self.lookup_many([chromosome], [start], [end])[0])
+
+    def lookup_many(self, chromosomes, starts, ends, missing = '-'):
+        '''
+        Returns the list of cytobands for each region. Regions with invalid coordinates get the missing value.
+        '''
+        regions = pd.DataFrame({
+            'chromosome' : pd.Series(list(chromosomes), dtype = object).astype(str),
+            'start' : pd.to_numeric(pd.Series(list(starts), dtype = object), errors = 'coerce'),
+            'end' : pd.to_numeric(pd.Series(list(ends), dtype = object), errors = 'coerce'),
+        })
+
+        cytobands = np.full(len(regions), missing, dtype = object)
+        valid = regions.start.notna() & regions.end.notna()
+        cytobands[valid.to_numpy()] = ''
+
+        for chromosome, chr_regions in regions.loc[valid].groupby('chromosome', sort = False):
+            if chromosome not in self.__index:
+                continue
+
+            band_starts, band_ends, band_ids, disjoint = self.__index[chromosome]
+            positions = chr_regions.index.to_numpy()
+            region_starts = chr_regions.start.to_numpy(dtype = np.int64)
+            region_ends = chr_regions.end.to_numpy(dtype = np.int64)
+
+            # Number of bands starting before (or at) each region:
+            candidates = np.searchsorted(band_starts, region_starts, side = 'right')
+
+            if disjoint:
+                last = candidates - 1
+                found = (last >= 0) & (band_ends[np.maximum(last, 0)] >= region_ends)
+                cytobands[positions[found]] = band_ids[last[found]]
+            else:
+                for position, count, region_end in zip(positions, candidates, region_ends):
+                    cytobands[position] = self.separator.join(band_ids[:count][band_ends[:count] >= region_end])
+
+        return(cytobands.tolist())
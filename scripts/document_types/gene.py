@@ -1,7 +1,8 @@
 import os
+import numpy as np
 import pandas as pd
 import pickle
-from tqdm import tqdm
+from scripts.cache import DiskCache, LRUCache
 from scripts.document_types import gene_annotator
 
 
@@ -9,14 +10,31 @@ def env_variable_else(env_var_name, default):
     return os.environ.get(env_var_name) if os.environ.get(env_var_name) else default
 
 
-def get_gene_data(connection, RESTURL, limit=0, testRun = False):
+def get_gene_data(connection, RESTURL, limit=0, testRun = False, database = None):
     # Importing shell variables:
     HGNC_file = env_variable_else("HGNCFtpPath", "https://storage.googleapis.com/public-download-files/hgnc/tsv/tsv/non_alt_loci_set.txt")
 
     EnsemblFtpPath = env_variable_else("EnsemblFtpPath", "ftp://ftp.ensembl.org/pub")
 
+    # The parsed gene annotation can be saved to a local snapshot, reused while the Ensembl release and HGNC file are unchanged:
+    geneSnapshotDir = env_variable_else("GeneSnapshotDir", None)
+
+    # Ensembl REST responses can be cached on disk for the current release. The cache can also be used offline:
+    RESTOptions = {
+        'cache_file' : env_variable_else("EnsemblCacheFile", None),
+        'cache_ttl' : float(env_variable_else("EnsemblCacheTTL", 30 * 24 * 3600)),
+        'cache_size' : int(env_variable_else("EnsemblCacheSize", 1000000)),
+        'cache_only' : env_variable_else("EnsemblCacheOnly", "0") == "1",
+    }
+
+    # The mapped genes of the variants can be cached on disk between runs:
+    geneCacheFile = env_variable_else("GeneCacheFile", None)
+    geneCacheSize = int(env_variable_else("GeneCacheSize", 1000000))
+    geneCacheTTL = float(env_variable_else("GeneCacheTTL", 30 * 24 * 3600))
+
     # Extract gene/mapping data from database:
-    geneSQL = gene_sql(connection=connection, testRun = testRun, limit = limit)
+    geneSQL = gene_sql(connection=connection, testRun = testRun, limit = limit, database = database,
+                       cache_file = geneCacheFile, cache_size = geneCacheSize, cache_ttl = geneCacheTTL)
     mappedGenes = geneSQL.get_results()
     
     ## For testing purposes the mapped genes and variants can be serialized:
@@ -27,19 +45,29 @@ def get_gene_data(connection, RESTURL, limit=0, testRun = False):
 
     # Initialize annotator object:
     geneAnnotObj = gene_annotator.GeneAnnotator(verbose=1, RESTServer= RESTURL,
-                        EnsemblFtpPath=EnsemblFtpPath, HGNCFile=HGNC_file)
-
-    ## For testing purposes the annotator object can be serialized and re-loaded:
-    # geneAnnotObj.save_data('data/gene_annotator.pkl')
-    # annotatorFile = 'gene_annotator.plk'
-    # with (open(annotatorFile, 'rb'))as f:
-    #     geneAnnotObj = pickle.load(f)
+                        EnsemblFtpPath=EnsemblFtpPath, HGNCFile=HGNC_file, snapshotDir=geneSnapshotDir,
+                        RESTOptions=RESTOptions)
 
     # Generating documents:
     geneDocuments = geneAnnotObj.create_document(mappedGenes)
 
     return(geneDocuments)
 
+class gene_record(object):
+    '''
+    The variants, studies and associations mapped to a gene.
+
+    IDs are stored as sorted arrays of integer codes interned by gene_sql, so every ID string is kept
+    in memory only once however many genes it is mapped to.
+    '''
+    __slots__ = ('rsIDs', 'studyIDs', 'assocIDs')
+
+    def __init__(self, rsIDs, studyIDs, assocIDs):
+        self.rsIDs = rsIDs
+        self.studyIDs = studyIDs
+        self.assocIDs = assocIDs
+
+
 class gene_sql(object):
     '''
     A class to extract gene related data from the database
@@ -65,82 +93,231 @@ class gene_sql(object):
         'rs204888', # Document of the mapped gene is missing from the slim solr..
     ]
     
-    # Extract associations for DYNLL1 (as a test suite):
-    sql_test_query = '''SELECT A.ID as ASSOCIATION_ID, A.STUDY_ID, SNP.RS_ID
+    # Extract every association with its variants:
+    sql_association_snps = '''
+        SELECT A.ID as ASSOCIATION_ID, A.STUDY_ID, SNP.RS_ID, SNP.ID as SNP_ID
         FROM ASSOCIATION A,
           ASSOCIATION_SNP_VIEW ASV,
           SINGLE_NUCLEOTIDE_POLYMORPHISM SNP
-        WHERE
-          SNP.RS_ID IN (%s)
+        WHERE ASV.ASSOCIATION_ID = A.ID
           AND SNP.ID = ASV.SNP_ID
-          AND ASV.ASSOCIATION_ID = A.ID
+          %s
     '''
-    
-    # Extract all association ID with the corresponding study ID
-    sql_associatinos_studies = '''
-        SELECT A.ID as ASSOCIATION_ID, A.STUDY_ID
-        FROM ASSOCIATION A
-        '''
 
-    # Get all rsIDs for an association:
-    sql_get_rsIDs = '''
-        SELECT SNP.RS_ID, SNP.ID as SNP_ID
-        FROM ASSOCIATION_SNP_VIEW ASV,
-            SINGLE_NUCLEOTIDE_POLYMORPHISM SNP
-        WHERE ASV.ASSOCIATION_ID = :assoc_id
-          AND ASV.SNP_ID = SNP.ID
-        '''
+    # Restrict the extract to the associations of the test rsIDs:
+    sql_test_filter = '''
+          AND A.ID IN (
+            SELECT TASV.ASSOCIATION_ID
+            FROM ASSOCIATION_SNP_VIEW TASV,
+              SINGLE_NUCLEOTIDE_POLYMORPHISM TSNP
+            WHERE TSNP.RS_ID IN (%s)
+              AND TSNP.ID = TASV.SNP_ID
+          )
+    '''
 
-    # Get all genes for a variant:
-    sql_get_genes = '''
-        SELECT GCont.*, EG.ENSEMBL_GENE_ID
-        FROM GENE_ENSEMBL_GENE GEG,
-          ENSEMBL_GENE EG,
-          (SELECT GC.SNP_ID, GC.GENE_ID, GC.IS_CLOSEST_GENE, GC.IS_INTERGENIC
-              FROM GENOMIC_CONTEXT GC
-              WHERE GC.SNP_ID = :snp_ID
-              AND GC.SOURCE = 'Ensembl'
-              AND (
-              GC.IS_INTERGENIC = 0
-              OR GC.IS_CLOSEST_GENE = 1
-              )
-          ) GCont
-        WHERE GCont.GENE_ID = GEG.GENE_ID
+    # Extract the overlapping and closest Ensembl genes of all variants, or of a chunk of variants.
+    # The selection between overlapping and closest genes is done for each variant later:
+    sql_snp_genes = '''
+        SELECT GC.SNP_ID, GC.GENE_ID, GC.IS_CLOSEST_GENE, GC.IS_INTERGENIC, EG.ENSEMBL_GENE_ID
+        FROM GENOMIC_CONTEXT GC,
+          GENE_ENSEMBL_GENE GEG,
+          ENSEMBL_GENE EG
+        WHERE GC.SOURCE = 'Ensembl'
+          AND (
+          GC.IS_INTERGENIC = 0
+          OR GC.IS_CLOSEST_GENE = 1
+          )
+          AND GC.GENE_ID = GEG.GENE_ID
           AND GEG.ENSEMBL_GENE_ID = EG.ID
+          %s
+    '''
+
+    # Restrict the genomic context extract to a chunk of variants:
+    sql_snp_filter = '''
+          AND GC.SNP_ID IN (%s)
+    '''
+
+    # Number of variants looked up in one query (Oracle allows at most 1000 expressions in a list):
+    snp_chunk_size = 1000
+
+    # If more than this fraction of the variants is missing from the cache, the whole genomic context
+    # is extracted at once instead of looking up the missing variants in chunks:
+    max_chunked_ratio = 0.5
+
+    # Tables the mapped genes are extracted from:
+    genomic_context_tables = ['ENSEMBL_GENE', 'GENE_ENSEMBL_GENE', 'GENOMIC_CONTEXT']
+
+    # A cheap stamp of these tables, read from the data dictionary without scanning the tables: the time and row
+    # count of the last statistics gathering and the inserts, updates and deletes tracked by table monitoring since.
+    # Monitoring data is flushed to the dictionary periodically (or by DBMS_STATS.FLUSH_DATABASE_MONITORING_INFO),
+    # so changes are picked up with some delay. Cached gene mappings are only used for the same stamp:
+    sql_genomic_context_version = '''
+        SELECT T.TABLE_NAME, T.NUM_ROWS, TO_CHAR(T.LAST_ANALYZED, 'YYYYMMDDHH24MISS') AS LAST_ANALYZED,
+          M.INSERTS, M.UPDATES, M.DELETES, M.TRUNCATED
+        FROM USER_TABLES T
+        LEFT JOIN USER_TAB_MODIFICATIONS M ON M.TABLE_NAME = T.TABLE_NAME AND M.PARTITION_NAME IS NULL
+        WHERE T.TABLE_NAME IN ('ENSEMBL_GENE', 'GENE_ENSEMBL_GENE', 'GENOMIC_CONTEXT')
+        ORDER BY T.TABLE_NAME
     '''
     
-    def __init__(self, connection, limit = 0, testRun = False):
+    def __init__(self, connection, limit = 0, testRun = False, database = None, cache_file = None, cache_size = 1000000,
+                 cache_ttl = 30 * 24 * 3600):
 
         # Initialize return variables:
         self.gene_container = {}
-        self.rsID_container = {}        
         self.connection = connection
 
-        if limit == 12:
-          test = True
+        # Cache of the mapped genes of the variants, saved on disk (None if not cached). At most cache_size
+        # variants are kept in memory, the least recently used ones are read from disk again:
+        self.snp_gene_cache = None
+        disk_cache = self.__open_disk_cache(cache_file, database, cache_size, cache_ttl)
+        if disk_cache is not None:
+            self.snp_gene_cache = LRUCache(maxsize = cache_size, backend = disk_cache)
 
-        # We extract the list of studies and associations:
+        # We extract all the associations with their variants:
         if testRun:
             in_vars = ','.join(':%d' % i for i in range(len(self.testRsIds)))
-            self.association_df = pd.read_sql(self.sql_test_query % in_vars, self.connection, params = self.testRsIds)
+            sql = self.sql_association_snps % (self.sql_test_filter % in_vars)
+            association_df = pd.read_sql(sql, self.connection, params = self.testRsIds)
         else:
-            self.association_df = pd.read_sql(self.sql_associatinos_studies, self.connection)
-                
-        tqdm.pandas(desc="Extracting mapped genes...")
-        
-        # Looping through all associations and return genomic context:
+            association_df = pd.read_sql(self.sql_association_snps % '', self.connection)
+
+        # Selecting a random set of associations:
         if limit != 0:
-            x = self.association_df.sample(n = limit).progress_apply(self.__process_association_row, axis = 1)
+            associations = pd.Series(association_df.ASSOCIATION_ID.unique())
+            associations = associations.sample(n = min(limit, len(associations)))
+            association_df = association_df.loc[association_df.ASSOCIATION_ID.isin(associations)]
+
+        print("[Info] Extracting mapped genes...")
+
+        # Mapped genes of the variants:
+        snp_genes = self.__get_mapped_genes(association_df.SNP_ID.unique().tolist())
+        snp_gene_df = pd.DataFrame([(snp_id, gene) for snp_id, genes in snp_genes.items() for gene in genes],
+                                   columns = ['SNP_ID', 'ENSEMBL_GENE_ID'])
+        association_df = association_df.drop_duplicates().merge(snp_gene_df, on = 'SNP_ID')
+
+        # Interning the IDs: every distinct ID is stored once, genes only keep integer codes:
+        gene_codes, genes = pd.factorize(association_df.ENSEMBL_GENE_ID, sort = True)
+        rs_codes, self.rsIDs = self.__intern(association_df.RS_ID)
+        study_codes, self.studyIDs = self.__intern(association_df.STUDY_ID)
+        assoc_codes, self.assocIDs = self.__intern(association_df.ASSOCIATION_ID)
+
+        # Collecting variants, studies and associations for each gene:
+        rs_groups = self.__group_codes(gene_codes, rs_codes, len(genes))
+        study_groups = self.__group_codes(gene_codes, study_codes, len(genes))
+        assoc_groups = self.__group_codes(gene_codes, assoc_codes, len(genes))
+
+        for index, EnsemblID in enumerate(genes):
+            self.gene_container[EnsemblID] = gene_record(rs_groups[index], study_groups[index], assoc_groups[index])
+
+        print("[Info] Number of mapped genes: %s" % len(self.gene_container))
+
+    def __open_disk_cache(self, cache_file, database, cache_size, cache_ttl):
+        '''
+        Opens the on-disk cache for the database and the current version of the genomic context.
+        Entries of outdated versions of the same database are never read again, so they are removed.
+        '''
+        if not cache_file:
+            return(None)
+
+        version = pd.read_sql(self.sql_genomic_context_version, self.connection)
+
+        # Without a stamp of every table, changes could not be detected:
+        if version.TABLE_NAME.tolist() != self.genomic_context_tables:
+            print("[Warning] The genomic context tables are not found in the data dictionary, mapped genes are not cached.")
+            return(None)
+
+        namespace = ':'.join([str(database)] + [str(value) for value in version.values.ravel().tolist()])
+
+        print("[Info] Mapped genes are cached in %s (%s)" % (cache_file, namespace))
+        disk_cache = DiskCache(cache_file, namespace, ttl = cache_ttl, max_entries = cache_size)
+        disk_cache.remove_other_namespaces('%s:' % database)
+        return(disk_cache)
+
+    def __get_mapped_genes(self, snp_ids):
+        '''
+        Returns a dictionary of variant ID -> list of mapped Ensembl gene IDs.
+
+        Without a disk cache, or if most variants are missing from it, the genomic context is extracted
+        with a single whole-table query. Otherwise only the missing variants are looked up, in chunks.
+        The cache is updated with the looked up variants.
+        '''
+        snp_genes = self.snp_gene_cache.get_many(snp_ids) if self.snp_gene_cache is not None else {}
+        missing = [snp_id for snp_id in snp_ids if snp_id not in snp_genes]
+
+        # A single query covers the missing variants if they fit in one chunk:
+        if len(missing) > self.snp_chunk_size and len(missing) > len(snp_ids) * self.max_chunked_ratio:
+            context_df = pd.read_sql(self.sql_snp_genes % '', self.connection)
+            new_genes = self.__select_mapped_genes(context_df.loc[context_df.SNP_ID.isin(missing)], missing)
         else:
-            x = self.association_df.progress_apply(self.__process_association_row, axis = 1)
+            new_genes = {}
+            for i in range(0, len(missing), self.snp_chunk_size):
+                chunk = missing[i : i + self.snp_chunk_size]
+                in_vars = ','.join(':%d' % j for j in range(len(chunk)))
+                context_df = pd.read_sql(self.sql_snp_genes % (self.sql_snp_filter % in_vars), self.connection,
+                                         params = [int(snp_id) for snp_id in chunk])
+                new_genes.update(self.__select_mapped_genes(context_df, chunk))
+
+        # Variants without genes are cached as well, so they are not looked up again:
+        if self.snp_gene_cache is not None:
+            self.snp_gene_cache.put_many(new_genes)
+            print("[Info] Mapped gene cache: %(hits)s hits, %(misses)s misses." % self.snp_gene_cache.get_stats())
+
+        snp_genes.update(new_genes)
+        return(snp_genes)
+
+    @staticmethod
+    def __select_mapped_genes(context_df, snp_ids):
+        '''
+        Returns the mapped genes of the variants from their genomic context: variants overlapping
+        with genes are mapped to the overlapping genes, other variants to the closest genes.
+        '''
+        context_df = context_df.drop_duplicates()
+        overlapping = context_df.IS_INTERGENIC == 0
+        has_overlapping = overlapping.groupby(context_df.SNP_ID).transform('any')
+        context_df = context_df.loc[overlapping | (~has_overlapping & (context_df.IS_CLOSEST_GENE == 1))]
+        mapped_genes = context_df.groupby('SNP_ID').ENSEMBL_GENE_ID.agg(list)
+
+        return({snp_id : mapped_genes.get(snp_id, []) for snp_id in snp_ids})
+
+    @staticmethod
+    def __intern(ids):
+        '''
+        Returns the integer codes of the IDs and the array of the distinct IDs as strings.
+        Integer IDs read as floats because of missing values are converted back to integers.
+        '''
+        if pd.api.types.is_float_dtype(ids):
+            ids = ids.astype('Int64')
+        codes, uniques = pd.factorize(ids)
+        return(codes.astype(np.int32), np.asarray(uniques).astype(str))
+
+    @staticmethod
+    def __group_codes(gene_codes, codes, gene_count):
+        '''
+        Returns the sorted, distinct codes for each gene code.
+        Missing IDs (code -1) are dropped, they would corrupt the packed pairs.
+        '''
+        valid = (gene_codes >= 0) & (codes >= 0)
+        pairs = np.unique(gene_codes[valid].astype(np.int64) << 32 | codes[valid])
+        bounds = np.searchsorted(pairs >> 32, np.arange(gene_count + 1))
+        codes = (pairs & 0xFFFFFFFF).astype(np.int32)
+        return(np.split(codes, bounds[1:-1]))
 
     def get_results(self):
-        for EnsemblID in self.gene_container.keys():
-            self.gene_container[EnsemblID]['rsIDs'] = list(set(self.gene_container[EnsemblID]['rsIDs']))
-            self.gene_container[EnsemblID]['studyID'] = list(set(self.gene_container[EnsemblID]['studyID']))
-            self.gene_container[EnsemblID]['studyCount'] = len(self.gene_container[EnsemblID]['studyID'])
-            
-        return(self.gene_container)
+        '''
+        Returns a dictionary of Ensembl gene ID -> variants, studies and associations of the gene.
+        '''
+        results = {}
+        for EnsemblID, gene in self.gene_container.items():
+            results[EnsemblID] = {
+                'rsIDs' : self.rsIDs[gene.rsIDs].tolist(),
+                'studyID' : self.studyIDs[gene.studyIDs].tolist(),
+                'assocID' : self.assocIDs[gene.assocIDs].tolist(),
+                'associationCount' : len(gene.assocIDs),
+                'studyCount' : len(gene.studyIDs)
+            }
+
+        return(results)
 
     def save_results(self, filename):
         try:
@@ -148,67 +325,8 @@ class gene_sql(object):
             current_dir = os.getcwd()
             path = os.path.join(current_dir, "data/%s" % (filename))
             dump = open(filename, 'wb')
-            pickle.dump(self.gene_container, dump)
+            pickle.dump(self.get_results(), dump)
             return(0)
         except:
             print("[Warning] Saving data failed.")
             return(1)
-
-    def __process_rsID_row(self, row):
-        rsID  = str(row['RS_ID'])
-        snpID = str(row['SNP_ID'])    
-
-        # Extracting genomic context:
-        if rsID in self.rsID_container:
-            return([rsID, self.rsID_container[rsID]])
-
-        genomicContext = pd.read_sql(self.sql_get_genes, self.connection, params = {'snp_ID': snpID})
-        genomicContext = genomicContext.drop_duplicates()
-        mappedGenes = []
-        if genomicContext.IS_INTERGENIC.isin([0]).any():
-            mappedGenes = genomicContext.loc[genomicContext.IS_INTERGENIC == 0, 'ENSEMBL_GENE_ID'].tolist()
-        else:
-            mappedGenes = genomicContext.loc[genomicContext.IS_CLOSEST_GENE == 1, 'ENSEMBL_GENE_ID'].tolist()
-
-        return([rsID, mappedGenes])
-
-    # Looping through all the associations and 
-    def __process_association_row(self, row):
-        associationID = str(row['ASSOCIATION_ID'])
-        studyID = str(row['STUDY_ID'])
-
-        # Extract rsIDs:
-        rsIDs = pd.read_sql(self.sql_get_rsIDs, self.connection, params = {'assoc_id': associationID})
-
-        # Extract mapped genes for every rsIDs in the association:
-        mapped_genes = rsIDs.apply(self.__process_rsID_row, axis = 1)
-
-        # Parsing out mapped genes:
-        gene_assoc = []
-        
-        for index, row in mapped_genes.iteritems():
-            rsID = row[0]
-            genes = row[1]
-
-            # Updating the rsID container:
-            self.rsID_container[rsID] = genes
-
-            # Adding gene to the gene container:
-            for gene in genes:
-                try:
-                    self.gene_container[gene]['rsIDs'].append(rsID)
-                    if not gene in gene_assoc:
-                        self.gene_container[gene]['studyID'].append(studyID)
-                        self.gene_container[gene]['associationCount'] += 1
-                        self.gene_container[gene]['assocID'].append(associationID)
-                        gene_assoc.append(gene)
-                except:
-                    self.gene_container[gene] = {
-                        'rsIDs' : [rsID],
-                        'studyID' : [studyID],
-                        'assocID' : [associationID],
-                        'associationCount' : 1
-                    }
-                    gene_assoc.append(gene)
-
-
@@ -1,32 +1,60 @@
-import subprocess
+import concurrent.futures
+import contextlib
 import numpy as np
 import pandas as pd
 import os
 import re
+import time
 import os.path
-import pickle
-import urllib
-from tqdm import tqdm
+import glob
+import gzip
+import hashlib
+import io
+import urllib.parse
+import urllib.request
 
 from scripts.EnsemblREST import REST
+from scripts.cytoband_index import CytobandIndex
 
 class GeneAnnotator(object):
     '''
     This class collects gene annotations from various sources then generates gene solr objects.
     '''
     
-    def __init__(self, HGNCFile, EnsemblFtpPath, RESTServer, verbose = False):
+    # Annotation tables saved in the local snapshot:
+    snapshot_tables = ['Ensembl_annot', 'cytoband', 'HGNC', 'entrez']
+
+    def __init__(self, HGNCFile, EnsemblFtpPath, RESTServer, verbose = False, snapshotDir = None, loaders = None, RESTOptions = None):
         # Setting verbosity flag:
         self.__verbose = verbose
+        if RESTOptions is None: RESTOptions = {}
         print(RESTServer)
         # Initialize handler for the REST API of Ensembl:
         try:
-            self.EnsemblREST = REST.REST(RESTServer)
+            self.EnsemblREST = REST.REST(RESTServer, **RESTOptions)
         except:
             raise("[Error] The initialization of the REST handler for Ensembl failed.")
 
-        # Detecting the actual ensembl release:
-        self.__Ensembl_release = self.EnsemblREST.getEnsemblRelease()
+        self.__HGNCFile = HGNCFile
+
+        # Tables of custom loaders don't come from the Ensembl release and HGNC file the snapshot is keyed on,
+        # so they are neither loaded from nor saved to the snapshot:
+        if loaders and snapshotDir:
+            print("[Info] Custom annotation loaders are used, the local snapshot is ignored.")
+            snapshotDir = None
+        self.__snapshotDir = snapshotDir
+
+        # Detecting the actual ensembl release. Without network, a local snapshot can still be used:
+        try:
+            self.__Ensembl_release = self.EnsemblREST.getEnsemblRelease()
+        except Exception as e:
+            if not snapshotDir:
+                raise
+            print("[Warning] Ensembl release could not be retrieved: %s" % e)
+            self.__Ensembl_release = None
+
+        # Loading the annotation from the local snapshot if available:
+        snapshot_loaded = self.__load_snapshot()
 
         # Validating input files:
         self.__input_file_path_constructor(HGNCFile, EnsemblFtpPath)
@@ -43,18 +71,49 @@ class GeneAnnotator(object):
             print("[Info] Fetching annotation...")
 
         # Gatering annotation data:
-        self.__get_Ensembl_gene_annotation() # Extracting Ensembl data
-        self.__get_cytoband() # Extracting cytoband data from REST
-        self.__get_Entrez_lookup_table() # Extracting cytoband data from REST
-        self.__get_HGNC() # Extracting HGNC names and synonyms
+        if not snapshot_loaded:
+            self.__load_annotation(loaders)
+            self.__save_snapshot()
+
+        # Interval index to assign cytobands to genes:
+        self.__cytoband_index = CytobandIndex(self.__cytobands)
 
         # Reporting completion:
         if self.__verbose:
             print("[Info] Gene annotation information compiled. Ready to create documents.\n")
 
+    def __load_annotation(self, loaders = None):
+        '''
+        Runs the loaders of the annotation tables in parallel threads, as they are mostly waiting for the network.
+
+        Each loader is a function without arguments returning its table. Any of the default loaders can be
+        replaced through the loaders dictionary (keys: Ensembl_annot, cytoband, HGNC, entrez), eg. to read local files.
+        '''
+        annotation_loaders = {
+            'Ensembl_annot' : self.__get_Ensembl_gene_annotation, # Extracting Ensembl data
+            'cytoband' : self.__get_cytoband, # Extracting cytoband data from REST
+            'entrez' : self.__get_Entrez_lookup_table, # Extracting Entrez IDs
+            'HGNC' : self.__get_HGNC, # Extracting HGNC names and synonyms
+        }
+        annotation_loaders.update(loaders or {})
+
+        def run_loader(name, loader):
+            start = time.time()
+            table = loader()
+            if self.__verbose: print("[Info] %s annotation is loaded in %.1f seconds." % (name, time.time() - start))
+            return(table)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(annotation_loaders)) as executor:
+            futures = {name : executor.submit(run_loader, name, loader) for name, loader in annotation_loaders.items()}
+            tables = {name : future.result() for name, future in futures.items()}
+
+        self.__ensembl_data = tables['Ensembl_annot']
+        self.__cytobands = tables['cytoband']
+        self.__HGNC_data = tables['HGNC']
+        self.__Entrez_lookup = tables['entrez']
+
     def __input_file_path_constructor(self, HGNCFile, EnsemblFtpPath):
 
-        self.__HGNCFile = HGNCFile
         self.__EntrezFile = ("%s/release-%s/tsv/homo_sapiens/Homo_sapiens.GRCh38.%s.entrez.tsv.gz" % (EnsemblFtpPath, self.__Ensembl_release, self.__Ensembl_release))
         self.__EnsemblFile = ("%s/release-%s/gff3/homo_sapiens/Homo_sapiens.GRCh38.%s.chr.gff3.gz" % (EnsemblFtpPath, self.__Ensembl_release, self.__Ensembl_release))
 
@@ -82,58 +141,140 @@ class GeneAnnotator(object):
 
         if self.__verbose : print('[Info] Input data validation passed.')
 
+    # Attributes of the gene lines extracted from the 9th column of the gff file:
+    gff_attribute_patterns = {
+        'id' : re.compile(r'(?:^|;)ID=[^:;]*:([^:;]*)'),
+        'display_name' : re.compile(r'(?:^|;)Name=([^;]*)'),
+        'biotype' : re.compile(r'(?:^|;)biotype=([^;]*)'),
+        'description' : re.compile(r'(?:^|;)description=([^;]*)'),
+    }
+
+    @staticmethod
+    def __open_stream(path):
+        '''
+        Opens a local file or an ftp/http URL as a binary stream.
+        '''
+        if re.match(r'^(ftp|https?)://', path):
+            return(urllib.request.urlopen(path))
+        else:
+            return(open(path, 'rb'))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def __open_text_stream(path):
+        '''
+        Opens a local file or an ftp/http URL as a text stream. Gzipped files are decompressed on the fly.
+        The decompressing stream does not close the stream it reads from, so every layer is closed on exit.
+        '''
+        with contextlib.ExitStack() as stack:
+            stream = stack.enter_context(GeneAnnotator.__open_stream(path))
+
+            if path.endswith('.gz'):
+                stream = stack.enter_context(gzip.GzipFile(fileobj = stream))
+
+            yield stack.enter_context(io.TextIOWrapper(stream, encoding = 'UTF-8'))
+
+    def __get_HGNC_version(self):
+        '''
+        Returns a checksum identifying the version of the HGNC file without downloading it: computed from the
+        ETag, Last-Modified or Content-Length header of a remote file, or the size and modification time of a local file.
+        '''
+        if re.match(r'^(ftp|https?)://', self.__HGNCFile):
+            # Only the headers are requested. FTP has no HEAD request, the transfer is closed before reading:
+            with urllib.request.urlopen(urllib.request.Request(self.__HGNCFile, method = 'HEAD'), timeout = 60) as response:
+                headers = response.headers
+            version = headers.get('ETag') or headers.get('Last-Modified') or headers.get('Content-Length')
+            if not version:
+                raise(ValueError("the server returned no ETag, Last-Modified or Content-Length header"))
+        else:
+            stat = os.stat(self.__HGNCFile)
+            version = "%s:%s" % (stat.st_size, stat.st_mtime_ns)
+
+        return(hashlib.md5(version.encode('UTF-8')).hexdigest())
+
+    def __get_snapshot_folders(self):
+        '''
+        Returns the snapshot folders matching the Ensembl release and the version of the HGNC file,
+        the most recent first. If the release or the HGNC version is not available, any value is accepted.
+        '''
+        try:
+            checksum = self.__get_HGNC_version()
+        except Exception as e:
+            print("[Warning] Version of the HGNC file could not be retrieved: %s" % e)
+            checksum = None
+
+        release = self.__Ensembl_release
+
+        # Snapshots are only written for a known release and HGNC file:
+        if release is not None and checksum is not None:
+            self.__snapshot_folder = os.path.join(self.__snapshotDir, "e%s_hgnc_%s" % (release, checksum))
+
+        pattern = os.path.join(self.__snapshotDir, "e%s_hgnc_%s" % (release or '*', checksum or '*'))
+        return(sorted(glob.glob(pattern), key = os.path.getmtime, reverse = True))
+
+    def __load_snapshot(self):
+        '''
+        Loads the annotation tables from the local snapshot. Returns True if the snapshot was found.
+        '''
+        self.__snapshot_folder = None
+        if not self.__snapshotDir:
+            return(False)
+
+        for folder in self.__get_snapshot_folders():
+            files = [os.path.join(folder, "%s.pkl" % table) for table in self.snapshot_tables]
+            if not all(os.path.isfile(file) for file in files):
+                continue
+
+            self.__ensembl_data, self.__cytobands, self.__HGNC_data, self.__Entrez_lookup = [pd.read_pickle(file) for file in files]
+            self.__Ensembl_release = re.match(r'e(\d+)_', os.path.basename(folder)).group(1)
+            print("[Info] Gene annotation is loaded from snapshot: %s" % folder)
+            return(True)
+
+        # Without release we cannot download the annotation:
+        if self.__Ensembl_release is None:
+            raise(ValueError("[Error] Ensembl release is not available and no local snapshot is found in %s." % self.__snapshotDir))
+
+        return(False)
+
+    def __save_snapshot(self):
+        '''
+        Saves the annotation tables, so the next run with the same Ensembl release and HGNC file can reuse them.
+        '''
+        if not self.__snapshot_folder:
+            return
+
+        try:
+            os.makedirs(self.__snapshot_folder, exist_ok = True)
+            for table in self.snapshot_tables:
+                filename = os.path.join(self.__snapshot_folder, "%s.pkl" % table)
+                self.export_data(table).to_pickle(filename + '.tmp')
+                os.replace(filename + '.tmp', filename)
+            print("[Info] Gene annotation is saved to snapshot: %s" % self.__snapshot_folder)
+        except Exception as e:
+            print("[Warning] Saving annotation snapshot has failed: %s" % e)
+
     def __get_Ensembl_gene_annotation(self):
 
-        # list with all the genes and the available annotation:
-        EnsemblAnnotationContainer = []
-
-        def parse_annotation(fields):
-            if len(fields) < 8:
-                print(row)
-                return()
-
-            # Extracting coordinates:
-            geneAnnot = {
-                'seq_region_name' : fields[0],
-                'start' : fields[3],
-                'end' : fields[4],
-            }
-            
-            # Parse description column of the gff file:
-            for annot in fields[8].split(";"):
-                key, value = annot.split("=")
-                if key == 'ID':
-                    geneAnnot['id'] = value.split(":")[1]
-                if key == 'Name':
-                    geneAnnot['display_name'] = value
-                if key == 'biotype':
-                    geneAnnot['biotype'] = value
-                if key == 'description':
-                    geneAnnot['description'] = urllib.parse.unquote(value.split(" [")[0])
-                else:
+        # Only the gene lines are kept from the gff3 file with 2.8M lines:
+        gene_lines = []
+        with self.__open_text_stream(self.__EnsemblFile) as gff:
+            for line in gff:
+                if 'ID=gene' not in line or line.startswith('#'):
+                    continue
+
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 9 or 'ID=gene' not in fields[8]:
                     continue
-            
-            # Adding annotation to the container
-            return(geneAnnot)
-
-        # filter the gff3 file with 2.8M lines
-        filtered_df = pd.DataFrame()
-        # read in chunks to save memory
-        chunks = pd.read_table(self.__EnsemblFile,
-                               comment='#',
-                               dtype=str,
-                               encoding='UTF-8',
-                               header=None,
-                               chunksize=100000)
-        # filter each chunk and append to filtered df
-        for chunk in chunks:
-            filtered_df = filtered_df.append(chunk[chunk[8].str.contains('ID=gene')])
-        # parse the annotations
-        for row in filtered_df.values:
-            EnsemblAnnotationContainer.append(parse_annotation(row))
-
-        # Pooling annotations into a pandas dataframe and format table:
-        EnsAnnotDf = pd.DataFrame.from_records(EnsemblAnnotationContainer)
+
+                gene_lines.append((fields[0], fields[3], fields[4], fields[8]))
+
+        EnsAnnotDf = pd.DataFrame.from_records(gene_lines, columns = ['seq_region_name', 'start', 'end', 'attributes'])
+
+        # Parsing the attributes:
+        for column, pattern in self.gff_attribute_patterns.items():
+            EnsAnnotDf[column] = EnsAnnotDf.attributes.str.extract(pattern, expand = False)
+
+        EnsAnnotDf.description = EnsAnnotDf.description.str.split(' \\[').str[0].map(urllib.parse.unquote, na_action = 'ignore')
 
         # Setting start and end columns as integers:
         EnsAnnotDf.start = EnsAnnotDf.start.astype(int)
@@ -147,7 +288,7 @@ class GeneAnnotator(object):
         
         if self.__verbose: print("[Info] Ensembl annotations are extracted for %s genes" % len(EnsAnnotDf))
         
-        self.__ensembl_data = EnsAnnotDf
+        return(EnsAnnotDf)
 
     def __get_HGNC(self):
         '''
@@ -161,35 +302,45 @@ class GeneAnnotator(object):
         # Report:
         if self.__verbose: print("[Info] Retrieving HGNC dataset from %s" % self.__HGNCFile )
 
-        df = pd.read_table(self.__HGNCFile, dtype = str)
-
-        def concatenate(x):
-            row = x.loc[~ x.isna()].tolist()
-            return("|".join([str(x) for x in row]))
+        alternativeID_columns = ['hgnc_id', 'vega_id', 'ucsc_id', 'ena', 'refseq_accession', 'ccds_id', 'mgd_id', 'uniprot_ids']
+        synonym_columns = ['symbol', 'alias_symbol', 'alias_name','prev_symbol', 'prev_name']
+
+        with self.__open_stream(self.__HGNCFile) as HGNC:
+            df = pd.read_table(HGNC, dtype = str,
+                               usecols = ['entrez_id', 'ensembl_gene_id'] + alternativeID_columns + synonym_columns)
+
+        def concatenate(columns):
+            '''
+            Joins the non-missing values of the columns with pipes, row by row.
+            '''
+            joined = pd.Series('', index = df.index, dtype = object)
+            has_value = pd.Series(False, index = df.index)
+            for column in columns:
+                values = df[column]
+                separator = np.where(has_value & values.notna(), '|', '')
+                joined = joined + separator + values.fillna('')
+                has_value = has_value | values.notna()
+            return(joined)
 
         # Adding other IDs:
-        df['alternativeIDs'] = df[['hgnc_id', 'vega_id', 'ucsc_id', 
-                                   'ena', 'refseq_accession', 'ccds_id', 
-                                   'mgd_id', 'uniprot_ids']].apply(concatenate, axis=1)
+        df['alternativeIDs'] = concatenate(alternativeID_columns)
 
         # Adding alternative names and synonyms:
-        df['synonyms'] = df[['symbol', 'alias_symbol', 
-                             'alias_name','prev_symbol', 'prev_name']].apply(concatenate, axis=1)
+        df['synonyms'] = concatenate(synonym_columns)
 
         # Filtering columns:
         df = df[['entrez_id', 'ensembl_gene_id', 'alternativeIDs', 'synonyms']]
         
-        # Remove duplicates:
-        df.drop_duplicates(inplace=True)
+        # Remove duplicates. Genes are looked up by Ensembl ID, so only the first row of each gene is kept:
+        df = df.loc[df.ensembl_gene_id.notna()].drop_duplicates(subset = ['ensembl_gene_id'])
         
         # Adding Ensembl IDs as index:
-        df.index = df.ensembl_gene_id.tolist()
+        df.index = pd.Index(df.ensembl_gene_id.tolist())
 
         # Report:
         if self.__verbose: print("[Info] Number of genes in the HGNC dataset: %s" % len(df))
         
-        # Saving data:
-        self.__HGNC_data = df
+        return(df)
 
     def __get_Entrez_lookup_table(self):
         
@@ -202,7 +353,7 @@ class GeneAnnotator(object):
         entrezdf.reset_index(drop=True, inplace= True)
         entrezdf.index = entrezdf.gene_stable_id.tolist()
         
-        self.__Entrez_lookup = entrezdf
+        return(entrezdf)
 
     def __get_cytoband(self):
 
@@ -212,133 +363,135 @@ class GeneAnnotator(object):
         cytobands = self.EnsemblREST.getAssembly('cytobands')
         cytobands_df = pd.DataFrame(cytobands)
         cytobands_df = cytobands_df[['chromosome', 'start', 'end', 'id', 'stain']].sort_values(by = ['chromosome', 'start'])
-        self.__cytobands = cytobands_df
 
-        if self.__verbose: print("[Info] Number of cytobands: %s" % len(self.__cytobands))
+        if self.__verbose: print("[Info] Number of cytobands: %s" % len(cytobands_df))
+
+        return(cytobands_df)
+
+    # Fields of the gene document in the order they are written:
+    document_fields = ['resourcename', 'id', 'ensemblID', 'rsIDs', 'studyCount', 'associationCount',
+                       'chromosomeStart', 'chromosomeEnd', 'chromosomeName', 'biotype', 'title',
+                       'ensemblDescription', 'crossRefs', 'entrez_id', 'cytobands', 'description']
+
+    # Fields of the Ensembl annotation (gff file or REST):
+    ensembl_fields = ['seq_region_name', 'start', 'end', 'biotype', 'display_name', 'description']
+
+    @staticmethod
+    def __format_REST_annotation(annotation):
+        '''
+        Formats the gene annotations returned by the REST API like the Ensembl table. Annotations without
+        any of the required fields are dropped.
+        '''
+        records = {}
+        for gene_ID, annot in annotation.items():
+            if not isinstance(annot, dict) or any(field not in annot for field in GeneAnnotator.ensembl_fields[:-1]):
+                continue
+
+            records[gene_ID] = {field : annot[field] for field in GeneAnnotator.ensembl_fields[:-1]}
+
+            # Missing descriptions are treated as the missing values of the gff file:
+            description = annot.get('description', np.nan)
+            records[gene_ID]['description'] = description if isinstance(description, float) else str(description)
+
+        return(pd.DataFrame.from_dict(records, orient = 'index', columns = GeneAnnotator.ensembl_fields))
 
     def create_document(self, inputData):
+        '''
+        Generates the gene documents for the input data. The documents are yielded one by one.
+
+        The input mapping is joined with the Ensembl, HGNC, Entrez and cytoband annotations in one go.
+        Genes missing from the gff file are looked up in REST while the other genes are annotated.
+        '''
         print ("[Info] Creating gene documents.")
 
         # Testing the input:
         self.__input_data_validator(inputData)
-            
-        def generate_description(gene):
-            try:
-                description = [
-                    str(gene['ensemblDescription']),
-                    "%s:%s-%s" % (gene['chromosomeName'],
-                    gene['chromosomeStart'],
-                    gene['chromosomeEnd']),
-                    str(gene['cytobands']),
-                    str(gene['biotype'])]
-                return("|".join(description))
-            except: 
-                print("[Warning] description generation was failed for %s" % gene['id'])
-                return("NA")
-
-        # Extracting data from HGNC dataFrame:
-        def add_Entrez_id(gene, annot = {'gene_stable_id': '', 'xref' : ''}):
-            gene['entrez_id'] = annot['xref']
-
-        # Adding entrez ID to the document:
-        def add_HGNC_annot(gene, annot = {'entrez_id' : '', 'alternativeIDs': '', 'synonyms' : ''}):
-            gene['crossRefs'] = annot['alternativeIDs']
-            # gene['synonymsGene'] = annot['synonyms']    
-
-        def add_Ensembl_annot(gene, annot = {'start' : '', 'end' : '', 'seq_region_name': '',
-                                            'biotype' : '', 'display_name' : '', 'description': ''}):
-            gene['chromosomeStart'] = annot['start']
-            gene['chromosomeEnd'] = annot['end']
-            gene['chromosomeName'] = annot['seq_region_name']
-            gene['biotype'] = annot['biotype']
-            gene['title']= annot['display_name']
-            if not 'description' in annot:
-                gene['ensemblDescription'] = 'No description available'
-            elif isinstance(annot['description'], float):
-                gene['ensemblDescription'] = 'No description available'
-            else:
-                gene['ensemblDescription'] = str(annot['description']).split(' [Source')[0]                
-
-        def get_cytoband(gene, cytoband):
-            chrom = gene['chromosomeName']
-            start = gene['chromosomeStart']
-            end = gene['chromosomeEnd']
-
-            bands = cytoband.loc[(cytoband.chromosome == str(chrom)) 
-                                 & (cytoband.start <= int(start)) 
-                                 & (cytoband.end >= int(end)),'id'].tolist()
-            gene['cytobands'] = "/".join(bands)      
-
-        GeneDocuments = []
-        
+
+        # Input mapping as a table:
+        genes_df = pd.DataFrame({
+            'ensemblID' : list(inputData.keys()),
+            'rsIDs' : [x['rsIDs'] for x in inputData.values()],
+            'studyCount' : [x['studyCount'] for x in inputData.values()],
+            'associationCount' : [x['associationCount'] for x in inputData.values()],
+        })
+
         # Checking which IDs are missing from the gff file:
-        missingIDs = [x for x in list(inputData.keys()) if not self.__ensembl_data.index.isin([x]).any()]
-        missing_annotation = {}
-        if len(missingIDs) > 0: 
-            print("[Warning] %s IDs are missing from the gff file. Downloading annotation from REST." % len(missingIDs))
-            missing_annotation = self.EnsemblREST.postID(missingIDs)
-            print("[Info] Annotation for %s genes downloaded successfuly." % len(missing_annotation))
-            
-        
-        for gene_ID, x in tqdm(inputData.items(), desc = "Gene document generation"):
-
-            # Initializing gene document with basic stuffs:
-            gene = {
-                'resourcename' : 'gene',
-                'id' : 'gene:' + gene_ID,
-                'ensemblID' : gene_ID,
-                'rsIDs' : x['rsIDs'],
-                'studyCount' : x['studyCount'],
-                'associationCount' : x['associationCount']
-                 }
-
-            # Adding Ensembl annotation:
-            try:    
-                add_Ensembl_annot(gene, self.__ensembl_data.loc[[gene_ID]].iloc[0])
-            except:
-                # If the gene was not found in the 
-                try:
-                    add_Ensembl_annot(gene, missing_annotation[gene_ID])
-                except:
+        ensembl_df = self.__ensembl_data.loc[~ self.__ensembl_data.index.duplicated(), self.ensembl_fields]
+        missingIDs = pd.Index(genes_df.ensemblID).difference(ensembl_df.index, sort = False).tolist()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+            if len(missingIDs) > 0:
+                print("[Warning] %s IDs are missing from the gff file. Downloading annotation from REST." % len(missingIDs))
+                missing_annotation = executor.submit(self.EnsemblREST.postID, missingIDs)
+
+            # Annotating genes found in the gff file:
+            annotated = genes_df.ensemblID.isin(ensembl_df.index)
+            documents_df = [self.__annotate_genes(genes_df.loc[annotated], ensembl_df)]
+
+            # Annotating genes found in REST:
+            if len(missingIDs) > 0:
+                missing_annotation = missing_annotation.result()
+                print("[Info] Annotation for %s genes downloaded successfuly." % len(missing_annotation))
+
+                REST_df = self.__format_REST_annotation(missing_annotation)
+                found = genes_df.ensemblID.isin(REST_df.index)
+                for gene_ID in genes_df.ensemblID.loc[~ annotated & ~ found]:
                     print("[Warning] Ensembl annotation has failed for %s" % gene_ID)
-                    continue
 
-            # Keeping only genes that are mapped to the chromosomes. Patches are excluded.
-            if len(gene['chromosomeName']) > 2 : 
-                continue
+                documents_df.append(self.__annotate_genes(genes_df.loc[~ annotated & found], REST_df))
 
-            # Adding HGNC annotation:
-            try:
-                add_HGNC_annot(gene, self.__HGNC_data.loc[[gene_ID]].iloc[0])
-            except:
-                add_HGNC_annot(gene)
-                
-            # Adding entrez ID:
-            try:
-                add_Entrez_id(gene, self.__Entrez_lookup.loc[[gene_ID]].iloc[0])
-            except:
-                #print("[Index] Entrez ID was not found for %s" % gene_ID)
-                add_Entrez_id(gene)
-
-            # Adding entrez ID:
-            try:
-                get_cytoband(gene, self.__cytobands)
-            except:
-                print("[Warning] cytobands were not found for %s" % gene_ID)
-                gene['cytobands'] = '-'
-
-            # Adding formatted description:
-            gene['description'] = generate_description(gene)
-
-            # Adding gene to gene document:
-            if gene == None:
-                print(x)
-                print(gene_ID)
-
-            GeneDocuments.append(gene)
+        # Restoring the order of the input:
+        documents_df = pd.concat(documents_df).sort_index() if len(documents_df) > 1 else documents_df[0]
+
+        if self.__verbose:
+            print("[Info] Ensembl REST: %(requests)s requests over %(connections)s connections (%(reused)s reused)." %
+                  self.EnsemblREST.get_connection_stats())
+            print("[Info] Ensembl REST cache: %(hits)s hits, %(misses)s misses." % self.EnsemblREST.get_cache_stats())
+
+        # Emitting the documents:
+        columns = [documents_df[field].tolist() for field in self.document_fields]
+        for values in zip(*columns):
+            yield dict(zip(self.document_fields, values))
 
         print("[Info] Gene documents are done.")
-        return(GeneDocuments)
+
+    def __annotate_genes(self, genes_df, ensembl_df):
+        '''
+        Joins the genes with the Ensembl annotation, then adds the HGNC, Entrez and cytoband annotations.
+        Returns the table of gene documents. The index of the input table is kept.
+        '''
+        genes_df = genes_df.join(ensembl_df, on = 'ensemblID')
+        genes_df = genes_df.rename(columns = {'start' : 'chromosomeStart', 'end' : 'chromosomeEnd',
+                                              'seq_region_name' : 'chromosomeName', 'display_name' : 'title'})
+
+        # Keeping only genes that are mapped to the chromosomes. Patches are excluded.
+        genes_df = genes_df.loc[genes_df.chromosomeName.astype(str).str.len() <= 2].copy()
+
+        genes_df['resourcename'] = 'gene'
+        genes_df['id'] = 'gene:' + genes_df.ensemblID
+        genes_df['ensemblDescription'] = genes_df.description.astype(str).str.partition(' [Source', expand = False).str[0].where(
+            genes_df.description.notna(), 'No description available')
+
+        # Adding HGNC annotation:
+        HGNC_df = self.__HGNC_data.loc[~ self.__HGNC_data.index.duplicated()]
+        genes_df['crossRefs'] = genes_df.ensemblID.map(HGNC_df.alternativeIDs).fillna('')
+
+        # Adding entrez ID. Kept as object, so missing values don't turn the IDs into floats:
+        entrez_df = self.__Entrez_lookup.loc[~ self.__Entrez_lookup.index.duplicated()]
+        genes_df['entrez_id'] = genes_df.ensemblID.map(entrez_df.xref.astype(object)).astype(object).fillna('')
+
+        # Adding cytobands:
+        genes_df['cytobands'] = self.__cytoband_index.lookup_many(genes_df.chromosomeName, genes_df.chromosomeStart,
+                                                                  genes_df.chromosomeEnd)
+        for gene_ID in genes_df.ensemblID.loc[genes_df.cytobands == '-']:
+            print("[Warning] cytobands were not found for %s" % gene_ID)
+
+        # Adding formatted description:
+        genes_df['description'] = (genes_df.ensemblDescription + '|' + genes_df.chromosomeName.astype(str) + ':'
+                                   + genes_df.chromosomeStart.astype(str) + '-' + genes_df.chromosomeEnd.astype(str) + '|'
+                                   + genes_df.cytobands.astype(str) + '|' + genes_df.biotype.astype(str))
+
+        return(genes_df[self.document_fields])
 
     def export_data(self, data = '-'):
         if data == 'Ensembl_annot':
@@ -351,15 +504,3 @@ class GeneAnnotator(object):
             return(self.__Entrez_lookup)
         else:
             print('[Info] Available fields to return: Ensembl_annot, cytoband, HGNC, entrez')
-
-    def save_data(self, filename):
-        try:
-            # Saving the whole object:
-            current_dir = os.getcwd()
-            path = os.path.join(current_dir, "data/%s" % (filename))
-            dump = open(filename, 'wb')
-            pickle.dump(self, dump)
-            return(0)
-        except:
-            print("[Warning] Saving data has failed.")
-            return(1)
\ No newline at end of file
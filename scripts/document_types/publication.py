@@ -11,9 +11,20 @@ import os.path
 # import gwas_data_sources
 
 
-def get_publication_data(connection, limit=0, testRun = False):
+publication_attr_list = [
+    'id', 'pmid', 'journal', 'title',
+    'publicationDate', 'resourcename', 'author', 'author_s',
+    'authorAscii', 'authorAscii_s', 'authorsList',
+    'associationCount', 'studyCount', 'description', 'countryOfRecruitment'
+]
+
+
+def get_publication_data(connection, limit=0, testRun = False, bulk = False):
     '''
-    Get Publication data for Solr document.
+    Get Publication data for Solr document. The documents are yielded one by one.
+
+    If bulk is set, the authors, counts, countries and studies of all publications are extracted
+    with one grouped query each, instead of querying the database for every single publication.
     '''
 
     # List of PMIDs of publications that are special in some way (as string!):
@@ -91,15 +102,6 @@ def get_publication_data(connection, limit=0, testRun = False):
     """
 
 
-    all_publication_data = []
-
-    publication_attr_list = [
-        'id', 'pmid', 'journal', 'title',
-        'publicationDate', 'resourcename', 'author', 'author_s',
-        'authorAscii', 'authorAscii_s', 'authorsList',
-        'associationCount', 'studyCount', 'description', 'countryOfRecruitment'
-    ]
-
     try:
         # ip, port, sid, username, password = gwas_data_sources.get_db_properties(DATABASE_NAME)  # noqa
         # dsn_tns = cx_Oracle.makedsn(ip, port, sid)
@@ -109,23 +111,16 @@ def get_publication_data(connection, limit=0, testRun = False):
             cursor.execute(publication_sql)
             publication_data = cursor.fetchall()
 
+            # Assemble all publication documents from whole-table extracts:
+            if bulk:
+                yield from get_bulk_publication_data(cursor, publication_data, testRun, testPmidSet)
+                return
+
             for publication in tqdm(publication_data, desc='Get Publication data'):  # noqa
 
                 # If a test run is called, skip all publications except which are listed in the test set:
                 if testRun and not publication[1] in testPmidSet: continue 
 
-                publication = list(publication)
-
-                publication_document = {}
-
-                # Add data from gene to dictionary
-                publication_document[publication_attr_list[0]] = publication[5]+":"+str(publication[0])  # noqa
-                publication_document[publication_attr_list[1]] = publication[1]
-                publication_document[publication_attr_list[2]] = publication[2]
-                publication_document[publication_attr_list[3]] = publication[3]
-                publication_document[publication_attr_list[4]] = publication[4]
-                publication_document[publication_attr_list[5]] = publication[5]
-
                 ############################
                 # Get Author data
                 ############################
@@ -133,45 +128,11 @@ def get_publication_data(connection, limit=0, testRun = False):
                 r = cursor.execute(None, {'pubmed_id': publication[1]})
                 author_data = cursor.fetchall()
 
-                # Create first author
-                # first_author = [author_data[0][0]]
-                
                 # There's a chance that a publication has no authors:
                 if not author_data: 
                     print("[Warning] Publication does not have any author: %s. Publication is skipped." % publication[1])
                     continue
 
-                publication_document[publication_attr_list[6]] = [author_data[0][0]]  # noqa
-
-                # Create first author as string
-                # author_s = author_data[0][0]
-                publication_document[publication_attr_list[7]] = author_data[0][0]  # noqa
-
-                # Create ascii author list
-                # author_ascii = [author_data[0][1]]
-                publication_document[publication_attr_list[8]] = [author_data[0][1]]  # noqa
-
-                # Create ascii author string 
-                # author_ascii_s = author_data[0][1]
-                # publication.append(author_ascii_s)
-                publication_document[publication_attr_list[9]] = author_data[0][1]  # noqa
-
-                if author_data[0][3] is None:
-                    author_orcid = 'NA'
-                else:   
-                    author_orcid = author_data[0][3] 
-                
-                authorList = []
-                for author in author_data:
-                    # author list, e.g. "Grallert H | Grallert H | 5 | ORCID"
-                    author_formatted = str(author[0])+" | "+str(author[1])+\
-                        " | "+str(author[2])+" | "+author_orcid
-                    authorList.append(author_formatted)
-                
-                # add authorList to publication data
-                publication_document[publication_attr_list[10]] = authorList
-
-
                 ##########################
                 # Get Association count 
                 ##########################
@@ -179,8 +140,6 @@ def get_publication_data(connection, limit=0, testRun = False):
                 r = cursor.execute(None, {'pubmed_id': publication[1]})
                 association_cnt = cursor.fetchone()
 
-                publication_document[publication_attr_list[11]] = association_cnt[0]
-
 
                 #########################################
                 # Get number of Studies per Publication
@@ -189,8 +148,6 @@ def get_publication_data(connection, limit=0, testRun = False):
                 r = cursor.execute(None, {'pubmed_id': publication[1]})
                 study_cnt = cursor.fetchone()
 
-                publication_document[publication_attr_list[12]] = study_cnt[0]
-
 
                 ##########################################
                 # Get a list of countries of recruitment
@@ -198,7 +155,6 @@ def get_publication_data(connection, limit=0, testRun = False):
                 cursor.prepare(country_of_recruitment_sql)
                 r = cursor.execute(None, {'publication_id' : publication[0]})
                 country_of_recruitment = cursor.fetchall()
-                publication_document['countryOfRecruitment'] = [ x[0] for x in country_of_recruitment ]  # noqa
 
 
                 #########################################
@@ -208,100 +164,267 @@ def get_publication_data(connection, limit=0, testRun = False):
                 r = cursor.execute(None, {'pubmed_id': publication[1]})
                 studies = cursor.fetchall()
 
-                # TEMP FIX - Add Study and FullPValue information to Publication document
-                study_list = []
-                full_pvalue = False
-                for study in studies:
-                    study_list.append(study[1])
-                    publication_document['parentDocument_accessionId'] = study_list
-
-                    # If any Study for the Publication includes Summary Stats, 
-                    # mark the Publication as having Summary Stats for Search results. 
-                    # Users will identify individual studies with summary stats on dedicated pages.
-                    if study[2]:
-                        full_pvalue = True
-                    publication_document['fullPvalueSet'] = full_pvalue
-
-                
-                # TEMP FIX - Add Study information to Publication document
-                all_genotyping_technologies = []
-                all_ancestral_groups = []
-                # For each study, get the Ancestral Groups
-                # child_docs = []
+                # Genotyping technologies and ancestral groups of the studies, keyed on the study ID
+                genotyping_technologies = {}
+                ancestral_groups = {}
                 for study in studies:
-                    # study_doc = {}
-                    # study_doc['content_type'] = 'childDocument'
-                    # study_doc['id'] = "study"+":"+str(study[0])
-                    # study_doc['accessionId'] = study[1]
-
-
-                    #############################
-                    # Get Genotyping Technology 
-                    #############################
-                    # study_genotyping_technologies = []
                     cursor.prepare(study_genotyping_technology_sql)
                     r = cursor.execute(None, {'study_id': study[0]})
-                    genotyping_technologies = cursor.fetchall()
-
-                    if not genotyping_technologies:
-                        gt_technologies = 'NA'
-                    else:
-                        gt_technologies = genotyping_technologies[0][1]
-                    
-                    # Add only distinct values to the all_genotyping_technologies list
-                    if gt_technologies not in all_genotyping_technologies:
-                        all_genotyping_technologies.append(gt_technologies)
-                    
-
-                    #######################
-                    # Get Ancestral groups
-                    #######################
-                    study_ancestral_groups = []
+                    genotyping_technologies.update(cursor.fetchall())
 
                     cursor.prepare(study_ancestral_groups_sql)
                     r = cursor.execute(None, {'study_id': study[0]})
-                    ancestral_groups = cursor.fetchall()
-
-                    if not ancestral_groups:
-                        study_ancestral_groups = 'NR'
-                        all_ancestral_groups.append('NR')
-                    else:
-                        study_ancestral_groups = [ancestral_groups[0][1]]
-                        all_ancestral_groups.append(ancestral_groups[0][1])
-
-                # Finally, add child_docs to publication document
-                # publication_document['_childDocuments_'] = child_docs
-                # publication_document['content_type'] = 'parentDocument'
-                publication_document['parentDocument_ancestralGroups'] = all_ancestral_groups
-                publication_document['genotypingTechnologies'] = all_genotyping_technologies
-
-
-
-                #############################
-                # Create description field
-                #############################
-                # The description field is formatted as:
-                # First author, year, journal, pmid.
-                year, month, day = publication[4].split("-")
-                
-                description = author_data[0][0]+" et al. "+year+" "+publication[2]+" "\
-                +"PMID:"+publication[1]
-
-                publication_document['description'] = description
-
-
-                ######################################
-                # Add publication data document to
-                # list of all publication data docs
-                ######################################
-                # all_publication_data.append(publication)
-                all_publication_data.append(publication_document)
+                    ancestral_groups.update(cursor.fetchall())
+
+                yield build_publication_document(publication, author_data, association_cnt[0],
+                    study_cnt[0], [ x[0] for x in country_of_recruitment ], studies,
+                    genotyping_technologies, ancestral_groups)
         
 
         # connection.close()
 
-        return all_publication_data
-
     except cx_Oracle.DatabaseError as e:
+        # The documents are streamed to the output file, which must not be completed with the documents extracted so far:
         print(e)
+        raise
+
+
+
+def get_bulk_publication_data(cursor, publication_data, testRun = False, testPmidSet = None):
+    '''
+    Assemble publication documents from whole-table extracts.
+
+    Each query returns the data of all publications (or studies), which is indexed
+    on the PubMed ID, publication ID or study ID, so no query is issued per publication.
+    '''
+
+    if testPmidSet is None:
+        testPmidSet = []
+
+    all_publication_author_list_sql = """
+        SELECT P.PUBMED_ID, A.FULLNAME, A.FULLNAME_STANDARD, PA.SORT, A.ORCID
+        FROM PUBLICATION P, AUTHOR A, PUBLICATION_AUTHORS PA
+        WHERE P.ID=PA.PUBLICATION_ID and PA.AUTHOR_ID=A.ID
+        ORDER BY P.PUBMED_ID, PA.SORT ASC
+    """
+
+    all_publication_association_cnt_sql = """
+        SELECT P.PUBMED_ID, COUNT(A.ID)
+        FROM STUDY S, PUBLICATION P, ASSOCIATION A
+        WHERE S.PUBLICATION_ID=P.ID and A.STUDY_ID=S.ID
+        GROUP BY P.PUBMED_ID
+    """
+
+    all_publication_study_cnt_sql = """
+        SELECT P.PUBMED_ID, COUNT(S.ID)
+        FROM STUDY S, PUBLICATION P
+        WHERE S.PUBLICATION_ID=P.ID
+        GROUP BY P.PUBMED_ID
+    """
+
+    all_publication_study_sql = """
+        SELECT P.PUBMED_ID, S.ID, S.ACCESSION_ID, S.FULL_PVALUE_SET 
+        FROM STUDY S, PUBLICATION P 
+        WHERE S.PUBLICATION_ID = P.ID 
+    """
+
+    all_study_ancestral_groups_sql = """
+        SELECT  x.ID, listagg(x.ANCESTRAL_GROUP, ', ') WITHIN GROUP (ORDER BY x.ANCESTRAL_GROUP)
+        FROM (
+                SELECT DISTINCT S.ID, AG.ANCESTRAL_GROUP
+                FROM STUDY S, ANCESTRY A, ANCESTRY_ANCESTRAL_GROUP AAG, ANCESTRAL_GROUP AG
+                WHERE S.ID=A.STUDY_ID and A.ID=AAG.ANCESTRY_ID and AAG.ANCESTRAL_GROUP_ID=AG.ID
+            ) x
+        GROUP BY x.ID
+    """
+
+    all_study_genotyping_technology_sql = """
+        SELECT  x.ID, listagg(x.GENOTYPING_TECHNOLOGY, ', ') WITHIN GROUP (ORDER BY x.GENOTYPING_TECHNOLOGY) 
+        FROM (
+            SELECT DISTINCT S.ID, GT.GENOTYPING_TECHNOLOGY 
+            FROM STUDY S, STUDY_GENOTYPING_TECHNOLOGY SGT, GENOTYPING_TECHNOLOGY GT 
+            WHERE S.ID=SGT.STUDY_ID and SGT.GENOTYPING_TECHNOLOGY_ID=GT.ID 
+            ) x 
+        GROUP BY x.ID
+    """
+
+    all_country_of_recruitment_sql = """
+        SELECT DISTINCT S.PUBLICATION_ID, C.COUNTRY_NAME
+        FROM STUDY S, ANCESTRY A, ANCESTRY_COUNTRY_RECRUITMENT ACR, COUNTRY C
+        WHERE S.ID=A.STUDY_ID and A.ID=ACR.ANCESTRY_ID and ACR.COUNTRY_ID=C.ID
+    """
+
+    print("[Info] Extracting publication data in bulk.")
+
+    def group_rows(sql):
+        '''
+        Runs the query and returns the rows grouped on the first column, in the order they were returned.
+        '''
+        cursor.execute(sql)
+        grouped = {}
+        for row in cursor.fetchall():
+            grouped.setdefault(row[0], []).append(row[1:])
+        return grouped
+
+    def lookup_rows(sql):
+        cursor.execute(sql)
+        return dict(cursor.fetchall())
+
+    authors = group_rows(all_publication_author_list_sql)
+    association_cnt = lookup_rows(all_publication_association_cnt_sql)
+    study_cnt = lookup_rows(all_publication_study_cnt_sql)
+    studies = group_rows(all_publication_study_sql)
+    genotyping_technologies = lookup_rows(all_study_genotyping_technology_sql)
+    ancestral_groups = lookup_rows(all_study_ancestral_groups_sql)
+    countries = group_rows(all_country_of_recruitment_sql)
+
+    for publication in tqdm(publication_data, desc='Get Publication data'):  # noqa
+
+        # If a test run is called, skip all publications except which are listed in the test set:
+        if testRun and not publication[1] in testPmidSet: continue 
+
+        # There's a chance that a publication has no authors:
+        if not publication[1] in authors: 
+            print("[Warning] Publication does not have any author: %s. Publication is skipped." % publication[1])
+            continue
+
+        # Publications without associations or studies are not returned by the grouped queries:
+        yield build_publication_document(publication, authors[publication[1]],
+            association_cnt.get(publication[1], 0), study_cnt.get(publication[1], 0),
+            [ x[0] for x in countries.get(publication[0], []) ], studies.get(publication[1], []),
+            genotyping_technologies, ancestral_groups)
+
+
+def build_publication_document(publication, author_data, association_cnt, study_cnt, country_of_recruitment,
+                               studies, genotyping_technologies, ancestral_groups):
+    '''
+    Assemble the publication document from the extracted data:
+        * author_data: non-empty list of (fullname, standard fullname, sort, orcid) tuples ordered by sort.
+        * studies: list of (study ID, accession ID, full p-value set) tuples.
+        * genotyping_technologies, ancestral_groups: comma separated values keyed on the study ID.
+    '''
+
+    publication = list(publication)
+
+    publication_document = {}
+
+    # Add data from gene to dictionary
+    publication_document[publication_attr_list[0]] = publication[5]+":"+str(publication[0])  # noqa
+    publication_document[publication_attr_list[1]] = publication[1]
+    publication_document[publication_attr_list[2]] = publication[2]
+    publication_document[publication_attr_list[3]] = publication[3]
+    publication_document[publication_attr_list[4]] = publication[4]
+    publication_document[publication_attr_list[5]] = publication[5]
+
+    ############################
+    # Get Author data
+    ############################
+
+    # Create first author
+    # first_author = [author_data[0][0]]
+    publication_document[publication_attr_list[6]] = [author_data[0][0]]  # noqa
+
+    # Create first author as string
+    # author_s = author_data[0][0]
+    publication_document[publication_attr_list[7]] = author_data[0][0]  # noqa
+
+    # Create ascii author list
+    # author_ascii = [author_data[0][1]]
+    publication_document[publication_attr_list[8]] = [author_data[0][1]]  # noqa
+
+    # Create ascii author string 
+    # author_ascii_s = author_data[0][1]
+    # publication.append(author_ascii_s)
+    publication_document[publication_attr_list[9]] = author_data[0][1]  # noqa
+
+    if author_data[0][3] is None:
+        author_orcid = 'NA'
+    else:   
+        author_orcid = author_data[0][3] 
+    
+    authorList = []
+    for author in author_data:
+        # author list, e.g. "Grallert H | Grallert H | 5 | ORCID"
+        author_formatted = str(author[0])+" | "+str(author[1])+\
+            " | "+str(author[2])+" | "+author_orcid
+        authorList.append(author_formatted)
+    
+    # add authorList to publication data
+    publication_document[publication_attr_list[10]] = authorList
+
+
+    ##########################
+    # Get Association count 
+    ##########################
+    publication_document[publication_attr_list[11]] = association_cnt
+
+
+    #########################################
+    # Get number of Studies per Publication
+    #########################################
+    publication_document[publication_attr_list[12]] = study_cnt
+
+
+    ##########################################
+    # Get a list of countries of recruitment
+    ##########################################
+    publication_document['countryOfRecruitment'] = country_of_recruitment
+
+
+    #########################################
+    # Get List of Studies per Publication
+    #########################################
+
+    # TEMP FIX - Add Study and FullPValue information to Publication document
+    study_list = []
+    full_pvalue = False
+    for study in studies:
+        study_list.append(study[1])
+        publication_document['parentDocument_accessionId'] = study_list
+
+        # If any Study for the Publication includes Summary Stats, 
+        # mark the Publication as having Summary Stats for Search results. 
+        # Users will identify individual studies with summary stats on dedicated pages.
+        if study[2]:
+            full_pvalue = True
+        publication_document['fullPvalueSet'] = full_pvalue
+
+    
+    # TEMP FIX - Add Study information to Publication document
+    all_genotyping_technologies = []
+    all_ancestral_groups = []
+    # For each study, get the Ancestral Groups
+    for study in studies:
+
+        #############################
+        # Get Genotyping Technology 
+        #############################
+        gt_technologies = genotyping_technologies.get(study[0], 'NA')
+        
+        # Add only distinct values to the all_genotyping_technologies list
+        if gt_technologies not in all_genotyping_technologies:
+            all_genotyping_technologies.append(gt_technologies)
+        
+
+        #######################
+        # Get Ancestral groups
+        #######################
+        all_ancestral_groups.append(ancestral_groups.get(study[0], 'NR'))
+
+    publication_document['parentDocument_ancestralGroups'] = all_ancestral_groups
+    publication_document['genotypingTechnologies'] = all_genotyping_technologies
+
+
+    #############################
+    # Create description field
+    #############################
+    # The description field is formatted as:
+    # First author, year, journal, pmid.
+    year, month, day = publication[4].split("-")
+    
+    description = author_data[0][0]+" et al. "+year+" "+publication[2]+" "\
+    +"PMID:"+publication[1]
+
+    publication_document['description'] = description
 
+    return publication_document
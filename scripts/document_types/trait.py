@@ -1,13 +1,19 @@
 import cx_Oracle
 import contextlib
+import os
+import concurrent.futures
+import numpy as np
 from tqdm import tqdm
 
 from scripts.ols import OLSData
+from scripts.ols import EFOGraph
 
 
-def get_trait_data(connection, limit=None):
+def get_trait_data(connection, limit=None, efo_file=None):
     '''
     Given each Mapped EFO trait, get all Reported trait information.
+    The documents are yielded one by one.
+    If a local EFO release file is given (OBO or JSON), the ontology data is read from there instead of OLS.
     '''
 
     efo_sql = """
@@ -25,14 +31,25 @@ def get_trait_data(connection, limit=None):
     """
 
     reported_trait_sql = """ 
-        SELECT DISTINCT DT.TRAIT AS REPORTED_DISEASE_TRAIT 
+        SELECT DISTINCT ET.ID, DT.TRAIT AS REPORTED_DISEASE_TRAIT 
         FROM STUDY S, EFO_TRAIT ET, DISEASE_TRAIT DT, STUDY_EFO_TRAIT SETR, STUDY_DISEASE_TRAIT SDT 
         WHERE S.ID=SETR.STUDY_ID and SETR.EFO_TRAIT_ID=ET.ID 
         and S.ID=SDT.STUDY_ID and SDT.DISEASE_TRAIT_ID=DT.ID 
-        and ET.ID= :trait_id
     """
 
-    all_trait_data = []
+    if efo_file:
+        term_data = EFOGraph.EFOGraph(efo_file).term_data
+        workers = 1
+    else:
+        # OLS responses are shared between the descendant and the ancestor lookups,
+        # and can be saved on disk for the current EFO release:
+        OLSData.configure_cache(cache_file=os.environ.get('OLSCacheFile'),
+                                cache_size=int(os.environ.get('OLSCacheSize', 100000)))
+
+        # Terms are looked up in parallel, with at most this many requests sent to OLS at a time:
+        workers = int(os.environ.get('OLSMaxInFlight', 10))
+        OLSData.configure_session(max_in_flight=workers, timeout=(10, float(os.environ.get('OLSTimeout', 60))))
+        term_data = OLSData.OLSData
 
     try:
         with contextlib.closing(connection.cursor()) as cursor:
@@ -41,16 +58,29 @@ def get_trait_data(connection, limit=None):
 
 
             # Build Lookup table of EFO_ID to list of children
-            efo_descendants_map =  __get_descendants(mapped_trait_data)
+            efo_descendants_map =  __get_descendants(mapped_trait_data, term_data, workers)
+
+            # Build Lookup table of EFO URI to term information and ancestors
+            efo_ancestors_map = __get_ancestors(mapped_trait_data, term_data, workers)
 
             # Get list of all EFOs used as annotations
-            all_efos = []
+            all_efos = set()
             for row in mapped_trait_data:
-                all_efos.append(row[4])
+                all_efos.add(row[4])
+
+            # Build Lookup tables of EFO_ID to studies and associations, the counts are rolled up in memory
+            efo_study_map = __get_members(cursor, 'study')
+            efo_association_map = __get_members(cursor, 'association')
 
             # Build Lookup table of EFO_ID to Association count
             efo_association_count_map = __build_efo_associationCnt_map(mapped_trait_data, cursor)
 
+            # Build Lookup table of trait ID to reported traits
+            cursor.execute(reported_trait_sql)
+            reported_trait_map = {}
+            for trait_id, reported_trait in cursor.fetchall():
+                reported_trait_map.setdefault(trait_id, []).append(reported_trait)
+
 
             # Build-up trait document for each EFO
             for mapped_trait in tqdm(mapped_trait_data, desc='Get EFO/Mapped trait data'):
@@ -78,7 +108,7 @@ def get_trait_data(connection, limit=None):
                 mapped_trait_document['label_autosuggest_e'] = [mapped_trait[1]]
 
                 
-                mapped_trait_document['termStudyCount'] = __get_count([mapped_trait[4]], cursor, 'study')
+                mapped_trait_document['termStudyCount'] = __count_members([mapped_trait[4]], efo_study_map)
 
                 mapped_trait_document['termAssociationCount'] = efo_association_count_map[mapped_trait[4]]
 
@@ -100,39 +130,30 @@ def get_trait_data(connection, limit=None):
                     # check if children list contains values
                     if children:
                         # remove children that are not in EFO table
-                        available_efo_children = list(set(all_efos).intersection(set(children)))
+                        available_efo_children = list(all_efos.intersection(children))
 
                         available_efo_children.append(mapped_trait[4])
-                        if len(available_efo_children) >= 1000:
-                            print("[Error] Too many EFOs for query: ", mapped_trait[4], len(available_efo_children))
 
-                        #TODO: Handle case if available_efo_children > 1000
-                        all_unique_study_count = __get_count(available_efo_children[0:999], cursor, 'study')
+                        all_unique_study_count = __count_members(available_efo_children, efo_study_map)
                         mapped_trait_document['studyCount'] = all_unique_study_count
 
-                        all_unique_association_count = __get_count(available_efo_children[0:999], cursor, 'association')
+                        all_unique_association_count = __count_members(available_efo_children, efo_association_map)
                         mapped_trait_document['associationCount'] = all_unique_association_count 
                     else:
-                        mapped_trait_document['studyCount'] = __get_count([mapped_trait[4]], cursor, 'study')
+                        mapped_trait_document['studyCount'] = __count_members([mapped_trait[4]], efo_study_map)
                         mapped_trait_document['associationCount'] = efo_association_count_map[mapped_trait[4]]
 
                 # term not yet in EFO 
                 else:
-                    mapped_trait_document['studyCount'] = __get_count([mapped_trait[4]], cursor, 'study')
+                    mapped_trait_document['studyCount'] = __count_members([mapped_trait[4]], efo_study_map)
                     mapped_trait_document['associationCount'] = efo_association_count_map[mapped_trait[4]]
 
 
                 #########################
                 # Get reported trait(s)
                 #########################
-                cursor.prepare(reported_trait_sql)
-                r = cursor.execute(None, {'trait_id': mapped_trait[0]})
-                all_reported_traits = cursor.fetchall()
-
                 # add reported trait as list
-                reported_trait_list = []
-                for trait in all_reported_traits:
-                    reported_trait_list.append(trait[0])
+                reported_trait_list = list(reported_trait_map.get(mapped_trait[0], []))
                 mapped_trait_document['reportedTrait'] = reported_trait_list
 
                 # add reported trait as a string
@@ -143,9 +164,7 @@ def get_trait_data(connection, limit=None):
                 #####################################
                 # Get EFO term information from OLS
                 #####################################
-                ols_data = OLSData.OLSData(mapped_trait[2])
-                type = 'ancestors'
-                ols_term_data = ols_data.get_ols_term(type)
+                ols_term_data, ancestors = efo_ancestors_map[mapped_trait[2]]
 
 
                 if not ols_term_data['iri'] == None:
@@ -182,8 +201,7 @@ def get_trait_data(connection, limit=None):
 
                     # Add ancestors
                     if not ols_term_data['ancestors'] == None:
-                        ancestor_data = OLSData.OLSData(ols_term_data['ancestors'])
-                        ancestor_terms = [ancestor for ancestor in ancestor_data.get_ancestors()]
+                        ancestor_terms = [ancestor for ancestor in ancestors]
                         mapped_trait_document['parent'] = ancestor_terms
 
                 else:
@@ -199,52 +217,69 @@ def get_trait_data(connection, limit=None):
 
 
                 ############################################
-                # Add trait data to list of all trait data
+                # Return trait data document
                 ############################################
-                all_trait_data.append(mapped_trait_document)
-
-            return all_trait_data
+                yield mapped_trait_document
 
+            if not efo_file:
+                print("[Info] OLS cache: %(hits)s hits, %(misses)s misses." % OLSData.term_cache.get_stats())
 
     except cx_Oracle.DatabaseError as e:
+        # The documents are streamed to the output file, which must not be completed with the documents extracted so far:
         print(e)
+        raise
 
 
 
-def __get_count(efos, cursor, count_type):
+def __get_members(cursor, member_type):
     '''
-    Get unique count of Study Accessions for 
-    these EFO IDs, Parent trait and all of it's children.
+    Load all Study Accessions or Association Ids of the EFO terms at once and
+    store in a lookup table keyed on the EFO Id with the value as the sorted
+    array of the Study Accession/Association codes.
     '''
 
-    in_vars = ','.join(':%d' % i for i in range(len(efos)))
-
-    unique_study_count_sql = """
-        SELECT COUNT(DISTINCT (S.ACCESSION_ID)) 
+    study_member_sql = """
+        SELECT ET.SHORT_FORM, S.ACCESSION_ID
         FROM STUDY S, EFO_TRAIT ET, STUDY_EFO_TRAIT SETR
         WHERE S.ID=SETR.STUDY_ID and SETR.EFO_TRAIT_ID=ET.ID
-            and ET.SHORT_FORM in ( {} )
-    """.format(in_vars)
-
+    """
 
-    unique_association_count_sql = """
-        SELECT COUNT(DISTINCT(A.ID))
+    association_member_sql = """
+        SELECT ET.SHORT_FORM, A.ID
         FROM ASSOCIATION_EFO_TRAIT AET, EFO_TRAIT ET, ASSOCIATION A
         WHERE AET.EFO_TRAIT_ID=ET.ID and AET.ASSOCIATION_ID=A.ID
-            and ET.SHORT_FORM in ( {} )
-    """.format(in_vars)
+    """
 
+    if member_type == 'study':
+        sql = study_member_sql
+    if member_type == 'association':
+        sql = association_member_sql
 
-    if count_type == 'study':
-        sql = unique_study_count_sql
-    if count_type == 'association':
-        sql = unique_association_count_sql
+    cursor.execute(sql)
+
+    # Accessions and Ids are replaced by integer codes
+    codes = {}
+    members = {}
+    for efo_id, member in cursor.fetchall():
+        # Not counted by COUNT(DISTINCT ...) either
+        if member is None:
+            continue
+        members.setdefault(efo_id, []).append(codes.setdefault(member, len(codes)))
 
+    return {efo_id: np.unique(np.array(member_codes, dtype=np.int64)) for efo_id, member_codes in members.items()}
+
+
+def __count_members(efos, efo_member_map):
+    '''
+    Get unique count of Study Accessions/Associations for these EFO IDs,
+    eg. Parent trait and all of it's children.
+    '''
 
-    cursor.execute(sql, efos)
-    count = cursor.fetchone()
+    member_codes = [efo_member_map[efo] for efo in efos if efo in efo_member_map]
+    if not member_codes:
+        return 0
 
-    return count[0]
+    return len(np.unique(np.concatenate(member_codes)))
 
 
 def __build_efo_associationCnt_map(efo_data, cursor):
@@ -252,61 +287,83 @@ def __build_efo_associationCnt_map(efo_data, cursor):
     Given a list of data from the "efo_sql" query, build a lookup table
     keyed on the EFO Id with the value as Association count.
     '''
-    efo_association = {}
 
     trait_association_cnt_sql = """
-        SELECT COUNT(A.ID)
+        SELECT ET.SHORT_FORM, COUNT(A.ID)
         FROM EFO_TRAIT ET, ASSOCIATION_EFO_TRAIT AET, ASSOCIATION A
         WHERE ET.ID=AET.EFO_TRAIT_ID AND AET.ASSOCIATION_ID=A.ID
-              AND ET.SHORT_FORM= :trait_id
+        GROUP BY ET.SHORT_FORM
     """
 
     # Get count of associations per trait
+    cursor.execute(trait_association_cnt_sql)
+    association_cnt = dict(cursor.fetchall())
+
+    # Traits without associations
+    efo_association = {}
     for row in efo_data:
         efo_id = row[4]
-
-        cursor.prepare(trait_association_cnt_sql)
-        r = cursor.execute(None, {'trait_id': efo_id})
-        trait_assoc_cnt = cursor.fetchone()
-
-        if not trait_assoc_cnt:
-            trait_assoc_cnt = 0
-            efo_association[efo_id] = trait_assoc_cnt
-        else:
-            efo_association[efo_id] = trait_assoc_cnt[0]
+        efo_association[efo_id] = association_cnt.get(efo_id, 0)
 
     return efo_association
 
 
-def __get_descendants(efo_data):
+def __get_descendants(efo_data, term_data=OLSData.OLSData, workers=1):
     '''
     For each EFO Id, get a list of all descendants and 
     store in a lookup table keyed on the EFO Id with the 
     value as the list of descendant EFO Ids (short_form).
+    The term data is fetched from OLS unless an EFOGraph.term_data is given.
+    The terms are looked up by the given number of threads.
     '''
 
     type = 'hierarchicalDescendants'
     efo_descendants = {}
 
-    for row in tqdm(efo_data, desc='Getting EFO term - hierarchicalDescendants mapping'):
-        ols_data = OLSData.OLSData(row[2])
+    def get_term_descendants(row):
+        ols_data = term_data(row[2])
         ols_term_data = ols_data.get_ols_term(type)
 
-        if not ols_term_data:
-            print("No OLS term data for the row:")
-            print(row)
-            continue
+        if ols_term_data and 'hierarchicalDescendants' in ols_term_data:
+            descendant_data = term_data(ols_term_data['hierarchicalDescendants'])
+            return ols_term_data, [descendant for descendant in descendant_data.get_hierarchicalDescendants()]
+        return ols_term_data, []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(get_term_descendants, efo_data)
 
-        if 'iri' in ols_term_data:
-            if 'hierarchicalDescendants' in ols_term_data:
-                descendant_data = OLSData.OLSData(ols_term_data['hierarchicalDescendants'])
-                descendant_terms = [descendant for descendant in descendant_data.get_hierarchicalDescendants()]
+        for row, (ols_term_data, descendant_terms) in tqdm(zip(efo_data, results), total=len(efo_data),
+                                                           desc='Getting EFO term - hierarchicalDescendants mapping'):
+            if not ols_term_data:
+                print("No OLS term data for the row:")
+                print(row)
+                continue
+
+            if 'iri' in ols_term_data:
+                # Empty list if the term has no descendants
                 efo_descendants[row[4]] = descendant_terms
-            else:
-                # add key and empty list to map
-                efo_descendants[row[4]] = []
 
     return efo_descendants
 
 
+def __get_ancestors(efo_data, term_data=OLSData.OLSData, workers=1):
+    '''
+    For each EFO URI, get the term information and the labels of the ancestors
+    (None if the term has no ancestors link). The terms are looked up by the given number of threads.
+    '''
+
+    type = 'ancestors'
+
+    def get_term_ancestors(row):
+        ols_term_data = term_data(row[2]).get_ols_term(type)
+
+        if ols_term_data['iri'] is not None and ols_term_data['ancestors'] is not None:
+            return ols_term_data, term_data(ols_term_data['ancestors']).get_ancestors()
+        return ols_term_data, None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(get_term_ancestors, efo_data)
+        efo_ancestors = {row[2]: result for row, result in tqdm(zip(efo_data, results), total=len(efo_data),
+                                                                desc='Getting EFO term - ancestors mapping')}
 
+    return efo_ancestors
@@ -5,7 +5,7 @@ from tqdm import tqdm
 
 def get_unpub_study_data(connection, limit=0):
     '''
-    Get unpublished study data for Solr document.
+    Get unpublished study data for Solr document. The documents are yielded one by one.
     '''
 
     # List of queries
@@ -16,8 +16,6 @@ def get_unpub_study_data(connection, limit=0):
         AND J.WORK_ID = B.ID
         """
 
-    all_unpub_study_data = []
-
     try:
         with contextlib.closing(connection.cursor()) as cursor:
             cursor.execute(unpub_study_sql)
@@ -35,12 +33,12 @@ def get_unpub_study_data(connection, limit=0):
                 unpub_study_document['description'] = study[2]
 
 
-                all_unpub_study_data.append(unpub_study_document)
-
-        return all_unpub_study_data
+                yield unpub_study_document
 
     except cx_Oracle.DatabaseError as e:
+        # The documents are streamed to the output file, which must not be completed with the documents extracted so far:
         print(e)
+        raise
 
 
 
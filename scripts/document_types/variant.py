@@ -1,10 +1,26 @@
-
+import collections
+import multiprocessing
+import multiprocessing.util
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
+from gwas_db_connect import DBConnection
 
-def get_variant_data(connection, limit=0, testRun = False):
+def get_variant_data(connection, limit=0, testRun = False, bulk = False, id_range = None, variant_cls = None):
     '''
     Get Variant data for Solr document.
+
+    If bulk is set, the variant data is extracted with a handful of whole-table
+    queries and the documents are assembled from merged tables, instead of
+    querying the database for every single variant.
+
+    If id_range is given as (first, last), only the variants with IDs in this
+    range are processed.
+
+    An already initialized variant_sqls object can be passed to reuse its gene
+    mapping table, its id_range is used then.
+
+    The documents are yielded one by one.
     '''
 
     # Special variant IDs that represent 
@@ -13,96 +29,202 @@ def get_variant_data(connection, limit=0, testRun = False):
         47195, # kgp ID
     ]
 
-    # function to retrieve further data from the database:
-    def get_more_variant_data(row):
+    # Step 1: initialize variant object:
+    if variant_cls is None:
+        variant_cls = variant_sqls(connection, id_range)
 
-        # Extracting basic variant information:
-        resourcename = 'variant'
-        ID = row['ID']
-        rsID = row['RS_ID']
-        consequence = str(row['FUNCTIONAL_CLASS']).replace("_", " ").capitalize() 
+    # Step 2: retrieve all the variants in the database:
+    variants_df = variant_cls.get_snps()
+
+    # Selecting variants for limited or test runs:
+    if limit != 0:
+        variants_df = variants_df[0:limit]
+    elif testRun:
+        variants_df = variants_df[variants_df['ID'].isin(testAssociationId)]
 
-        # Extracting association count:
-        association_count = variant_cls.get_association_count(ID)
+    # Adding the association and study counts. We don't care about variants that have no associations,
+    # so they are dropped here. The inner merge keeps the order of the variant table:
+    variants_df = variants_df.merge(variant_cls.get_snp_counts(), how = 'inner', left_on = 'ID', right_on = 'SNP_ID')
+    variants_df = variants_df.drop(columns = 'SNP_ID').reset_index(drop = True)
 
-        # Extracting study count:
-        study_count = variant_cls.get_study_count(ID)
+    # Step 3: Assemble all variant documents from whole-table extracts:
+    if bulk:
+        yield from get_bulk_variant_data(variant_cls, variants_df)
+        return
 
-        # We don't care about variants that have no associations:
-        if association_count == 0: 
-            return(1)
+    # Step 3: Looping through the variants to retrieve further data from the database:
+    for row in tqdm(variants_df.itertuples(index = False), total = len(variants_df), desc = "Returning variant data"):
 
         # Extracting genomic location:
-        location = variant_cls.get_variant_location(ID)
+        location = variant_cls.get_variant_location(row.ID)
 
         # Extracting mapped genes:
-        mapped_genes_list = variant_cls.get_mapped_genes(ID)
-        mapped_genes_names = [x.split("|")[0] for x in mapped_genes_list]
-        mapped_genes_names = list(set(mapped_genes_names)) # GOCI-2475 - unique set of names are generated.
+        mapped_genes_list = variant_cls.get_mapped_genes(row.ID)
 
         # Extracting merged rsID:
-        current_rsID = variant_cls.get_current_rsID(ID)
-
-        # Assign merged rsID and generate title:
-        title = ''
-        if current_rsID:
-            merged_rsID = rsID
-            title = "%s (%s)" %(current_rsID, merged_rsID)
-        else: 
-            current_rsID = rsID
-            merged_rsID = ''
-            title = current_rsID
-        
-        # Combining data into a dictionary:
-        varDoc = {
-            'resourcename' : resourcename,
-            'id' : "%s:%s" % (resourcename,ID),
-            'title' : title,
-            'rsID' : rsID,
-            'current_rsID' : current_rsID,
-            'merged_rsID' : merged_rsID,
-            'associationCount' : association_count,
-            'studyCount' : study_count,
-            'mappedGenes' : mapped_genes_list,
-            'consequence' : consequence,
-        }
-
-        # Adding only valid location indicated by integer position:
-        if isinstance(location['position'], int):
-            varDoc['chromosomeName'] = location['chromosome']
-            varDoc['chromosomePosition'] = location['position']
-            varDoc['region'] = location['region']
-
-        # Adding description to the document:
-        coordinates = '%s:%s' %(location['chromosome'], location['position'])
-        genes_str = ",".join(mapped_genes_names)
-        varDoc['description'] =  "|".join([coordinates, 
-            str(location['region']), consequence,genes_str])
-        
-        # Adding to document list:
-        all_variant_data.append(varDoc)
+        current_rsID = variant_cls.get_current_rsID(row.ID)
 
-    # Initialize empty list for the documents:
-    all_variant_data = []
+        yield build_variant_document(row.ID, row.RS_ID, row.FUNCTIONAL_CLASS,
+            row.ASSOCIATION_COUNT, row.STUDY_COUNT, location, mapped_genes_list, current_rsID)
 
-    # Step 1: initialize variant object:
-    variant_cls = variant_sqls(connection)
-
-    # Step 2: retrieve all the variants in the database:
-    variants_df = variant_cls.get_snps()
 
-    # Inintialize progress bar:
-    tqdm.pandas(desc="Returning variant data")
+def get_sharded_variant_data(connection, database, workers, limit=0, bulk = False, shard_size = 20000):
+    '''
+    Get Variant data for Solr document using multiple processes.
+
+    The variants are split into ID ranges (shards) of about shard_size variants.
+    Each worker process opens its own database connection and loads the gene mapping table
+    once, then processes shards one after the other. The documents are returned in the order
+    of the shards, so the output does not depend on the scheduling. At most two shards per
+    worker are submitted ahead, so only their documents are held in memory. Within a shard, the
+    documents follow the variant table, so the output is in the order of the variant IDs only at the
+    shard level. The limit selects the variants with the lowest IDs.
+
+    The worker processes are started with the spawn method and shut down with close/join,
+    so each one closes its own database connection on exit.
+    '''
 
-    # Step 3: Calling apply to retrieve all variant data:
+    # Getting the sorted list of variant IDs. Only the ID column is read, the associations are counted by the workers:
+    snp_ids = np.sort(pd.read_sql(variant_sqls.snp_id_sql, connection)['ID'].values)
     if limit != 0:
-        variants_df[0:limit].progress_apply(get_more_variant_data, axis = 1)
-    elif testRun:
-        variants_df[variants_df['ID'].isin(testAssociationId)].progress_apply(get_more_variant_data, axis = 1)
+        snp_ids = snp_ids[0:limit]
+
+    # Splitting variants into contiguous ID ranges. At least one shard per worker:
+    shard_count = max(workers, int(np.ceil(len(snp_ids) / float(shard_size))))
+    shards = [(bulk, (int(ids[0]), int(ids[-1])))
+              for ids in np.array_split(snp_ids, shard_count) if len(ids) > 0]
+
+    print("[Info] Generating variant documents for %s variants in %s shards using %s workers." % (len(snp_ids), len(shards), workers))
+
+    # Workers are spawned, so they don't inherit the open database connection of the parent process:
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(workers, initializer = _init_variant_worker, initargs = (database,))
+    try:
+        pending = collections.deque()
+        for shard in shards:
+            pending.append(pool.apply_async(_get_variant_shard, (shard,)))
+            if len(pending) > workers * 2:
+                yield from pending.popleft().get()
+
+        while pending:
+            yield from pending.popleft().get()
+    except BaseException:
+        pool.terminate()
+        raise
     else:
-        variants_df.progress_apply(get_more_variant_data, axis = 1)
+        # Workers exit normally, so their database connections are closed by the finalizers:
+        pool.close()
+    finally:
+        pool.join()
+
 
-    return all_variant_data
+# Database connection and variant object of a worker process, shared by all shards it processes:
+_worker_connection = None
+_worker_variant_cls = None
+
+
+def _init_variant_worker(database):
+    '''
+    Opens the database connection of a worker process and loads the gene mapping table.
+    '''
+    global _worker_connection, _worker_variant_cls
+
+    _worker_connection = DBConnection.gwasCatalogDbConnector(database)
+    multiprocessing.util.Finalize(None, _worker_connection.close, exitpriority = 10)
+    _worker_variant_cls = variant_sqls(_worker_connection.connection)
+
+
+def _get_variant_shard(shard):
+    '''
+    Generate the variant documents of one ID range in a worker process.
+    '''
+    bulk, id_range = shard
+
+    _worker_variant_cls.id_range = id_range
+    return list(get_variant_data(_worker_connection.connection, bulk = bulk, variant_cls = _worker_variant_cls))
+
+
+def get_bulk_variant_data(variant_cls, variants_df):
+    '''
+    Assemble variant documents from whole-table extracts.
+
+    The location, merged rsID and mapped gene tables are merged to the variant
+    table (already filtered to associated variants), so no query is issued per variant.
+    '''
+
+    print("[Info] Extracting variant data in bulk.")
+
+    # Genomic location. Missing locations are flagged by the merge indicator:
+    variants_df = variants_df.merge(variant_cls.get_variant_locations(), how = 'left',
+                                    left_on = 'ID', right_on = 'SNP_ID', indicator = True)
+    variants_df['HAS_LOCATION'] = variants_df['_merge'] == 'both'
+
+    # Current rsID of the merged variants:
+    variants_df = variants_df.drop(columns = ['SNP_ID', '_merge']).merge(variant_cls.get_current_rsIDs(), how = 'left',
+                                                                         left_on = 'ID', right_on = 'SNP_ID')
+    variants_df['CURRENT_RS_ID'] = variants_df['CURRENT_RS_ID'].fillna('')
+
+    # Mapped genes of all variants:
+    mapped_genes = variant_cls.get_all_mapped_genes()
+
+    for row in tqdm(variants_df.itertuples(index = False), total = len(variants_df), desc = "Returning variant data"):
+        location = {'chromosome' : 'NA', 'position' : 'NA', 'region' : 'NA'}
+        if row.HAS_LOCATION:
+            location = variant_cls.format_location(row.CHROMOSOME_NAME, row.CHROMOSOME_POSITION, row.NAME)
+
+        yield build_variant_document(row.ID, row.RS_ID, row.FUNCTIONAL_CLASS,
+            row.ASSOCIATION_COUNT, row.STUDY_COUNT, location, mapped_genes.get(row.ID, ['intergenic']), row.CURRENT_RS_ID)
+
+
+def build_variant_document(ID, rsID, functional_class, association_count, study_count,
+                           location, mapped_genes_list, current_rsID):
+    '''
+    Build a variant document from the extracted variant data.
+    '''
+
+    resourcename = 'variant'
+    consequence = str(functional_class).replace("_", " ").capitalize() 
+
+    mapped_genes_names = [x.split("|")[0] for x in mapped_genes_list]
+    mapped_genes_names = list(set(mapped_genes_names)) # GOCI-2475 - unique set of names are generated.
+
+    # Assign merged rsID and generate title:
+    title = ''
+    if current_rsID:
+        merged_rsID = rsID
+        title = "%s (%s)" %(current_rsID, merged_rsID)
+    else: 
+        current_rsID = rsID
+        merged_rsID = ''
+        title = current_rsID
+    
+    # Combining data into a dictionary:
+    varDoc = {
+        'resourcename' : resourcename,
+        'id' : "%s:%s" % (resourcename,ID),
+        'title' : title,
+        'rsID' : rsID,
+        'current_rsID' : current_rsID,
+        'merged_rsID' : merged_rsID,
+        'associationCount' : association_count,
+        'studyCount' : study_count,
+        'mappedGenes' : mapped_genes_list,
+        'consequence' : consequence,
+    }
+
+    # Adding only valid location indicated by integer position:
+    if isinstance(location['position'], int):
+        varDoc['chromosomeName'] = location['chromosome']
+        varDoc['chromosomePosition'] = location['position']
+        varDoc['region'] = location['region']
+
+    # Adding description to the document:
+    coordinates = '%s:%s' %(location['chromosome'], location['position'])
+    genes_str = ",".join(mapped_genes_names)
+    varDoc['description'] =  "|".join([coordinates, 
+        str(location['region']), consequence,genes_str])
+
+    return(varDoc)
 
 
 class variant_sqls(object):
@@ -111,9 +233,16 @@ class variant_sqls(object):
     '''
 
     ### The following class variables are stores the sql queries:
+    snp_id_sql = """
+        SELECT SNP.ID
+        FROM SINGLE_NUCLEOTIDE_POLYMORPHISM SNP
+    """
+
+    ### The whole-table queries have a placeholder for the ID range condition (see __read_sql):
     snp_sql = """
         SELECT SNP.ID, SNP.RS_ID, SNP.FUNCTIONAL_CLASS, 'variant' as resourcename
         FROM SINGLE_NUCLEOTIDE_POLYMORPHISM SNP
+        %s
     """
     snp_location_sql = """
         SELECT L.CHROMOSOME_NAME, L.CHROMOSOME_POSITION, R.NAME
@@ -139,18 +268,43 @@ class variant_sqls(object):
             AND GC.SOURCE = 'Ensembl'
     """
 
-    association_count_sql = """
-        SELECT asv.SNP_ID, COUNT(asv.ASSOCIATION_ID) AS count
-        FROM ASSOCIATION_SNP_VIEW asv
-        WHERE asv.SNP_ID = :snp_id
-        group by asv.SNP_ID
+    # Association and study counts of all associated variants:
+    snp_count_sql = """
+        SELECT ASV.SNP_ID, COUNT(ASV.ASSOCIATION_ID) AS ASSOCIATION_COUNT, COUNT(DISTINCT(A.STUDY_ID)) AS STUDY_COUNT
+        FROM ASSOCIATION_SNP_VIEW ASV
+        LEFT JOIN ASSOCIATION A ON ASV.ASSOCIATION_ID = A.ID
+        %s
+        GROUP BY ASV.SNP_ID
+        HAVING COUNT(ASV.ASSOCIATION_ID) > 0
     """
 
-    study_count_sql = """
-        SELECT COUNT(DISTINCT(A.STUDY_ID)) AS count
-        FROM ASSOCIATION_SNP_VIEW ASV, ASSOCIATION A
-        WHERE ASV.ASSOCIATION_ID = A.ID
-          AND ASV.SNP_ID = :snp_id
+    # Whole-table variants of the above queries for the bulk extraction (associated variants only):
+    all_snp_location_sql = """
+        SELECT SL.SNP_ID, L.CHROMOSOME_NAME, L.CHROMOSOME_POSITION, R.NAME
+        FROM LOCATION L, SNP_LOCATION SL, REGION R
+        WHERE L.ID = SL.LOCATION_ID and L.REGION_ID = R.ID
+            and length(l.CHROMOSOME_NAME) < 3
+            and EXISTS (SELECT 1 FROM ASSOCIATION_SNP_VIEW ASV WHERE ASV.SNP_ID = SL.SNP_ID)
+            %s
+    """
+
+    all_merged_snp_sql = """
+        SELECT SMS.SNP_ID_MERGED as SNP_ID, SNP.RS_ID as CURRENT_RS_ID
+        FROM SNP_MERGED_SNP SMS, SINGLE_NUCLEOTIDE_POLYMORPHISM SNP
+        WHERE SNP.ID = SMS.SNP_ID_CURRENT
+            AND EXISTS (SELECT 1 FROM ASSOCIATION_SNP_VIEW ASV WHERE ASV.SNP_ID = SMS.SNP_ID_MERGED)
+            %s
+    """
+
+    all_genomic_context_sql = """
+        SELECT GC.SNP_ID, G.GENE_NAME, GC.GENE_ID, GC.IS_DOWNSTREAM, GC.IS_UPSTREAM, GC.IS_INTERGENIC, GC.IS_CLOSEST_GENE, GC.DISTANCE
+        FROM GENOMIC_CONTEXT GC, GENE G, LOCATION L
+        WHERE G.ID = GC.GENE_ID 
+            AND L.ID = GC.LOCATION_ID 
+            AND length(L.CHROMOSOME_NAME) < 3
+            AND GC.SOURCE = 'Ensembl'
+            AND EXISTS (SELECT 1 FROM ASSOCIATION_SNP_VIEW ASV WHERE ASV.SNP_ID = GC.SNP_ID)
+            %s
     """
 
     ensembl_entr_ID_map_sql = """
@@ -165,25 +319,50 @@ class variant_sqls(object):
         ON ENS.GENE_NAME = ENTR.GENE_NAME
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, id_range = None):
         self.connection = connection
+        self.id_range = id_range
 
         # We extract the mapping table:
         gene_map_df = pd.read_sql(self.ensembl_entr_ID_map_sql, self.connection)
-        gene_map_df['GENE_NAME'] = gene_map_df['ENS_NAME']
-        gene_map_df['GENE_NAME'][pd.isnull(gene_map_df['ENS_NAME'])] = gene_map_df[pd.isnull(gene_map_df['ENS_NAME'])]['ENT_NAME']
-        self.gene_map_df = gene_map_df[['GENE_NAME', 'ENSEMBL_ID', 'ENTREZ_ID']]
+        gene_map_df['GENE_NAME'] = gene_map_df['ENS_NAME'].where(pd.notnull(gene_map_df['ENS_NAME']), gene_map_df['ENT_NAME'])
+        gene_map_df = gene_map_df[['GENE_NAME', 'ENSEMBL_ID', 'ENTREZ_ID']]
+        self.gene_map_df = gene_map_df.astype(object).where(pd.notnull(gene_map_df), None)
+
+        # The formatted labels (GENE|ENSG|ENTREZ) are precomputed for each gene name. The row
+        # position is kept, so the labels of a variant are returned in the mapping table order:
+        self.gene_labels = {}
+        for position, row in enumerate(self.gene_map_df.itertuples(index = False)):
+            self.gene_labels.setdefault(row.GENE_NAME, []).append((position, "|".join(filter(None, row))))
 
     def get_snps(self):
-        return pd.read_sql(self.snp_sql, self.connection)
+        return self.__read_sql(self.snp_sql, 'WHERE SNP.ID')
+
+    def __read_sql(self, sql, id_filter):
+        '''
+        Runs a whole-table query. If an ID range is set, the rows are restricted to the variants in the range:
+        the range condition on the ID column given in id_filter (with the preceding WHERE or AND, e.g. 'AND GC.SNP_ID')
+        is put in the placeholder of the query, so it is applied before the grouping and the joins.
+        '''
+        if self.id_range is None:
+            return pd.read_sql(sql % '', self.connection)
+
+        sql = sql % ("%s BETWEEN :id_first AND :id_last" % id_filter)
+        return pd.read_sql(sql, self.connection, params = {'id_first': self.id_range[0], 'id_last': self.id_range[1]})
 
     def get_variant_location(self, variant_id):
         location = {'chromosome' : 'NA', 'position' : 'NA', 'region' : 'NA'}
         location_df = pd.read_sql(self.snp_location_sql, self.connection, params = {'snp_id': variant_id})
         if len(location_df) > 0:
-            location['chromosome'] = location_df['CHROMOSOME_NAME'].tolist()[0]
-            location['position'] = location_df['CHROMOSOME_POSITION'].tolist()[0]
-            location['region'] = location_df['NAME'].tolist()[0]
+            location = self.format_location(location_df['CHROMOSOME_NAME'].tolist()[0],
+                                            location_df['CHROMOSOME_POSITION'].tolist()[0],
+                                            location_df['NAME'].tolist()[0])
+
+        return(location)
+
+    @staticmethod
+    def format_location(chromosome, position, region):
+        location = {'chromosome' : chromosome, 'position' : position, 'region' : region}
 
         try:
             location['position'] = int(location['position'])
@@ -192,19 +371,23 @@ class variant_sqls(object):
 
         return(location)
 
-    def get_study_count(self, variant_id):
-        study_count = 0
-        df = pd.read_sql(self.study_count_sql, self.connection, params = {'snp_id': variant_id})
-        if len(df) > 0:
-            study_count = df.COUNT.tolist()[0]
-        return(study_count)
+    def get_variant_locations(self):
+        '''
+        Returns the first location of every variant. Missing values are None as in the per variant query.
+        '''
+        df = self.__read_sql(self.all_snp_location_sql, 'AND SL.SNP_ID').drop_duplicates(subset = 'SNP_ID')
+        location_columns = ['CHROMOSOME_NAME', 'CHROMOSOME_POSITION', 'NAME']
+        df[location_columns] = df[location_columns].astype(object).where(pd.notnull(df[location_columns]), None)
+        return(df)
 
-    def get_association_count(self, variant_id):
-        assoc_count = 0
-        df = pd.read_sql(self.association_count_sql, self.connection, params = {'snp_id': variant_id})
-        if len(df) > 0:
-            assoc_count = df.COUNT.tolist()[0]
-        return(assoc_count)
+    def get_snp_counts(self):
+        '''
+        Returns the association and distinct study count of every associated variant.
+        '''
+        return self.__read_sql(self.snp_count_sql, 'WHERE ASV.SNP_ID')
+
+    def get_current_rsIDs(self):
+        return self.__read_sql(self.all_merged_snp_sql, 'AND SMS.SNP_ID_MERGED').drop_duplicates(subset = 'SNP_ID')
 
     def get_current_rsID(self, variant_id):
         currentrsID = ''
@@ -217,6 +400,41 @@ class variant_sqls(object):
 
         df = pd.read_sql(self.genomic_context_sql, self.connection, params = {'snp_id': variant_id})
 
+        # Return mapped genes:
+        return(self.__select_mapped_genes(df))
+
+    def get_all_mapped_genes(self):
+        '''
+        Returns the mapped genes of every variant with genomic context in a dictionary keyed by the variant ID.
+
+        The selection rules of the per variant extraction are applied on the whole genomic context table:
+        overlapping genes if there are any, otherwise the closest up- and downstream genes.
+        '''
+        df = self.__read_sql(self.all_genomic_context_sql, 'AND GC.SNP_ID')
+
+        # Overlapping genes in the order of appearance:
+        overlapping = df.loc[df.IS_INTERGENIC == 0, ['SNP_ID', 'GENE_NAME']].drop_duplicates()
+        overlapping = overlapping.groupby('SNP_ID', sort = False).GENE_NAME.agg(list)
+
+        # For variants without overlapping genes, the up- and downstream genes with the smallest distance are selected:
+        intergenic = df.loc[~df.SNP_ID.isin(overlapping.index)]
+        closest = []
+        for direction in ['IS_UPSTREAM', 'IS_DOWNSTREAM']:
+            flanking = intergenic.loc[intergenic[direction] == 1]
+            closest.append(flanking.loc[flanking.DISTANCE == flanking.groupby('SNP_ID').DISTANCE.transform('min'), ['SNP_ID', 'GENE_NAME']])
+        closest = pd.concat(closest).groupby('SNP_ID', sort = False).GENE_NAME.agg(lambda names: list(set(names)))
+
+        # Looking up the labels of the mapped genes:
+        mapped_genes = {snp_id : self.__get_gene_labels(names) for snp_id, names in pd.concat([overlapping, closest]).items()}
+
+        return(mapped_genes)
+
+    def __get_gene_labels(self, gene_names):
+        labels = sorted(label for name in gene_names for label in self.gene_labels.get(name, []))
+        return([label for position, label in labels])
+
+    def __select_mapped_genes(self, df):
+
         # Get a list overlapping genes:
         mappedGenes = []
         mappedGenes = df[df.IS_INTERGENIC == 0].GENE_NAME.unique().tolist()
@@ -231,8 +449,6 @@ class variant_sqls(object):
         if not mappedGenes: 
            mappedGenes.append('intergenic')
         else:
-            mappedGenes = self.gene_map_df.loc[self.gene_map_df.GENE_NAME.isin(mappedGenes)].apply(lambda row: "|".join(filter(None, row.tolist())), axis = 1).tolist()
+            mappedGenes = self.__get_gene_labels(mappedGenes)
 
-        # Return mapped genes:
         return(mappedGenes)
-
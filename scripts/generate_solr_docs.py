@@ -1,4 +1,5 @@
 import argparse
+import os
 import sys
 import json
 import numpy as np
@@ -14,10 +15,10 @@ from scripts.document_types import unpub_study
 
 
 def publication_data(connection, limit=0, test=False):
-    return publication.get_publication_data(connection, testRun = test)
+    return publication.get_publication_data(connection, testRun = test, bulk = BULK)
 
 def trait_data(connection, limit=0, test=False):
-    return trait.get_trait_data(connection)
+    return trait.get_trait_data(connection, efo_file=EFO_FILE)
 
 def study_data(connection, limit=0, test=False):
     return study.get_study_data(connection)
@@ -28,12 +29,13 @@ def unpub_study_data(connection, limit=0, test=False):
 def check_data(data, doctype):
     '''
     This function checks if all the required fields of the documents are present.
-    Input is the list with all the documents.
-    If any of the required field is missing from the document, it will be deleted.
+    Input is an iterable (list or generator) with all the documents. The valid documents
+    are yielded one by one, so the documents don't need to be held in memory.
+    If any of the required field is missing from the document, it will be skipped.
     '''
 
-    # Check if the submitted data is a dictionary:
-    if not isinstance(data, list):
+    # Check if the submitted data is an iterable of documents:
+    if data is None or isinstance(data, (dict, str)) or not hasattr(data, '__iter__'):
         
         # Report to standard output:
         print("[Error] An error occured while generating the %s documents: the submitted data is not a list, but a %s!" % (doctype, type(data)))
@@ -46,41 +48,76 @@ def check_data(data, doctype):
     # A minimal list of fields that need to be found in every documents:
     requireFields = ['id', 'title', 'description', 'resourcename']
 
-    for i, doc in reversed(list(enumerate(data))):
+    for doc in data:
         for field in requireFields:
             if not field in doc:
                 print("[Warning] %s is missing from document. Removing." % (field))
                 print('[Warning] The problematic document looks like this: ')
                 print(doc)
-
-                data.pop(i)
                 break
-
-    # Exit if there's no document left to save:
-    if len(data) == 0:
-        sys.exit('[Error] %s data could not be saved as no documents left. Exiting.' % doctype)
-
-    return(data)
+        else:
+            yield doc
 
 # def save_data(data, docfileSuffix, data_type=None):
-def save_data(data, targetDir, data_type=None):
+def save_data(data, targetDir, data_type=None, output_format='json'):
     '''
-    data: list of solr ducments as dictionaries
+    data: iterable of solr ducments as dictionaries
         dictionaries have to contain the resourcename key.
+    output_format: json - the documents are saved as a JSON array,
+        ndjson - one document per line (newline delimited JSON).
+
+    The documents are written one at a time, so memory use does not depend on the number of documents.
+    The file is written under a temporary name and only renamed once all documents are written.
+    If the generation of the documents fails, the temporary file is removed and the error is raised.
     '''
 
-    resourcename = data[0]['resourcename']
+    documents = iter(data)
+
+    # The first document is needed to name the output file:
+    first_document = next(documents, None)
+
+    # Exit if there's no document to save:
+    if first_document is None:
+        sys.exit('[Error] %s data could not be saved as no documents left. Exiting.' % data_type)
+
+    resourcename = first_document['resourcename']
+
+    if output_format == 'ndjson':
+        fileNameWithPath = '{}/{}_data.ndjson'.format(targetDir, resourcename)
+        opening, separator, closing = '', '\n', '\n'
+    else:
+        fileNameWithPath = '{}/{}_data.json'.format(targetDir, resourcename)
+        opening, separator, closing = '[', ', ', ']'
 
-    fileNameWithPath = '{}/{}_data.json'.format(targetDir, resourcename)
+    document_count = 0
+    try:
+        with open(fileNameWithPath + '.tmp', 'w') as outfile:
+            outfile.write(opening)
+            outfile.write(json.dumps(first_document, cls=NumpyEncoder))
+            document_count += 1
 
-    with open(fileNameWithPath, 'w') as outfile:
-        json.dump(data, outfile, cls=NumpyEncoder)
+            for document in documents:
+                outfile.write(separator)
+                outfile.write(json.dumps(document, cls=NumpyEncoder))
+                document_count += 1
+
+            outfile.write(closing)
+    except BaseException:
+        # An incomplete file is never renamed:
+        if os.path.exists(fileNameWithPath + '.tmp'):
+            os.remove(fileNameWithPath + '.tmp')
+        raise
+
+    os.replace(fileNameWithPath + '.tmp', fileNameWithPath)
+    print("[Info] %s %s documents saved to %s" % (document_count, resourcename, fileNameWithPath))
 
 def variant_data(connection, limit=0, test=False):
-    return variant.get_variant_data(connection, limit, testRun = test)
+    if WORKERS > 1:
+        return variant.get_sharded_variant_data(connection, DATABASE_NAME, WORKERS, limit, bulk = BULK)
+    return variant.get_variant_data(connection, limit, testRun = test, bulk = BULK)
 
 def gene_data(connection, limit=0, test=False):
-    return gene.get_gene_data(connection, RESTURL, limit, testRun = test)
+    return gene.get_gene_data(connection, RESTURL, limit, testRun = test, database = DATABASE_NAME)
 
 
 class NumpyEncoder(json.JSONEncoder):
@@ -115,9 +152,22 @@ def main():
                         action='store_true', default=False)
     parser.add_argument('--targetDir', help='Folder in which the output files will be saved.', type=str,
                         default='./data')
+    parser.add_argument('--bulk',
+                        help='Extract the data with whole-table queries instead of querying every document separately. (variant, publication)',
+                        action='store_true', default=False)
+    parser.add_argument('--format', default='json', choices=['json', 'ndjson'],
+                        help='Format of the output files: JSON array or newline delimited JSON (default: json).')
+    parser.add_argument('--efoFile', type=str, default=None,
+                        help='Local EFO release (efo.obo or efo.json) to use instead of OLS. (trait)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes generating the documents, each with its own database connection. (variant)')
 
     args = parser.parse_args()
 
+    # The test variants are selected from the whole variant table, which is not split into shards:
+    if args.test and args.workers > 1:
+        parser.error('--test cannot be used with --workers')
+
     targetDir = args.targetDir
 
     global DATABASE_NAME
@@ -129,6 +179,15 @@ def main():
     global RESTURL
     RESTURL = args.restURL
 
+    global BULK
+    BULK = args.bulk
+
+    global WORKERS
+    WORKERS = args.workers
+
+    global EFO_FILE
+    EFO_FILE = args.efoFile
+
     # Docfile suffix
     # now = datetime.datetime.now()
     # docfileSuffix = now.strftime("%Y.%m.%d-%H.%M")
@@ -155,7 +214,7 @@ def main():
         document_data = dispatcher[doc](db_object.connection, limit, test)
         document_data = check_data(document_data, doc)
         # save_data(document_data, docfileSuffix)
-        save_data(document_data, targetDir)
+        save_data(document_data, targetDir, data_type=doc, output_format=args.format)
 
     # Close database connection
     db_object.close()
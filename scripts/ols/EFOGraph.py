@@ -0,0 +1,235 @@
+import collections
+import gzip
+import json
+import re
+import time
+
+
+# Relations followed by OLS for the hierarchical descendants besides subclasses (part of):
+hierarchical_relations = ['part_of', 'BFO:0000050', 'http://purl.obolibrary.org/obo/BFO_0000050']
+
+# Namespaces of the OBO identifiers, the rest are OBO library terms:
+obo_namespaces = {
+    'EFO' : 'http://www.ebi.ac.uk/efo/',
+    'Orphanet' : 'http://www.orpha.net/ORDO/',
+}
+obo_default_namespace = 'http://purl.obolibrary.org/obo/'
+
+obo_quoted_pattern = re.compile(r'"((?:[^"\\]|\\.)*)"\s*(\S*)')
+
+
+class EFOGraph(object):
+    '''
+    In-memory copy of an EFO release read from a local file, to be used instead of OLS.
+
+    Supported formats: OBO (efo.obo) and OBO graphs JSON (efo.json), optionally gzipped.
+    Terms can be looked up by IRI or short form. The ancestors and descendants of each term
+    are computed once and kept.
+
+    The terms and their ancestors and descendants are the same as in OLS, but:
+    - the ancestors and descendants are listed in breadth-first order (the closest first),
+      while OLS lists the ancestors from the root,
+    - only the EXACT synonyms are kept (hasExactSynonym in OBO graphs JSON), as in the
+      "synonyms" field of the OLS term.
+
+        efo = EFOGraph('efo.obo')
+        ols_data = efo.term_data(iri)   # Same methods as OLSData
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.terms = {}
+        self.__short_forms = {}
+        self.__parents = {}
+        self.__children = {}
+        self.__ancestors = {}
+        self.__descendants = {}
+
+        start = time.time()
+        if re.search(r'\.json(\.gz)?$', filename):
+            self.__load_json()
+        else:
+            self.__load_obo()
+
+        print("[Info] %s EFO terms loaded from %s (%.1fs)" % (len(self.terms), filename, time.time() - start))
+
+    def __open(self):
+        if self.filename.endswith('.gz'):
+            return gzip.open(self.filename, 'rt', encoding='utf-8')
+        return open(self.filename, 'r', encoding='utf-8')
+
+    def __add_term(self, iri, label, synonyms, description):
+        short_form = re.split(r'[/#]', iri)[-1]
+        self.terms[iri] = {
+            'iri' : iri,
+            'label' : label,
+            'short_form' : short_form,
+            'synonyms' : synonyms if synonyms else None,
+            'description' : description if description else None
+        }
+        self.__short_forms[short_form] = iri
+
+    def __add_edge(self, child, parent, subclass):
+        '''
+        Subclass edges are used for the ancestors, part of relations for the descendants only.
+        '''
+        if subclass:
+            self.__parents.setdefault(child, []).append(parent)
+        self.__children.setdefault(parent, []).append(child)
+
+    def __load_obo(self):
+        namespaces = dict(obo_namespaces)
+        stanza = None
+        edges = []
+
+        def to_iri(ID):
+            if ID.startswith('http'):
+                return ID
+            prefix, _, local = ID.partition(':')
+            return namespaces.get(prefix, obo_default_namespace) + prefix + '_' + local
+
+        def close_stanza():
+            if stanza and stanza.get('id'):
+                iri = to_iri(stanza['id'])
+                self.__add_term(iri, stanza.get('name'), stanza['synonyms'], stanza['def'])
+                edges.extend([(iri, parent, subclass) for parent, subclass in stanza['parents']])
+
+        with self.__open() as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('['):
+                    close_stanza()
+                    stanza = {'synonyms' : [], 'def' : [], 'parents' : []} if line == '[Term]' else None
+                    continue
+
+                tag, _, value = line.partition(': ')
+                if stanza is None:
+                    # Header lines may define the namespace of the identifiers, eg. "idspace: EFO http://www.ebi.ac.uk/efo/"
+                    if tag == 'idspace':
+                        prefix, namespace = value.split()[:2]
+                        namespaces[prefix] = namespace
+                    continue
+
+                # Comments after "!" are dropped from the references:
+                if tag in ['id', 'name']:
+                    stanza[tag] = value
+                elif tag == 'is_a':
+                    stanza['parents'].append((to_iri(value.split(' ! ')[0].split()[0]), True))
+                elif tag == 'relationship':
+                    relation, target = value.split()[:2]
+                    if relation in hierarchical_relations:
+                        stanza['parents'].append((to_iri(target), False))
+                elif tag in ['synonym', 'def']:
+                    match = obo_quoted_pattern.match(value)
+                    if not match:
+                        continue
+                    text = match.group(1).replace('\\"', '"')
+                    if tag == 'def':
+                        stanza['def'].append(text)
+                    elif match.group(2) == 'EXACT':
+                        stanza['synonyms'].append(text)
+            close_stanza()
+
+        for child, parent, subclass in edges:
+            self.__add_edge(child, parent, subclass)
+
+    def __load_json(self):
+        with self.__open() as f:
+            data = json.load(f)
+
+        for graph in data['graphs']:
+            for node in graph.get('nodes', []):
+                if node.get('type', 'CLASS') != 'CLASS':
+                    continue
+                meta = node.get('meta', {})
+                synonyms = [synonym['val'] for synonym in meta.get('synonyms', []) if synonym.get('pred') == 'hasExactSynonym']
+                description = [meta['definition']['val']] if 'definition' in meta else []
+                self.__add_term(node['id'], node.get('lbl'), synonyms, description)
+
+            for edge in graph.get('edges', []):
+                if edge['pred'] == 'is_a':
+                    self.__add_edge(edge['sub'], edge['obj'], True)
+                elif edge['pred'] in hierarchical_relations:
+                    self.__add_edge(edge['sub'], edge['obj'], False)
+
+    def get_iri(self, term):
+        '''
+        Returns the IRI of a term given by IRI or short form, None if the term is not in the release.
+        '''
+        if term in self.terms:
+            return term
+        return self.__short_forms.get(term)
+
+    def get_ancestors(self, iri):
+        '''
+        Returns the IRIs of all superclasses of the term, the closest ones first.
+        '''
+        if iri not in self.__ancestors:
+            self.__ancestors[iri] = self.__closure(iri, self.__parents)
+        return self.__ancestors[iri]
+
+    def get_descendants(self, iri):
+        '''
+        Returns the IRIs of all subclasses and parts of the term, the closest ones first.
+        '''
+        if iri not in self.__descendants:
+            self.__descendants[iri] = self.__closure(iri, self.__children)
+        return self.__descendants[iri]
+
+    @staticmethod
+    def __closure(iri, edges):
+        '''
+        Breadth-first walk along the edges. Every term is visited once, so cycles
+        (eg. through part of relations) and deep hierarchies are handled.
+        '''
+        visited = {iri}
+        closure = []
+        queue = collections.deque([iri])
+        while queue:
+            for term in edges.get(queue.popleft(), []):
+                if term not in visited:
+                    visited.add(term)
+                    closure.append(term)
+                    queue.append(term)
+        return tuple(closure)
+
+    def get_children(self, iri):
+        return list(self.__children.get(iri, []))
+
+    def get_ancestor_labels(self, iri):
+        return [self.terms[ancestor]['label'] for ancestor in self.get_ancestors(iri) if ancestor in self.terms]
+
+    def get_descendant_short_forms(self, iri):
+        return [self.terms[descendant]['short_form'] for descendant in self.get_descendants(iri) if descendant in self.terms]
+
+    def term_data(self, iri):
+        return EFOTermData(self, iri)
+
+
+class EFOTermData(object):
+    '''
+    Drop-in replacement of OLSData backed by an EFOGraph. The ancestor and descendant "links"
+    of a term are the IRI of the term itself.
+    '''
+
+    def __init__(self, graph, term_iri):
+        self.graph = graph
+        self.term_iri = term_iri
+
+    def get_ols_term(self, type):
+        iri = self.graph.get_iri(self.term_iri)
+        if iri is None:
+            return {'iri': None, 'synonyms': None, 'short_form': None, 'label': None, 'description': None}
+
+        result_obj = dict(self.graph.terms[iri])
+        if type == 'ancestors':
+            result_obj['ancestors'] = iri if self.graph.get_ancestors(iri) else None
+        if type == 'hierarchicalDescendants' and self.graph.get_descendants(iri):
+            result_obj['hierarchicalDescendants'] = iri
+        return result_obj
+
+    def get_ancestors(self):
+        return self.graph.get_ancestor_labels(self.term_iri)
+
+    def get_hierarchicalDescendants(self, page=0):
+        return self.graph.get_descendant_short_forms(self.term_iri)
@@ -1,9 +1,99 @@
 import requests, json
 import urllib
+import threading
+import time
+import concurrent.futures
+from requests.adapters import HTTPAdapter
 
+from scripts.cache import DiskCache, LRUCache
 from scripts.constants import OLS4_BASE_URL, ONTOLOGY_PREFIX, TERMS_PREFIX
+from scripts.EnsemblREST.REST import backoff_delay
 from scripts.ols import DataFormatter
 
+
+# OLS responses shared by all OLSData objects: term resources, ancestor labels and descendant IDs of the terms.
+# Only successful responses are cached. See configure_cache.
+term_cache = LRUCache()
+
+# Responses worth retrying:
+retry_status_codes = [408, 429, 500, 502, 503, 504]
+
+
+def configure_session(max_in_flight=10, timeout=(10, 60), max_try=5):
+    '''
+    Sets up the session shared by all OLS requests, so connections are kept alive and reused:
+        * max_in_flight: number of requests sent to OLS at the same time, from any thread.
+        * timeout: connect and read timeout of each request in seconds.
+        * max_try: number of retries of failed requests (connection errors, timeouts and 5xx responses).
+    '''
+    global session, max_workers, request_timeout, max_retries, __in_flight
+
+    session = requests.Session()
+    session.headers.update({'Accept-Encoding' : 'gzip, deflate'})
+    adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    max_workers = max_in_flight
+    request_timeout = timeout
+    max_retries = max_try
+    __in_flight = threading.BoundedSemaphore(max_in_flight)
+
+configure_session()
+
+
+def fetch(URL):
+    '''
+    Sends a GET request to OLS through the shared session. Requests are retried with exponential backoff,
+    the last response is returned. Raises the connection error if all tries failed.
+    '''
+    for current_try in range(max_retries + 1):
+        try:
+            with __in_flight:
+                response = session.get(URL, timeout=request_timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if current_try == max_retries:
+                raise
+            print("[Warning] Request to %s failed: %s" % (URL, e))
+            time.sleep(backoff_delay(current_try))
+            continue
+
+        if response.status_code not in retry_status_codes or current_try == max_retries:
+            return response
+        time.sleep(backoff_delay(current_try))
+
+
+def get_efo_release():
+    '''
+    Returns the version of the EFO release loaded in OLS.
+    '''
+    response = fetch(f"{OLS4_BASE_URL}/{ONTOLOGY_PREFIX}")
+    response.raise_for_status()
+    ontology = json.loads(response.content)
+    return ontology.get('config', {}).get('version') or ontology.get('loaded')
+
+
+def configure_cache(cache_file=None, cache_size=100000):
+    '''
+    Sets up the shared OLS cache. At most cache_size responses are kept in memory, the least recently used
+    ones are dropped. With a cache file, responses are also saved on disk for the current EFO release,
+    so later runs on the same release don't fetch them again.
+    '''
+    global term_cache
+
+    backend = None
+    if cache_file:
+        try:
+            release = get_efo_release()
+            backend = DiskCache(cache_file, 'efo:%s' % release, max_entries=cache_size)
+            backend.remove_other_namespaces('efo:')
+            print("[Info] OLS responses are cached in %s for EFO release %s" % (cache_file, release))
+        except requests.exceptions.RequestException as e:
+            print("[Warning] EFO release could not be retrieved, OLS responses are not saved: %s" % e)
+
+    term_cache = LRUCache(maxsize=cache_size, backend=backend)
+
+
 class OLSData:
     def __init__(self, term_iri):
         self.term_iri = term_iri
@@ -22,12 +112,20 @@ class OLSData:
 
         no_results = {'iri': None, 'synonyms': None, 'short_form': None, 'label': None, 'description': None}
 
+        # The same term resource serves all types:
+        cache_key = 'term:' + term_iri
+        results = term_cache.get(cache_key)
+        if results:
+            data_formatter = DataFormatter.DataFormatter(results)
+            return (data_formatter.get_term_information(type))
+
         try:
-            response = requests.get(OLS_URL)
+            response = fetch(OLS_URL)
             if response.status_code == 200:
                 results = json.loads(response.content)
 
                 if results:
+                    term_cache.put(cache_key, results)
                     data_formatter = DataFormatter.DataFormatter(results)
                     return (data_formatter.get_term_information(type))
 
@@ -56,14 +154,21 @@ class OLSData:
 
         no_ancestor_results = []
 
+        cache_key = 'ancestors:' + OLS_ANCESTOR_URL
+        ancestor_labels = term_cache.get(cache_key)
+        if ancestor_labels is not None:
+            return ancestor_labels
+
         try:
-            response = requests.get(OLS_ANCESTOR_URL)
+            response = fetch(OLS_ANCESTOR_URL)
             if response.status_code == 200:
                 results = json.loads(response.content)
 
                 if results:
                     data_formatter = DataFormatter.DataFormatter(results)
-                    return (data_formatter.get_ancestor_labels())
+                    ancestor_labels = data_formatter.get_ancestor_labels()
+                    term_cache.put(cache_key, ancestor_labels)
+                    return ancestor_labels
 
                 else:
                     # print "** No data returned!!!"
@@ -88,27 +193,36 @@ class OLSData:
         OLS_DESCENDANT_URL = self.term_iri+"?size=1000&page={}".format(page)
 
         no_descendant_results = []
-        all_descendants = []
+
+        cache_key = 'descendants:' + OLS_DESCENDANT_URL
+        descendant_ids = term_cache.get(cache_key)
+        if descendant_ids is not None:
+            return descendant_ids
 
         try:
-            response = requests.get(OLS_DESCENDANT_URL)
+            response = fetch(OLS_DESCENDANT_URL)
             if response.status_code == 200:
                 results = json.loads(response.content)
 
                 if results:
                     data_formatter = DataFormatter.DataFormatter(results)
                     total_pages = data_formatter.get_pages()
-
-                    if total_pages == 1:
-                        return (data_formatter.get_hierarchicalDescendants_ids())
-                    else:
-                        while page < total_pages:                            
-                            efo_ids = OLSData.__get_pages(self, page)
-                            all_descendants.extend(efo_ids)
-
-                            page += 1
-
-                    return all_descendants
+                    descendant_ids = data_formatter.get_hierarchicalDescendants_ids() if total_pages else []
+
+                    # The rest of the pages are fetched in parallel, in the order of the pages:
+                    complete = True
+                    if total_pages > page + 1:
+                        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                            for efo_ids in executor.map(self.__get_pages, range(page + 1, total_pages)):
+                                if isinstance(efo_ids, list):
+                                    descendant_ids.extend(efo_ids)
+                                else:
+                                    complete = False
+
+                    # Only complete lists are cached:
+                    if complete:
+                        term_cache.put(cache_key, descendant_ids)
+                    return descendant_ids
                 else:
                     return no_descendant_results
             
@@ -129,7 +243,7 @@ class OLSData:
         OLS_DESCENDANT_URL = self.term_iri+"?size=1000&page={}".format(page)
 
         try:
-            response = requests.get(OLS_DESCENDANT_URL)
+            response = fetch(OLS_DESCENDANT_URL)
             if response.status_code == 200:
                 results = json.loads(response.content)
 
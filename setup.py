@@ -19,5 +19,7 @@ install_requires=['pandas>=0.23.4',
                   'numpy>=1.15.4',
                   'tqdm>=4.23.4',
                   'urllib3>=1.22'
-                 ]
+                 ],
+# The asyncio Ensembl REST client (scripts.EnsemblREST.AsyncREST) needs aiohttp:
+extras_require={'async': ['aiohttp>=3.7']}
 )
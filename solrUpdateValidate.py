@@ -27,6 +27,10 @@ class solr(object):
     def addDocument(self, documentFile):
         print("[Info] Adding {} to the solr core.".format(documentFile))
         URL = '{}/{}/update?commit=true'.format(self.base_url, self.core)
+
+        # Newline delimited documents are submitted to the json docs handler:
+        if documentFile.endswith('.ndjson'):
+            URL = '{}/{}/update/json/docs?commit=true'.format(self.base_url, self.core)
         content = self._submit(URL, data=open(documentFile, 'rb'))
         return (0)
 
@@ -72,7 +76,7 @@ class solr(object):
 
 def validateDocument(schema, documentFile):
     # Reading file into a dataframe
-    docDf = pd.read_json(documentFile)
+    docDf = pd.read_json(documentFile, lines=documentFile.endswith('.ndjson'))
 
     # Validate column headers
     schemaFieldNames = set(schema.name)
@@ -146,7 +150,7 @@ def main():
     # 4    True        True       authorAscii      NaN   True  text_general
 
     # Reading all files from a directory and validate fields:
-    for documentFile in glob.glob('{}/*.json'.format(documentFolder)):
+    for documentFile in glob.glob('{}/*.json'.format(documentFolder)) + glob.glob('{}/*.ndjson'.format(documentFolder)):
         valid = validateDocument(solrSchema, documentFile)
         if valid:
             solrObj.addDocument(documentFile)
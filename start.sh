@@ -26,13 +26,14 @@ function display_help(){
     echo "Wrapper for the generation of the slim solr documents."
     echo ""
     echo ""
-    echo "Usage: $0 -h -l <limit> -b <database> -t -d <dataDirectory>"
+    echo "Usage: $0 -h -l <limit> -b <database> -t -d <dataDirectory> -w <workers>"
     echo ""
     echo -e "\t-d - Data directory where the json files will be saved."
     echo -e "\t-l - limit the number of documents for testing."
     echo -e "\t-b - name of the database used."
     echo -e "\t-h - print help message."
     echo -e "\t-t - call a test run: run only for test cases"
+    echo -e "\t-w - number of processes (and cores, GB of memory requested) for the variant documents."
     echo ""
     echo ""
 
@@ -43,12 +44,13 @@ function display_help(){
 ## Parsing command line options:
 ## 
 OPTIND=1
-while getopts "htd:l:b:" opt; do
+while getopts "htd:l:b:w:" opt; do
     case "$opt" in
         "d" ) targetDir="${OPTARG}" ;;
         "l" ) limit="${OPTARG}" ;;
         "b" ) database="${OPTARG}" ;;
         "t" ) testRun=1;; 
+        "w" ) workers="${OPTARG}" ;;
         "h" ) display_help ;;
         * ) display_help ;;
     esac
@@ -67,7 +69,7 @@ else
     targetDir=$(readlink -f $targetDir)
     mkdir -p "${targetDir}/data"
     mkdir -p "${targetDir}/logs"
-    rm -f ${targetDir}/data/*.json
+    rm -f ${targetDir}/data/*.json ${targetDir}/data/*.ndjson ${targetDir}/data/*.tmp
     rm -f ${targetDir}/logs/*
 
     # Adding output folder to python dir:
@@ -103,24 +105,42 @@ source ${scriptDir}/config.sh
 ##
 declare -A jobIDs
 for document in ${docTypes[*]}; do 
+    # Variant documents can be generated by multiple processes, one core and 1G memory each (plus the main process):
+    cpus=1
+    memory=1G
+    DocumentCommand="${PythonCommand} --document ${document}"
+
+    # Variant and publication documents are assembled from whole-table extracts:
+    if [[ ${document} == "variant" || ${document} == "publication" ]]; then
+        DocumentCommand="${DocumentCommand} --bulk"
+    fi
+
+    if [[ ${document} == "variant" && ! -z "${workers}" ]]; then
+        cpus=${workers}
+        memory="$(( workers + 1 ))G"
+        DocumentCommand="${DocumentCommand} --workers ${workers}"
+    fi
+
     # Submit the job and capture the output
     # Construct the sbatch command as a string
-    sbatch_command="sbatch --mem=1G \
+    sbatch_command="sbatch --mem=${memory} \
                         --time=08:00:00 \
+                        --cpus-per-task=${cpus} \
                         --job-name=generate_${document} \
                         --output=${targetDir}/logs/generate_${document}.o \
                         --error=${targetDir}/logs/generate_${document}.e \
-                        --wrap='${PythonCommand} --document ${document}'"
+                        --wrap='${DocumentCommand}'"
 
     # Echo the command
     echo "Executing command: $sbatch_command"
 
-    output=$(sbatch --mem=1G \
+    output=$(sbatch --mem=${memory} \
                     --time=08:00:00 \
+                    --cpus-per-task=${cpus} \
                     --job-name=generate_${document} \
                     --output=${targetDir}/logs/generate_${document}.o \
                     --error=${targetDir}/logs/generate_${document}.e \
-                    --wrap="${PythonCommand} --document ${document}")
+                    --wrap="${DocumentCommand}")
     # Extract the job ID
     echo $output
     jobID=$(echo $output | perl -lane '($id) = $_ =~ /Submitted batch job (\d+)/; print $id' )
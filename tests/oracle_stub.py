@@ -0,0 +1,119 @@
+'''
+In-memory SQLite stand-in for the GWAS Catalog Oracle schema.
+
+The queries of the document modules are translated to SQLite on the fly, so the
+per row and the bulk extractions can be run on the same small tables:
+- LISTAGG(x, sep) WITHIN GROUP (ORDER BY y) is replaced by an aggregate that sorts by y,
+- TO_CHAR(x, format) returns x unchanged,
+- bind variable names are case insensitive as in Oracle,
+- column names are returned in upper case as by cx_Oracle,
+- cursor.prepare/cursor.execute(None, params) behave as in cx_Oracle.
+'''
+import re
+import sqlite3
+
+listagg_pattern = re.compile(r'listagg\s*\(\s*(?P<value>[^,]+?)\s*,\s*(?P<separator>\'[^\']*\')\s*\)\s*'
+                             r'WITHIN\s+GROUP\s*\(\s*ORDER\s+BY\s+(?P<order>[^)]+?)\s*\)', re.IGNORECASE)
+bind_pattern = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+
+class ListAgg(object):
+    '''
+    LISTAGG with an ORDER BY clause: sqlite cannot order the values within the group.
+    '''
+    def __init__(self):
+        self.values = []
+
+    def step(self, value, separator, order):
+        if value is not None:
+            self.values.append((order, str(value), separator))
+
+    def finalize(self):
+        if not self.values:
+            return None
+        separator = self.values[0][2]
+        return separator.join(value for order, value, separator in sorted(self.values, key = lambda x: (x[0] is None, x[0], x[1])))
+
+
+def translate(sql):
+    sql = listagg_pattern.sub(lambda m: 'LISTAGG_ORDERED(%s, %s, %s)' % (m.group('value'), m.group('separator'), m.group('order')), sql)
+    return bind_pattern.sub(lambda m: ':' + m.group(1).lower(), sql)
+
+
+def translate_params(params):
+    if isinstance(params, dict):
+        return {key.lower(): value for key, value in params.items()}
+    return params if params is not None else []
+
+
+class Cursor(object):
+    def __init__(self, cursor, connection):
+        self.__cursor = cursor
+        self.__connection = connection
+        self.__prepared = None
+
+    def prepare(self, sql):
+        self.__prepared = sql
+
+    def execute(self, sql, params = None, **kwargs):
+        if sql is None:
+            sql = self.__prepared
+        if kwargs:
+            params = kwargs
+        self.__connection.executed.append(sql)
+        self.__cursor.execute(translate(sql), translate_params(params))
+        return self
+
+    @property
+    def description(self):
+        if self.__cursor.description is None:
+            return None
+        return [(column[0].upper(),) + tuple(column[1:]) for column in self.__cursor.description]
+
+    def fetchone(self):
+        return self.__cursor.fetchone()
+
+    def fetchmany(self, size = 1):
+        return self.__cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.__cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.__cursor)
+
+    def close(self):
+        self.__cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Connection(object):
+    '''
+    Connection to an in-memory database with the given tables: {table name: pandas DataFrame}.
+    The executed statements are recorded in self.executed.
+    '''
+    def __init__(self, tables):
+        self.__connection = sqlite3.connect(':memory:')
+        self.__connection.create_function('TO_CHAR', 2, lambda value, format: value)
+        self.__connection.create_aggregate('LISTAGG_ORDERED', 3, ListAgg)
+        self.executed = []
+
+        for name, df in tables.items():
+            df.to_sql(name, self.__connection, index = False)
+
+    def cursor(self):
+        return Cursor(self.__connection.cursor(), self)
+
+    def commit(self):
+        self.__connection.commit()
+
+    def rollback(self):
+        self.__connection.rollback()
+
+    def close(self):
+        self.__connection.close()
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+from scripts.EnsemblREST import AsyncREST as async_rest
+from scripts.EnsemblREST.AsyncREST import AsyncREST
+from scripts.EnsemblREST.REST import RateLimiter
+
+
+class StubEnsembl(object):
+    '''
+    Local stand-in for the Ensembl REST server, recording the requests and their concurrency.
+    '''
+    def __init__(self, failures = 0):
+        self.failures = failures
+        self.posted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def lookup(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if self.failures > 0:
+                self.failures -= 1
+                return web.Response(status = 503)
+
+            IDs = (await request.json())['ids']
+            self.posted.append(IDs)
+            return web.json_response({ID : {'id' : ID} for ID in IDs if ID != 'ENSG_MISSING'})
+        finally:
+            self.in_flight -= 1
+
+    async def release(self, request):
+        return web.json_response({'releases' : [109, 110]})
+
+
+def run(stub, coroutine_function):
+    '''
+    Starts the stub server, then runs the coroutine function with a client connected to it.
+    '''
+    async def main():
+        app = web.Application()
+        app.router.add_post('/lookup/id', stub.lookup)
+        app.router.add_get('/info/data/', stub.release)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with AsyncREST('http://127.0.0.1:%s' % port, max_in_flight = 2,
+                                 rate_limiter = RateLimiter(rate = 1000, capacity = 1000)) as client:
+                return await coroutine_function(client)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+IDs = ['ENSG%05d' % i for i in range(2500)]
+
+
+def test_post_ID_merges_the_chunks():
+    stub = StubEnsembl()
+    results = run(stub, lambda client: client.postID(IDs + ['ENSG_MISSING']))
+
+    assert list(results) == IDs
+    assert sorted(len(chunk) for chunk in stub.posted) == [501, 1000, 1000]
+
+
+def test_in_flight_requests_are_bounded():
+    stub = StubEnsembl()
+    run(stub, lambda client: client.postID(IDs * 4))
+
+    assert len(stub.posted) == 10
+    assert stub.max_in_flight == 2
+
+
+def test_chunks_are_streamed():
+    async def collect(client):
+        return [response async for response in client.iter_postID(IDs)]
+
+    responses = run(StubEnsembl(), collect)
+
+    assert len(responses) == 3
+    assert sorted(ID for response in responses for ID in response) == IDs
+
+
+def test_failed_requests_are_retried(monkeypatch):
+    monkeypatch.setattr(async_rest, 'backoff_delay', lambda current_try: 0)
+    stub = StubEnsembl(failures = 2)
+
+    assert list(run(stub, lambda client: client.postID(IDs[:10]))) == IDs[:10]
+    assert stub.failures == 0
+
+
+def test_release():
+    assert run(StubEnsembl(), lambda client: client.getEnsemblRelease()) == 110
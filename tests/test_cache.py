@@ -0,0 +1,136 @@
+import time
+from unittest import mock
+
+from scripts import cache
+from scripts.cache import DiskCache, LRUCache
+
+
+def test_disk_cache_round_trip(tmp_path):
+    disk = DiskCache(str(tmp_path / 'cache.sqlite'), 'db:1')
+    disk.put_many({1 : ['ENSG01'], 2 : []})
+
+    assert disk.get_many([1, 2, 3]) == {1 : ['ENSG01'], 2 : []}
+    assert disk.get(3) is None
+    assert len(disk) == 2
+    disk.close()
+
+
+def test_disk_cache_survives_reopening(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    disk = DiskCache(filename, 'db:1')
+    disk.put('rs123', {'genes' : ['ENSG01']})
+    disk.close()
+
+    disk = DiskCache(filename, 'db:1')
+    assert disk.get('rs123') == {'genes' : ['ENSG01']}
+    disk.close()
+
+
+def test_disk_cache_namespaces_are_separate(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    old = DiskCache(filename, 'db:1')
+    new = DiskCache(filename, 'db:2')
+    old.put('key', 'old value')
+
+    assert new.get('key') is None
+    new.put('key', 'new value')
+    assert old.get('key') == 'old value'
+    assert new.get('key') == 'new value'
+
+    new.clear()
+    assert len(new) == 0
+    assert len(old) == 1
+
+
+def test_disk_cache_ttl_expiry(tmp_path):
+    with mock.patch.object(cache.time, 'time', return_value = 1000.0) as clock:
+        disk = DiskCache(str(tmp_path / 'cache.sqlite'), 'db:1', ttl = 60)
+        disk.put('key', 'value')
+
+        clock.return_value = 1059.0
+        assert disk.get('key') == 'value'
+
+        clock.return_value = 1061.0
+        assert disk.get('key') is None
+
+        # Expired entries are removed on the next write:
+        disk.put('other', 'value')
+        assert len(disk) == 1
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    with mock.patch.object(cache.time, 'time', return_value = 1000.0) as clock:
+        disk = DiskCache(str(tmp_path / 'cache.sqlite'), 'db:1', max_entries = 2)
+        disk.put('a', 1)
+        clock.return_value = 1001.0
+        disk.put('b', 2)
+
+        # Reading "a" makes "b" the least recently used entry:
+        clock.return_value = 1002.0
+        disk.get('a')
+        clock.return_value = 1003.0
+        disk.put('c', 3)
+
+    assert disk.get_many(['a', 'b', 'c']) == {'a' : 1, 'c' : 3}
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(maxsize = 2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    lru.get('a')
+    lru.put('c', 3)
+
+    assert 'a' in lru and 'c' in lru
+    assert 'b' not in lru
+    assert len(lru) == 2
+
+
+def test_lru_cache_counts_hits_and_misses():
+    lru = LRUCache(maxsize = 10)
+    lru.put_many({'a' : 1, 'b' : 2})
+
+    assert lru.get_many(['a', 'b', 'c']) == {'a' : 1, 'b' : 2}
+    assert lru.get('c', 'default') == 'default'
+
+    stats = lru.get_stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (2, 2, 2)
+    assert stats['hitRate'] == 0.5
+
+
+def test_lru_cache_falls_back_to_disk(tmp_path):
+    disk = DiskCache(str(tmp_path / 'cache.sqlite'), 'db:1')
+    LRUCache(maxsize = 10, backend = disk).put('a', [1, 2])
+
+    # A new in-memory cache finds the value on disk and keeps it in memory:
+    lru = LRUCache(maxsize = 10, backend = disk)
+    assert lru.get('a') == [1, 2]
+    assert 'a' in lru
+    assert lru.get_stats()['hits'] == 1
+
+
+def test_disk_cache_eviction_is_scoped_to_the_namespace(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    release = DiskCache(filename, 'release')
+    release.put('release', 110)
+
+    # Expiry and the size limit of a cache sharing the file leave the other namespace alone:
+    responses = DiskCache(filename, 'responses', ttl = 10, max_entries = 2)
+    with mock.patch.object(cache.time, 'time', return_value = time.time() + 100):
+        responses.put_many({'a' : 1, 'b' : 2, 'c' : 3})
+
+    assert len(responses) == 2
+    assert release.get('release') == 110
+
+
+def test_disk_cache_removes_outdated_namespaces(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    for namespace in ['db:1', 'db:2', 'other:1']:
+        DiskCache(filename, namespace).put('key', namespace)
+
+    current = DiskCache(filename, 'db:3')
+    current.put('key', 'db:3')
+    current.remove_other_namespaces('db:')
+
+    assert [DiskCache(filename, namespace).get('key') for namespace in ['db:1', 'db:2', 'db:3', 'other:1']] == \
+        [None, None, 'db:3', 'other:1']
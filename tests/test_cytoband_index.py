@@ -0,0 +1,53 @@
+import pandas as pd
+
+from scripts.cytoband_index import CytobandIndex
+
+
+def build_index(bands):
+    return CytobandIndex(pd.DataFrame(bands, columns = ['chromosome', 'start', 'end', 'id']))
+
+
+# Disjoint bands, as returned by Ensembl:
+cytobands = build_index([
+    ('1', 1, 100, '1p36.33'),
+    ('1', 101, 200, '1p36.32'),
+    ('X', 1, 500, 'Xp22.33'),
+])
+
+
+def test_region_within_a_band():
+    assert cytobands.lookup('1', 10, 20) == '1p36.33'
+    assert cytobands.lookup('X', 100, 200) == 'Xp22.33'
+
+
+def test_regions_at_band_boundaries():
+    regions = [
+        (1, 100),    # Exactly the first band
+        (100, 100),  # Last base of the first band
+        (101, 101),  # First base of the second band
+        (101, 200),  # Exactly the second band
+        (100, 101),  # Spanning both bands
+        (150, 201),  # Running past the last band
+    ]
+    starts, ends = zip(*regions)
+
+    assert cytobands.lookup_many(['1'] * len(regions), starts, ends) == [
+        '1p36.33', '1p36.33', '1p36.32', '1p36.32', '', '']
+
+
+def test_regions_before_the_first_band_and_on_unknown_chromosomes():
+    assert cytobands.lookup('1', 0, 10) == ''
+    assert cytobands.lookup('MT', 1, 10) == ''
+
+
+def test_invalid_coordinates_get_the_missing_value():
+    assert cytobands.lookup_many(['1', '1', '1'], [10, None, 'NA'], [20, 30, 40]) == ['1p36.33', '-', '-']
+
+
+def test_overlapping_bands_are_joined():
+    overlapping = build_index([
+        ('2', 1, 100, '2p25.3'),
+        ('2', 50, 150, '2p25.2'),
+    ])
+
+    assert overlapping.lookup_many(['2', '2', '2'], [10, 60, 60], [20, 90, 120]) == ['2p25.3', '2p25.3/2p25.2', '2p25.2']
@@ -0,0 +1,163 @@
+import gzip
+import json
+from urllib.parse import quote_plus
+
+import pytest
+
+from scripts.cache import LRUCache
+from scripts.constants import OLS4_BASE_URL
+from scripts.ols import OLSData
+from scripts.ols.EFOGraph import EFOGraph
+
+from tests.test_ols_data import StubSession
+
+
+EFO = 'http://www.ebi.ac.uk/efo/EFO_'
+OBO = 'http://purl.obolibrary.org/obo/'
+
+# disease <- cancer <- lung cancer, with lung cancer also part of a lung disease:
+obo_content = '''format-version: 1.2
+ontology: efo
+
+[Term]
+id: EFO:0000408
+name: disease
+def: "A disposition to undergo pathological processes." []
+
+[Term]
+id: EFO:0000311
+name: cancer
+synonym: "malignant neoplasm" EXACT []
+synonym: "tumour" RELATED []
+is_a: EFO:0000408 ! disease
+
+[Term]
+id: EFO:0001071
+name: lung cancer
+is_a: EFO:0000311 ! cancer
+relationship: part_of MONDO:0005275 ! lung disease
+
+[Term]
+id: MONDO:0005275
+name: lung disease
+is_a: EFO:0000408 ! disease
+
+[Typedef]
+id: part_of
+name: part of
+'''
+
+json_content = {'graphs' : [{
+    'nodes' : [
+        {'id' : EFO + '0000408', 'lbl' : 'disease', 'type' : 'CLASS',
+         'meta' : {'definition' : {'val' : 'A disposition to undergo pathological processes.'}}},
+        {'id' : EFO + '0000311', 'lbl' : 'cancer', 'type' : 'CLASS',
+         'meta' : {'synonyms' : [{'pred' : 'hasExactSynonym', 'val' : 'malignant neoplasm'},
+                                 {'pred' : 'hasRelatedSynonym', 'val' : 'tumour'}]}},
+        {'id' : EFO + '0001071', 'lbl' : 'lung cancer', 'type' : 'CLASS'},
+        {'id' : OBO + 'MONDO_0005275', 'lbl' : 'lung disease', 'type' : 'CLASS'},
+        {'id' : OBO + 'BFO_0000050', 'lbl' : 'part of', 'type' : 'PROPERTY'},
+    ],
+    'edges' : [
+        {'sub' : EFO + '0000311', 'pred' : 'is_a', 'obj' : EFO + '0000408'},
+        {'sub' : EFO + '0001071', 'pred' : 'is_a', 'obj' : EFO + '0000311'},
+        {'sub' : EFO + '0001071', 'pred' : OBO + 'BFO_0000050', 'obj' : OBO + 'MONDO_0005275'},
+        {'sub' : OBO + 'MONDO_0005275', 'pred' : 'is_a', 'obj' : EFO + '0000408'},
+    ]
+}]}
+
+
+@pytest.fixture(params = ['efo.obo', 'efo.obo.gz', 'efo.json', 'efo.json.gz'])
+def efo(request, tmp_path):
+    filename = str(tmp_path / request.param)
+    content = obo_content if '.obo' in filename else json.dumps(json_content)
+    with (gzip.open(filename, 'wt') if filename.endswith('.gz') else open(filename, 'w')) as f:
+        f.write(content)
+    return EFOGraph(filename)
+
+
+def test_terms_are_parsed(efo):
+    assert set(efo.terms) == {EFO + '0000408', EFO + '0000311', EFO + '0001071', OBO + 'MONDO_0005275'}
+    assert efo.terms[EFO + '0000311'] == {
+        'iri' : EFO + '0000311',
+        'label' : 'cancer',
+        'short_form' : 'EFO_0000311',
+        'synonyms' : ['malignant neoplasm'],
+        'description' : None,
+    }
+    assert efo.terms[EFO + '0000408']['description'] == ['A disposition to undergo pathological processes.']
+
+
+def test_terms_are_found_by_short_form(efo):
+    assert efo.get_iri('EFO_0001071') == EFO + '0001071'
+    assert efo.get_iri(EFO + '0001071') == EFO + '0001071'
+    assert efo.get_iri('EFO_9999999') is None
+
+
+def test_ancestors_follow_subclasses_only(efo):
+    assert efo.get_ancestors(EFO + '0001071') == (EFO + '0000311', EFO + '0000408')
+    assert efo.get_ancestor_labels(EFO + '0001071') == ['cancer', 'disease']
+    assert efo.get_ancestors(EFO + '0000408') == ()
+
+
+def test_descendants_follow_subclasses_and_parts(efo):
+    assert efo.get_descendants(OBO + 'MONDO_0005275') == (EFO + '0001071',)
+    assert sorted(efo.get_descendant_short_forms(EFO + '0000408')) == ['EFO_0000311', 'EFO_0001071', 'MONDO_0005275']
+    assert efo.get_descendants(EFO + '0001071') == ()
+
+
+def test_closure_handles_cycles(tmp_path):
+    filename = str(tmp_path / 'cycle.obo')
+    with open(filename, 'w') as f:
+        f.write('[Term]\nid: EFO:1\nname: a\nis_a: EFO:2\n\n[Term]\nid: EFO:2\nname: b\nis_a: EFO:1\n')
+    efo = EFOGraph(filename)
+
+    assert efo.get_ancestors(EFO + '1') == (EFO + '2',)
+    assert efo.get_descendants(EFO + '1') == (EFO + '2',)
+
+
+def test_term_data_replaces_ols_data(efo):
+    # The terms are looked up like in OLS: by the mapped term, then by the returned links:
+    term = efo.term_data('EFO_0001071').get_ols_term('ancestors')
+    assert term['label'] == 'lung cancer'
+    assert efo.term_data(term['ancestors']).get_ancestors() == ['cancer', 'disease']
+
+    term = efo.term_data(EFO + '0000311').get_ols_term('hierarchicalDescendants')
+    assert efo.term_data(term['hierarchicalDescendants']).get_hierarchicalDescendants() == ['EFO_0001071']
+
+    assert 'hierarchicalDescendants' not in efo.term_data(EFO + '0001071').get_ols_term('hierarchicalDescendants')
+    assert efo.term_data('EFO_9999999').get_ols_term('ancestors')['iri'] is None
+
+
+def test_term_data_matches_ols_data(efo, monkeypatch):
+    # The OLS responses for the same release. OLS lists the ancestors root first and keeps
+    # the exact synonyms only (the "synonyms" field of the term resource):
+    term_URL = '%s/efo/terms/%s' % (OLS4_BASE_URL, quote_plus(quote_plus(EFO + '0000311')))
+    ancestors_URL, descendants_URL = term_URL + '/ancestors', term_URL + '/hierarchicalDescendants'
+    responses = {
+        term_URL : (200, {'iri' : EFO + '0000311', 'label' : 'cancer', 'short_form' : 'EFO_0000311',
+                          'synonyms' : ['malignant neoplasm'], 'description' : None,
+                          '_links' : {'ancestors' : {'href' : ancestors_URL},
+                                      'hierarchicalDescendants' : {'href' : descendants_URL}}}),
+        ancestors_URL : (200, {'_embedded' : {'terms' : [{'label' : 'disease'}]}}),
+        descendants_URL + '?size=1000&page=0' : (200, {'page' : {'totalPages' : 1},
+                                                       '_embedded' : {'terms' : [{'short_form' : 'EFO_0001071'}]}}),
+        term_URL + '/lung_cancer/ancestors' : (200, {'_embedded' : {'terms' : [{'label' : 'disease'}, {'label' : 'cancer'}]}}),
+    }
+    monkeypatch.setattr(OLSData, 'session', StubSession(responses))
+    monkeypatch.setattr(OLSData, 'term_cache', LRUCache())
+
+    ols_term = OLSData.OLSData(EFO + '0000311').get_ols_term('hierarchicalDescendants')
+    graph_term = efo.term_data(EFO + '0000311').get_ols_term('hierarchicalDescendants')
+    assert {key : graph_term[key] for key in ['iri', 'label', 'short_form', 'synonyms', 'description']} == \
+        {key : ols_term[key] for key in ['iri', 'label', 'short_form', 'synonyms', 'description']}
+
+    assert efo.term_data(graph_term['hierarchicalDescendants']).get_hierarchicalDescendants() == \
+        OLSData.OLSData(ols_term['hierarchicalDescendants']).get_hierarchicalDescendants()
+    assert efo.term_data(EFO + '0000311').get_ancestors() == OLSData.OLSData(ancestors_URL).get_ancestors()
+
+    # The same ancestors, the closest first:
+    graph_ancestors = efo.term_data(EFO + '0001071').get_ancestors()
+    ols_ancestors = OLSData.OLSData(term_URL + '/lung_cancer/ancestors').get_ancestors()
+    assert graph_ancestors == ['cancer', 'disease']
+    assert sorted(graph_ancestors) == sorted(ols_ancestors)
@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts.cache import LRUCache
+from scripts.document_types import gene
+
+from tests.oracle_stub import Connection
+
+# The stub connection is not an SQLAlchemy connectable, just like cx_Oracle's:
+pytestmark = pytest.mark.filterwarnings('ignore:pandas only supports SQLAlchemy')
+
+
+def gene_tables():
+    '''
+    Associations of overlapping, intergenic and unmapped variants. Variant 1 has a duplicated and
+    a non-Ensembl genomic context row, variant 2 is only flanked by genes, variant 3 has no genes.
+    '''
+    return {
+        'ASSOCIATION': pd.DataFrame({'ID': [1, 2, 3, 4], 'STUDY_ID': [10, 10, 11, 12]}),
+        'ASSOCIATION_SNP_VIEW': pd.DataFrame({'ASSOCIATION_ID': [1, 1, 2, 3, 4, 4], 'SNP_ID': [1, 2, 2, 3, 4, 1]}),
+        'SINGLE_NUCLEOTIDE_POLYMORPHISM': pd.DataFrame({'ID': [1, 2, 3, 4, 5], 'RS_ID': ['rs1', 'rs2', 'rs3', 'rs4', 'rs5']}),
+        'GENOMIC_CONTEXT': pd.DataFrame(
+            [(1, 1, 1, 0, 'Ensembl'),
+             (1, 1, 1, 0, 'Ensembl'),
+             (1, 2, 1, 1, 'Ensembl'),
+             (1, 4, 0, 0, 'NCBI'),
+             (2, 2, 1, 1, 'Ensembl'),
+             (2, 3, 1, 1, 'Ensembl'),
+             (2, 4, 0, 1, 'Ensembl'),
+             (4, 3, 1, 0, 'Ensembl'),
+             (5, 1, 1, 0, 'Ensembl')],
+            columns = ['SNP_ID', 'GENE_ID', 'IS_CLOSEST_GENE', 'IS_INTERGENIC', 'SOURCE']),
+        'GENE_ENSEMBL_GENE': pd.DataFrame({'GENE_ID': [1, 2, 3, 3, 4], 'ENSEMBL_GENE_ID': [1, 2, 3, 5, 4]}),
+        'ENSEMBL_GENE': pd.DataFrame({'ID': [1, 2, 3, 4, 5], 'ENSEMBL_GENE_ID': ['ENSG01', 'ENSG02', 'ENSG03', 'ENSG04', 'ENSG05']}),
+        'USER_TABLES': pd.DataFrame({
+            'TABLE_NAME': ['ENSEMBL_GENE', 'GENE_ENSEMBL_GENE', 'GENOMIC_CONTEXT', 'GENE'],
+            'NUM_ROWS': [5, 5, 9, 4],
+            'LAST_ANALYZED': ['20240101000000'] * 4,
+        }),
+        'USER_TAB_MODIFICATIONS': pd.DataFrame({
+            'TABLE_NAME': ['GENOMIC_CONTEXT'], 'PARTITION_NAME': [None],
+            'INSERTS': [0], 'UPDATES': [0], 'DELETES': [0], 'TRUNCATED': ['NO'],
+        }),
+    }
+
+
+@pytest.fixture
+def connection():
+    connection = Connection(gene_tables())
+    yield connection
+    connection.close()
+
+
+def per_association_results(connection):
+    '''
+    The gene mapping as extracted association by association and variant by variant
+    (the queries and rules of the original implementation), with the IDs as sorted lists.
+    '''
+    sql_get_rsIDs = '''
+        SELECT SNP.RS_ID, SNP.ID as SNP_ID
+        FROM ASSOCIATION_SNP_VIEW ASV,
+            SINGLE_NUCLEOTIDE_POLYMORPHISM SNP
+        WHERE ASV.ASSOCIATION_ID = :assoc_id
+          AND ASV.SNP_ID = SNP.ID
+    '''
+    sql_get_genes = '''
+        SELECT GCont.*, EG.ENSEMBL_GENE_ID
+        FROM GENE_ENSEMBL_GENE GEG,
+          ENSEMBL_GENE EG,
+          (SELECT GC.SNP_ID, GC.GENE_ID, GC.IS_CLOSEST_GENE, GC.IS_INTERGENIC
+              FROM GENOMIC_CONTEXT GC
+              WHERE GC.SNP_ID = :snp_ID
+              AND GC.SOURCE = 'Ensembl'
+              AND (
+              GC.IS_INTERGENIC = 0
+              OR GC.IS_CLOSEST_GENE = 1
+              )
+          ) GCont
+        WHERE GCont.GENE_ID = GEG.GENE_ID
+          AND GEG.ENSEMBL_GENE_ID = EG.ID
+    '''
+
+    genes = {}
+    for association in pd.read_sql('SELECT A.ID as ASSOCIATION_ID, A.STUDY_ID FROM ASSOCIATION A', connection).itertuples():
+        for variant in pd.read_sql(sql_get_rsIDs, connection, params = {'assoc_id': association.ASSOCIATION_ID}).itertuples():
+            context = pd.read_sql(sql_get_genes, connection, params = {'snp_ID': variant.SNP_ID}).drop_duplicates()
+            if context.IS_INTERGENIC.isin([0]).any():
+                mapped_genes = context.loc[context.IS_INTERGENIC == 0, 'ENSEMBL_GENE_ID'].tolist()
+            else:
+                mapped_genes = context.loc[context.IS_CLOSEST_GENE == 1, 'ENSEMBL_GENE_ID'].tolist()
+
+            for EnsemblID in mapped_genes:
+                record = genes.setdefault(EnsemblID, {'rsIDs': set(), 'studyID': set(), 'assocID': set()})
+                record['rsIDs'].add(variant.RS_ID)
+                record['studyID'].add(str(association.STUDY_ID))
+                record['assocID'].add(str(association.ASSOCIATION_ID))
+
+    return {EnsemblID: {'rsIDs': sorted(record['rsIDs']), 'studyID': sorted(record['studyID']),
+                        'assocID': sorted(record['assocID']), 'associationCount': len(record['assocID']),
+                        'studyCount': len(record['studyID'])}
+            for EnsemblID, record in genes.items()}
+
+
+def sorted_results(results):
+    return {EnsemblID: dict(record, rsIDs = sorted(record['rsIDs']), studyID = sorted(record['studyID']),
+                            assocID = sorted(record['assocID']))
+            for EnsemblID, record in results.items()}
+
+
+def test_mapped_genes_match_per_association_extraction(connection):
+    results = gene.gene_sql(connection).get_results()
+
+    assert sorted_results(results) == per_association_results(connection)
+    assert sorted(results) == ['ENSG01', 'ENSG02', 'ENSG03', 'ENSG05']
+    assert results['ENSG01']['assocID'] == ['1', '4']
+
+
+def test_test_run_selects_the_associations_of_the_test_variants(connection, monkeypatch):
+    monkeypatch.setattr(gene.gene_sql, 'testRsIds', ['rs2'])
+
+    results = gene.gene_sql(connection, testRun = True).get_results()
+
+    # Associations 1 and 2 have rs2, all their variants are mapped:
+    assert sorted(results) == ['ENSG01', 'ENSG02', 'ENSG03', 'ENSG05']
+    assert results['ENSG01'] == {'rsIDs': ['rs1'], 'studyID': ['10'], 'assocID': ['1'], 'associationCount': 1, 'studyCount': 1}
+    assert results['ENSG02']['assocID'] == ['1', '2']
+
+
+def genomic_context_queries(connection):
+    return [sql for sql in connection.executed if 'FROM GENOMIC_CONTEXT GC' in sql]
+
+
+def test_cached_mapped_genes_are_reused(connection, tmp_path):
+    cache_file = str(tmp_path / 'genes.sqlite')
+    expected = per_association_results(connection)
+
+    del connection.executed[:]
+    first = gene.gene_sql(connection, database = 'TEST', cache_file = cache_file).get_results()
+    assert len(genomic_context_queries(connection)) == 1
+
+    del connection.executed[:]
+    geneSQL = gene.gene_sql(connection, database = 'TEST', cache_file = cache_file)
+    second = geneSQL.get_results()
+    assert genomic_context_queries(connection) == []
+    assert isinstance(geneSQL.snp_gene_cache, LRUCache)
+    assert geneSQL.snp_gene_cache.get_stats()['hits'] == 4
+
+    assert sorted_results(first) == sorted_results(second) == expected
+
+
+def test_modified_tables_invalidate_the_cache(connection, tmp_path):
+    cache_file = str(tmp_path / 'genes.sqlite')
+    gene.gene_sql(connection, database = 'TEST', cache_file = cache_file)
+
+    # Table monitoring records a change of the genomic context:
+    connection.cursor().execute("UPDATE USER_TAB_MODIFICATIONS SET INSERTS = 1 WHERE TABLE_NAME = 'GENOMIC_CONTEXT'")
+
+    del connection.executed[:]
+    gene.gene_sql(connection, database = 'TEST', cache_file = cache_file)
+    assert len(genomic_context_queries(connection)) == 1
+
+
+def test_no_cache_without_table_stamps(connection, tmp_path):
+    cache_file = str(tmp_path / 'genes.sqlite')
+    connection.cursor().execute("DELETE FROM USER_TABLES WHERE TABLE_NAME = 'ENSEMBL_GENE'")
+
+    geneSQL = gene.gene_sql(connection, database = 'TEST', cache_file = cache_file)
+    assert geneSQL.snp_gene_cache is None
+    assert sorted_results(geneSQL.get_results()) == per_association_results(connection)
+
+
+def test_missing_variants_are_looked_up_in_chunks(connection, tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'genes.sqlite')
+    monkeypatch.setattr(gene.gene_sql, 'snp_chunk_size', 1)
+
+    # Most variants are missing from the empty cache, so the whole genomic context is read once:
+    del connection.executed[:]
+    gene.gene_sql(connection, database = 'TEST', cache_file = cache_file)
+    assert genomic_context_queries(connection) == [gene.gene_sql.sql_snp_genes % '']
+
+    # A new association of an uncached variant: only this variant is looked up:
+    connection.cursor().execute("INSERT INTO ASSOCIATION_SNP_VIEW VALUES (4, 5)")
+
+    del connection.executed[:]
+    results = gene.gene_sql(connection, database = 'TEST', cache_file = cache_file).get_results()
+    assert len(genomic_context_queries(connection)) == 1
+    assert 'IN (:0)' in genomic_context_queries(connection)[0]
+    assert sorted_results(results) == per_association_results(connection)
+
+
+def test_gene_records_keep_interned_sorted_codes(connection):
+    geneSQL = gene.gene_sql(connection)
+
+    # Every distinct ID is stored once:
+    assert sorted(geneSQL.rsIDs.tolist()) == ['rs1', 'rs2', 'rs4']
+    assert len(set(geneSQL.assocIDs.tolist())) == len(geneSQL.assocIDs)
+
+    for record in geneSQL.gene_container.values():
+        for codes in [record.rsIDs, record.studyIDs, record.assocIDs]:
+            assert codes.dtype == np.int32
+            assert codes.tolist() == sorted(set(codes.tolist()))
+
+
+def test_null_IDs_are_dropped(connection):
+    connection.cursor().execute("INSERT INTO ASSOCIATION VALUES (5, NULL)")
+    connection.cursor().execute("INSERT INTO ASSOCIATION_SNP_VIEW VALUES (5, 4)")
+
+    results = gene.gene_sql(connection).get_results()
+
+    # The association is kept, its missing study is not counted:
+    assert sorted(results['ENSG03']['assocID']) == ['1', '2', '4', '5']
+    assert sorted(results['ENSG03']['studyID']) == ['10', '12']
+    assert results['ENSG03']['studyCount'] == 2
@@ -0,0 +1,323 @@
+import gzip
+import hashlib
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from scripts.document_types import gene_annotator
+from scripts.document_types.gene_annotator import GeneAnnotator
+
+
+class StubREST(object):
+    '''
+    Stands in for the Ensembl REST handler: returns a fixed release and the annotation of the missing genes.
+    '''
+    def __init__(self, URL, **options):
+        self.URL = URL
+        self.cache_file = 'responses.sqlite'
+        self.posted = []
+
+    def getEnsemblRelease(self):
+        return 110
+
+    def postID(self, IDs):
+        self.posted.extend(IDs)
+        return {'ENSG00000000005' : {'seq_region_name' : '2', 'start' : 1500, 'end' : 1600, 'biotype' : 'lncRNA',
+                                     'display_name' : 'GENE5'}}
+
+    def get_connection_stats(self):
+        return {'requests' : 0, 'connections' : 0, 'reused' : 0}
+
+    def get_cache_stats(self):
+        return {'hits' : 0, 'misses' : 0}
+
+
+def ensembl_table():
+    df = pd.DataFrame({
+        'seq_region_name' : ['1', '1', 'KI270728.1'],
+        'start' : [100, 1200, 10],
+        'end' : [200, 1300, 20],
+        'id' : ['ENSG00000000001', 'ENSG00000000002', 'ENSG00000000003'],
+        'display_name' : ['GENE1', 'GENE2', 'GENE3'],
+        'biotype' : ['protein_coding', 'protein_coding', 'lncRNA'],
+        'description' : ['first gene [Source:HGNC Symbol;Acc:HGNC:1]', np.nan, 'patch gene'],
+    })
+    df.index = df.id.tolist()
+    return df
+
+
+def cytoband_table():
+    return pd.DataFrame({
+        'chromosome' : ['1', '1', '2'],
+        'start' : [1, 1001, 1],
+        'end' : [1000, 2000, 2000],
+        'id' : ['1p36.33', '1p36.32', '2p25.3'],
+        'stain' : ['gneg', 'gpos25', 'gneg'],
+    })
+
+
+def HGNC_table():
+    return pd.DataFrame({
+        'entrez_id' : ['11'],
+        'ensembl_gene_id' : ['ENSG00000000001'],
+        'alternativeIDs' : ['HGNC:1|uc001'],
+        'synonyms' : ['GENE1|G1'],
+    }, index = ['ENSG00000000001'])
+
+
+def entrez_table():
+    return pd.DataFrame({'gene_stable_id' : ['ENSG00000000001'], 'xref' : [11]}, index = ['ENSG00000000001'])
+
+
+stub_loaders = {
+    'Ensembl_annot' : ensembl_table,
+    'cytoband' : cytoband_table,
+    'HGNC' : HGNC_table,
+    'entrez' : entrez_table,
+}
+
+mapped_genes = {
+    'ENSG00000000001' : {'rsIDs' : ['rs1', 'rs2'], 'studyCount' : 1, 'associationCount' : 2},
+    'ENSG00000000002' : {'rsIDs' : ['rs3'], 'studyCount' : 2, 'associationCount' : 3},
+    'ENSG00000000003' : {'rsIDs' : ['rs4'], 'studyCount' : 1, 'associationCount' : 1},
+    'ENSG00000000005' : {'rsIDs' : ['rs5'], 'studyCount' : 1, 'associationCount' : 1},
+    'ENSG00000000009' : {'rsIDs' : ['rs9'], 'studyCount' : 1, 'associationCount' : 1},
+}
+
+
+@pytest.fixture(autouse = True)
+def stub_REST(monkeypatch):
+    monkeypatch.setattr(gene_annotator.REST, 'REST', StubREST)
+
+
+@pytest.fixture
+def HGNC_file(tmp_path):
+    filename = str(tmp_path / 'hgnc.txt')
+    with open(filename, 'w') as f:
+        f.write('hgnc_id\tsymbol\n')
+    return filename
+
+
+def annotator(HGNC_file, **kwargs):
+    return GeneAnnotator(HGNC_file, 'ftp://ftp.ensembl.org/pub', 'https://rest.ensembl.org', **kwargs)
+
+
+gff_lines = [
+    '##gff-version 3',
+    '#!genome-build GRCh38.p14',
+    '1\tensembl_havana\tgene\t100\t200\t.\t+\t.\tID=gene:ENSG00000000001;Name=GENE1;biotype=protein_coding;'
+    'description=first gene [Source:HGNC Symbol%3BAcc:HGNC:1];gene_id=ENSG00000000001',
+    '1\tensembl_havana\tmRNA\t100\t200\t.\t+\t.\tID=transcript:ENST00000000001;Parent=gene:ENSG00000000001',
+    '1\tensembl\tncRNA_gene\t1200\t1300\t.\t-\t.\tID=gene:ENSG00000000002;Name=GENE2;biotype=lncRNA;gene_id=ENSG00000000002',
+]
+
+
+@pytest.fixture
+def Ensembl_ftp(tmp_path):
+    '''
+    Local copy of the Ensembl release folder with the gzipped gff3 file.
+    '''
+    folder = tmp_path / 'release-110' / 'gff3' / 'homo_sapiens'
+    folder.mkdir(parents = True)
+    with gzip.open(str(folder / 'Homo_sapiens.GRCh38.110.chr.gff3.gz'), 'wt') as gff:
+        gff.write('\n'.join(gff_lines) + '\n')
+    return str(tmp_path)
+
+
+def test_gene_lines_are_streamed_from_the_gff_file(HGNC_file, Ensembl_ftp, monkeypatch):
+    # Keeping track of the opened raw streams:
+    opened = []
+    open_stream = GeneAnnotator._GeneAnnotator__open_stream
+    def tracked_open_stream(path):
+        stream = open_stream(path)
+        opened.append(stream)
+        return stream
+    monkeypatch.setattr(GeneAnnotator, '_GeneAnnotator__open_stream', staticmethod(tracked_open_stream))
+
+    loaders = {name : loader for name, loader in stub_loaders.items() if name != 'Ensembl_annot'}
+    gene_annotator_obj = GeneAnnotator(HGNC_file, Ensembl_ftp, 'https://rest.ensembl.org', loaders = loaders)
+
+    ensembl_df = gene_annotator_obj.export_data('Ensembl_annot')
+    assert ensembl_df.id.tolist() == ['ENSG00000000001', 'ENSG00000000002']
+    assert ensembl_df.loc['ENSG00000000001'].tolist() == ['1', 100, 200, 'ENSG00000000001', 'GENE1', 'protein_coding', 'first gene']
+    assert ensembl_df.loc['ENSG00000000002', 'biotype'] == 'lncRNA'
+
+    # The file is closed with the decompressing stream:
+    assert len(opened) == 1 and opened[0].closed
+
+
+def test_snapshot_round_trip(HGNC_file, tmp_path, monkeypatch):
+    snapshot_dir = str(tmp_path / 'snapshots')
+
+    # The default loaders are replaced, as custom loaders bypass the snapshot:
+    for name, loader in [('Ensembl_gene_annotation', ensembl_table), ('cytoband', cytoband_table),
+                         ('HGNC', HGNC_table), ('Entrez_lookup_table', entrez_table)]:
+        monkeypatch.setattr(GeneAnnotator, '_GeneAnnotator__get_%s' % name, lambda self, loader = loader: loader())
+
+    first = annotator(HGNC_file, snapshotDir = snapshot_dir)
+    snapshots = os.listdir(snapshot_dir)
+    assert len(snapshots) == 1 and snapshots[0].startswith('e110_hgnc_')
+
+    # The second annotator reads the tables from the snapshot, without calling the loaders:
+    def fail(self):
+        raise AssertionError('The annotation should be loaded from the snapshot.')
+    for name in ['Ensembl_gene_annotation', 'cytoband', 'HGNC', 'Entrez_lookup_table']:
+        monkeypatch.setattr(GeneAnnotator, '_GeneAnnotator__get_%s' % name, fail)
+
+    second = annotator(HGNC_file, snapshotDir = snapshot_dir)
+    for table in GeneAnnotator.snapshot_tables:
+        pd.testing.assert_frame_equal(second.export_data(table), first.export_data(table))
+
+    assert list(second.create_document(mapped_genes)) == list(first.create_document(mapped_genes))
+
+
+def test_custom_loaders_bypass_the_snapshot(HGNC_file, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    annotator(HGNC_file, snapshotDir = snapshot_dir, loaders = stub_loaders)
+
+    assert not os.path.exists(snapshot_dir)
+
+
+def test_HGNC_file_is_not_read_for_the_snapshot_key(HGNC_file, tmp_path, monkeypatch):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    monkeypatch.setattr(GeneAnnotator, '_GeneAnnotator__open_stream', staticmethod(lambda path: pytest.fail('%s is opened' % path)))
+    for name, loader in [('Ensembl_gene_annotation', ensembl_table), ('cytoband', cytoband_table),
+                         ('HGNC', HGNC_table), ('Entrez_lookup_table', entrez_table)]:
+        monkeypatch.setattr(GeneAnnotator, '_GeneAnnotator__get_%s' % name, lambda self, loader = loader: loader())
+
+    annotator(HGNC_file, snapshotDir = snapshot_dir)
+    first = os.listdir(snapshot_dir)
+
+    # A new HGNC file has a new key:
+    with open(HGNC_file, 'a') as f:
+        f.write('HGNC:1\tGENE1\n')
+    annotator(HGNC_file, snapshotDir = snapshot_dir)
+    assert len(set(os.listdir(snapshot_dir)) - set(first)) == 1
+
+
+class HeadResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+@pytest.mark.parametrize('headers', [{'ETag' : '"5f2b-61a"'}, {'Last-Modified' : 'Mon, 02 Sep 2024 10:00:00 GMT'}])
+def test_remote_HGNC_file_is_keyed_on_its_headers(HGNC_file, monkeypatch, headers):
+    gene_annotator_obj = annotator(HGNC_file, loaders = stub_loaders)
+    gene_annotator_obj._GeneAnnotator__HGNCFile = 'https://storage.googleapis.com/public-download-files/hgnc/tsv/tsv/non_alt_loci_set.txt'
+
+    requests = []
+    def urlopen(request, timeout = None):
+        requests.append(request)
+        return HeadResponse(headers)
+    monkeypatch.setattr(gene_annotator.urllib.request, 'urlopen', urlopen)
+
+    version = gene_annotator_obj._GeneAnnotator__get_HGNC_version()
+
+    assert version == hashlib.md5(list(headers.values())[0].encode('UTF-8')).hexdigest()
+    assert [request.get_method() for request in requests] == ['HEAD']
+
+
+def test_documents_from_stub_loaders(HGNC_file):
+    documents = {document['ensemblID'] : document for document in
+                 annotator(HGNC_file, loaders = stub_loaders).create_document(mapped_genes)}
+
+    # Genes on patches and genes not found anywhere are dropped:
+    assert list(documents) == ['ENSG00000000001', 'ENSG00000000002', 'ENSG00000000005']
+
+    assert documents['ENSG00000000001'] == {
+        'resourcename' : 'gene',
+        'id' : 'gene:ENSG00000000001',
+        'ensemblID' : 'ENSG00000000001',
+        'rsIDs' : ['rs1', 'rs2'],
+        'studyCount' : 1,
+        'associationCount' : 2,
+        'chromosomeStart' : 100,
+        'chromosomeEnd' : 200,
+        'chromosomeName' : '1',
+        'biotype' : 'protein_coding',
+        'title' : 'GENE1',
+        'ensemblDescription' : 'first gene',
+        'crossRefs' : 'HGNC:1|uc001',
+        'entrez_id' : 11,
+        'cytobands' : '1p36.33',
+        'description' : 'first gene|1:100-200|1p36.33|protein_coding',
+    }
+
+    # Genes without HGNC, Entrez or description:
+    assert documents['ENSG00000000002']['ensemblDescription'] == 'No description available'
+    assert documents['ENSG00000000002']['crossRefs'] == ''
+    assert documents['ENSG00000000002']['entrez_id'] == ''
+    assert documents['ENSG00000000002']['cytobands'] == '1p36.32'
+
+
+def test_missing_genes_are_annotated_from_REST(HGNC_file):
+    gene_annotator_obj = annotator(HGNC_file, loaders = stub_loaders)
+    documents = {document['ensemblID'] : document for document in gene_annotator_obj.create_document(mapped_genes)}
+
+    assert sorted(gene_annotator_obj.EnsemblREST.posted) == ['ENSG00000000005', 'ENSG00000000009']
+    assert documents['ENSG00000000005']['title'] == 'GENE5'
+    assert documents['ENSG00000000005']['cytobands'] == '2p25.3'
+    assert documents['ENSG00000000005']['description'] == 'No description available|2:1500-1600|2p25.3|lncRNA'
+
+
+def test_HGNC_cross_references_match_row_wise_concatenation(tmp_path):
+    HGNC_df = pd.DataFrame({
+        'hgnc_id' : ['HGNC:1', 'HGNC:2', 'HGNC:3', 'HGNC:4'],
+        'symbol' : ['GENE1', 'GENE2', 'GENE3', 'GENE1B'],
+        'name' : ['first gene', 'second gene', 'third gene', 'first gene copy'],
+        'alias_symbol' : ['G1|GN1', None, None, None],
+        'alias_name' : [None, None, None, None],
+        'prev_symbol' : [None, 'OLD2', None, None],
+        'prev_name' : [None, None, None, None],
+        'entrez_id' : ['11', '12', None, '11'],
+        'ensembl_gene_id' : ['ENSG00000000001', 'ENSG00000000002', None, 'ENSG00000000001'],
+        'vega_id' : [None, 'OTTHUMG2', None, None],
+        'ucsc_id' : ['uc001', None, None, None],
+        'ena' : [None, None, None, None],
+        'refseq_accession' : ['NM_1', 'NM_2', None, None],
+        'ccds_id' : [None, None, None, None],
+        'mgd_id' : [None, 'MGI:2', None, None],
+        'uniprot_ids' : ['P1', None, None, None],
+    })
+    HGNC_file = str(tmp_path / 'hgnc.txt')
+    HGNC_df.to_csv(HGNC_file, sep = '\t', index = False)
+
+    loaders = {name : loader for name, loader in stub_loaders.items() if name != 'HGNC'}
+    HGNC_table = annotator(HGNC_file, loaders = loaders).export_data('HGNC')
+
+    # Joining the values row by row as the original implementation did:
+    def concatenate(x):
+        return("|".join([str(value) for value in x.loc[~ x.isna()].tolist()]))
+    alternativeIDs = HGNC_df[['hgnc_id', 'vega_id', 'ucsc_id', 'ena', 'refseq_accession', 'ccds_id', 'mgd_id', 'uniprot_ids']].apply(concatenate, axis = 1)
+    synonyms = HGNC_df[['symbol', 'alias_symbol', 'alias_name', 'prev_symbol', 'prev_name']].apply(concatenate, axis = 1)
+
+    # Genes without Ensembl ID are dropped, only the first row of each gene is kept:
+    assert HGNC_table.index.tolist() == ['ENSG00000000001', 'ENSG00000000002']
+    assert HGNC_table.alternativeIDs.tolist() == alternativeIDs[[0, 1]].tolist() == ['HGNC:1|uc001|NM_1|P1', 'HGNC:2|OTTHUMG2|NM_2|MGI:2']
+    assert HGNC_table.synonyms.tolist() == synonyms[[0, 1]].tolist() == ['GENE1|G1|GN1', 'GENE2|OLD2']
+    assert HGNC_table.entrez_id.tolist() == ['11', '12']
+
+
+def test_annotation_loaders_run_concurrently(HGNC_file):
+    # Every loader waits for all the others, which only returns if they run at the same time:
+    barrier = threading.Barrier(len(stub_loaders), timeout = 5)
+    def waiting_loader(loader):
+        def load():
+            barrier.wait()
+            return loader()
+        return load
+
+    gene_annotator_obj = annotator(HGNC_file, loaders = {name : waiting_loader(loader) for name, loader in stub_loaders.items()})
+
+    # The tables of the custom loaders are used:
+    pd.testing.assert_frame_equal(gene_annotator_obj.export_data('HGNC'), HGNC_table())
+    pd.testing.assert_frame_equal(gene_annotator_obj.export_data('entrez'), entrez_table())
@@ -0,0 +1,63 @@
+import json
+import os
+import sys
+from unittest import mock
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gwas_db_connect')
+from scripts import generate_solr_docs
+
+
+def test_test_run_cannot_be_sharded(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['generate-solr-docs', '--document', 'variant', '--test', '--workers', '4'])
+
+    with pytest.raises(SystemExit):
+        generate_solr_docs.main()
+
+    assert '--test cannot be used with --workers' in capsys.readouterr().err
+
+
+def documents():
+    return [{'resourcename': 'variant', 'id': 'variant:%s' % ID, 'title': 'rs%s' % ID, 'description': 'NA',
+             'associationCount': np.int64(ID), 'mappedGenes': ['GENE%s' % ID]} for ID in range(1, 4)]
+
+
+def test_json_output_matches_json_dump(tmp_path):
+    generate_solr_docs.save_data(iter(documents()), str(tmp_path), data_type = 'variant')
+
+    with open(str(tmp_path / 'variant_data.json')) as infile:
+        assert infile.read() == json.dumps(documents(), cls = generate_solr_docs.NumpyEncoder)
+    assert os.listdir(str(tmp_path)) == ['variant_data.json']
+
+
+def test_ndjson_output_has_one_document_per_line(tmp_path):
+    generate_solr_docs.save_data(iter(documents()), str(tmp_path), data_type = 'variant', output_format = 'ndjson')
+
+    with open(str(tmp_path / 'variant_data.ndjson')) as infile:
+        lines = infile.read().splitlines()
+    assert [json.loads(line) for line in lines] == json.loads(json.dumps(documents(), cls = generate_solr_docs.NumpyEncoder))
+
+
+def test_failed_generation_leaves_no_file(tmp_path):
+    def failing_documents():
+        yield from documents()
+        raise RuntimeError('ORA-03113: end-of-file on communication channel')
+
+    with pytest.raises(RuntimeError):
+        generate_solr_docs.save_data(failing_documents(), str(tmp_path), data_type = 'variant')
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_database_errors_are_raised(tmp_path):
+    cx_Oracle = pytest.importorskip('cx_Oracle')
+    from scripts.document_types import unpub_study
+
+    connection = mock.Mock()
+    connection.cursor.return_value.execute.side_effect = cx_Oracle.DatabaseError('ORA-00942: table or view does not exist')
+
+    with pytest.raises(cx_Oracle.DatabaseError):
+        generate_solr_docs.save_data(unpub_study.get_unpub_study_data(connection), str(tmp_path), data_type = 'unpub')
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,161 @@
+import json
+import threading
+
+import pytest
+
+from scripts.cache import LRUCache
+from scripts.constants import OLS4_BASE_URL
+from scripts.ols import OLSData
+
+
+class StubResponse(object):
+    def __init__(self, status_code, payload = None):
+        self.status_code = status_code
+        self.content = json.dumps(payload)
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession(object):
+    '''
+    Stands in for the OLS session: returns the responses of the URLs (status code, payload) and counts the requests.
+    Requests of the URLs in wait_for wait on the barrier, so they only return if they are sent at the same time.
+    '''
+    def __init__(self, responses, barrier = None, wait_for = ()):
+        self.responses = responses
+        self.barrier = barrier
+        self.wait_for = wait_for
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get(self, URL, timeout = None):
+        with self.lock:
+            self.requested.append(URL)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if URL in self.wait_for:
+                self.barrier.wait()
+            status_code, payload = self.responses[URL]
+            return StubResponse(status_code, payload)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+term_iri = 'http://www.ebi.ac.uk/efo/EFO_0000001'
+term_URL = '%s/efo/terms/%s' % (OLS4_BASE_URL, 'http%253A%252F%252Fwww.ebi.ac.uk%252Fefo%252FEFO_0000001')
+ancestors_URL = term_URL + '/ancestors'
+descendants_URL = term_URL + '/hierarchicalDescendants'
+
+term_resource = {
+    'iri' : term_iri, 'label' : 'experimental factor', 'short_form' : 'EFO_0000001', 'synonyms' : ['factor'],
+    'description' : ['A factor.'],
+    '_links' : {'ancestors' : {'href' : ancestors_URL}, 'hierarchicalDescendants' : {'href' : descendants_URL}},
+}
+
+
+def descendant_page(page, total_pages):
+    return {'page' : {'totalPages' : total_pages},
+            '_embedded' : {'terms' : [{'short_form' : 'EFO_%07d' % (page * 10 + i)} for i in range(2)]}}
+
+
+@pytest.fixture
+def ols(monkeypatch):
+    '''
+    Installs a stub session and an empty cache. The module state is restored after the test.
+    '''
+    def install(responses, **options):
+        session = StubSession(responses, **options)
+        monkeypatch.setattr(OLSData, 'session', session)
+        return session
+
+    monkeypatch.setattr(OLSData, 'term_cache', LRUCache())
+    monkeypatch.setattr(OLSData, 'backoff_delay', lambda current_try: 0)
+    return install
+
+
+def test_term_resource_is_requested_once(ols):
+    session = ols({term_URL : (200, term_resource)})
+
+    term = OLSData.OLSData(term_iri)
+    assert term.get_ols_term(None)['label'] == 'experimental factor'
+    assert term.get_ols_term('ancestors')['ancestors'] == ancestors_URL
+    assert OLSData.OLSData(term_iri).get_ols_term('hierarchicalDescendants')['hierarchicalDescendants'] == descendants_URL
+
+    assert session.requested == [term_URL]
+    assert OLSData.term_cache.get_stats()['hits'] == 2
+
+
+def test_failed_responses_are_not_cached(ols):
+    session = ols({term_URL : (404, {})})
+
+    assert OLSData.OLSData(term_iri).get_ols_term(None)['label'] is None
+    assert OLSData.OLSData(term_iri).get_ols_term(None)['label'] is None
+    assert session.requested == [term_URL, term_URL]
+
+
+def test_responses_are_cached_on_disk_for_the_release(ols, tmp_path):
+    cache_file = str(tmp_path / 'ols.sqlite')
+    responses = {
+        '%s/efo' % OLS4_BASE_URL : (200, {'config' : {'version' : '3.60.0'}}),
+        ancestors_URL : (200, {'_embedded' : {'terms' : [{'label' : 'Thing'}, {'label' : 'material entity'}]}}),
+    }
+
+    ols(responses)
+    OLSData.configure_cache(cache_file)
+    assert OLSData.OLSData(ancestors_URL).get_ancestors() == ['Thing', 'material entity']
+
+    # A later run on the same release reads the ancestors from the disk:
+    session = ols(responses)
+    OLSData.configure_cache(cache_file)
+    assert OLSData.OLSData(ancestors_URL).get_ancestors() == ['Thing', 'material entity']
+    assert session.requested == ['%s/efo' % OLS4_BASE_URL]
+
+    # But not on a new release:
+    responses['%s/efo' % OLS4_BASE_URL] = (200, {'config' : {'version' : '3.61.0'}})
+    session = ols(responses)
+    OLSData.configure_cache(cache_file)
+    OLSData.OLSData(ancestors_URL).get_ancestors()
+    assert session.requested == ['%s/efo' % OLS4_BASE_URL, ancestors_URL]
+
+
+def test_descendant_pages_are_fetched_concurrently_in_order(ols):
+    pages = ['%s?size=1000&page=%s' % (descendants_URL, page) for page in range(4)]
+    session = ols({URL : (200, descendant_page(page, 4)) for page, URL in enumerate(pages)},
+                  barrier = threading.Barrier(3, timeout = 5), wait_for = pages[1:])
+
+    descendants = OLSData.OLSData(descendants_URL).get_hierarchicalDescendants()
+
+    assert descendants == ['EFO_%07d' % (page * 10 + i) for page in range(4) for i in range(2)]
+    assert session.requested[0] == pages[0]
+
+
+def test_requests_in_flight_are_bounded(ols):
+    OLSData.configure_session(max_in_flight = 2)
+    URLs = ['%s/efo/terms/EFO_%07d' % (OLS4_BASE_URL, i) for i in range(8)]
+    session = ols({URL : (200, {}) for URL in URLs}, barrier = threading.Barrier(2, timeout = 5), wait_for = URLs)
+
+    threads = [threading.Thread(target = OLSData.fetch, args = (URL,)) for URL in URLs]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        OLSData.configure_session()
+
+    assert sorted(session.requested) == URLs
+    assert session.max_in_flight == 2
+
+
+def test_failed_requests_are_retried(ols):
+    session = ols({term_URL : (200, term_resource)})
+    responses = iter([StubResponse(503), StubResponse(502)])
+    get = session.get
+    session.get = lambda URL, timeout = None: next(responses, None) or get(URL, timeout)
+
+    assert OLSData.OLSData(term_iri).get_ols_term(None)['label'] == 'experimental factor'
@@ -0,0 +1,83 @@
+import json
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('cx_Oracle')
+from scripts.document_types import publication
+
+from tests.oracle_stub import Connection
+
+
+def publication_tables():
+    '''
+    Publications with several studies, ancestries and countries, a publication without studies,
+    one without associations and one without authors. 22569225 is in the test set.
+    '''
+    return {
+        'PUBLICATION': pd.DataFrame({
+            'ID': [1, 2, 3, 4],
+            'PUBMED_ID': ['22569225', '30000002', '30000003', '30000004'],
+            'PUBLICATION': ['Nat Genet', 'Nature', 'PLoS One', 'Cell'],
+            'TITLE': ['First', 'Second', 'Third', 'Fourth'],
+            'PUBLICATION_DATE': ['2012-05-06', '2018-01-02', '2018-03-04', '2019-07-08'],
+        }),
+        'AUTHOR': pd.DataFrame({
+            'ID': [1, 2, 3],
+            'FULLNAME': ['Müller A', 'Smith B', 'Jones C'],
+            'FULLNAME_STANDARD': ['Muller A', 'Smith B', 'Jones C'],
+            'ORCID': ['0000-0001', None, None],
+        }),
+        'PUBLICATION_AUTHORS': pd.DataFrame({'PUBLICATION_ID': [1, 1, 2, 3], 'AUTHOR_ID': [2, 1, 3, 3], 'SORT': [2, 1, 1, 1]}),
+        'STUDY': pd.DataFrame({
+            'ID': [10, 11, 12, 13],
+            'PUBLICATION_ID': [1, 1, 2, 4],
+            'ACCESSION_ID': ['GCST10', 'GCST11', 'GCST12', 'GCST13'],
+            'FULL_PVALUE_SET': [0, 1, 0, 0],
+        }),
+        'ASSOCIATION': pd.DataFrame({'ID': [100, 101, 102], 'STUDY_ID': [10, 10, 11]}),
+        'ANCESTRY': pd.DataFrame({'ID': [1, 2, 3, 4], 'STUDY_ID': [10, 10, 11, 12]}),
+        'ANCESTRAL_GROUP': pd.DataFrame({'ID': [1, 2], 'ANCESTRAL_GROUP': ['European', 'East Asian']}),
+        'ANCESTRY_ANCESTRAL_GROUP': pd.DataFrame({'ANCESTRY_ID': [1, 2, 3], 'ANCESTRAL_GROUP_ID': [1, 2, 1]}),
+        'GENOTYPING_TECHNOLOGY': pd.DataFrame({'ID': [1, 2], 'GENOTYPING_TECHNOLOGY': ['Genome-wide array', 'Exome array']}),
+        'STUDY_GENOTYPING_TECHNOLOGY': pd.DataFrame({'STUDY_ID': [10, 10, 11], 'GENOTYPING_TECHNOLOGY_ID': [2, 1, 1]}),
+        'COUNTRY': pd.DataFrame({'ID': [1, 2], 'COUNTRY_NAME': ['Germany', 'Japan']}),
+        'ANCESTRY_COUNTRY_RECRUITMENT': pd.DataFrame({'ANCESTRY_ID': [1, 2, 3, 4], 'COUNTRY_ID': [1, 2, 1, 2]}),
+    }
+
+
+@pytest.fixture
+def connection():
+    connection = Connection(publication_tables())
+    yield connection
+    connection.close()
+
+
+def dump(documents):
+    return [json.dumps(document, sort_keys = True) for document in documents]
+
+
+@pytest.mark.parametrize('testRun', [False, True])
+def test_bulk_documents_match_per_publication_documents(connection, testRun):
+    per_publication = list(publication.get_publication_data(connection, testRun = testRun))
+    bulk = list(publication.get_publication_data(connection, testRun = testRun, bulk = True))
+
+    assert dump(bulk) == dump(per_publication)
+    assert [document['pmid'] for document in bulk] == (['22569225'] if testRun else ['22569225', '30000002', '30000003'])
+
+
+def test_bulk_documents_are_assembled_from_whole_table_extracts(connection):
+    documents = {document['pmid']: document for document in publication.get_publication_data(connection, bulk = True)}
+
+    # The publication query and one query per extract:
+    assert len(connection.executed) == 8
+
+    assert documents['22569225']['authorsList'] == ['Müller A | Muller A | 1 | 0000-0001', 'Smith B | Smith B | 2 | 0000-0001']
+    assert documents['22569225']['associationCount'] == 3
+    assert documents['22569225']['parentDocument_ancestralGroups'] == ['East Asian, European', 'European']
+    assert documents['22569225']['genotypingTechnologies'] == ['Exome array, Genome-wide array', 'Genome-wide array']
+    assert documents['22569225']['fullPvalueSet'] is True
+    assert sorted(documents['22569225']['countryOfRecruitment']) == ['Germany', 'Japan']
+    assert documents['30000002']['associationCount'] == 0
+    assert documents['30000003']['studyCount'] == 0
+    assert 'parentDocument_accessionId' not in documents['30000003']
@@ -0,0 +1,170 @@
+import json
+import threading
+from unittest import mock
+
+import pytest
+import requests
+
+from scripts.EnsemblREST import REST
+from scripts.EnsemblREST.REST import RateLimiter, backoff_delay
+
+
+@pytest.fixture
+def clock():
+    with mock.patch.object(REST.time, 'monotonic', return_value = 100.0) as monotonic:
+        yield monotonic
+
+
+def test_try_acquire_spends_the_bucket(clock):
+    limiter = RateLimiter(rate = 2, capacity = 2)
+
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == pytest.approx(0.5)
+
+    # Tokens are refilled at the rate:
+    clock.return_value = 100.5
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == pytest.approx(0.5)
+
+
+def test_bucket_does_not_exceed_capacity(clock):
+    limiter = RateLimiter(rate = 10, capacity = 1)
+
+    clock.return_value = 200.0
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == pytest.approx(0.1)
+
+
+def test_update_follows_the_rate_limit_headers(clock):
+    limiter = RateLimiter(rate = 15, capacity = 15)
+    limiter.update({'X-RateLimit-Limit' : '55000', 'X-RateLimit-Period' : '3600', 'X-RateLimit-Remaining' : '1'})
+
+    assert limiter.rate == pytest.approx(55000 / 3600.0)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() > 0
+
+
+def test_update_blocks_until_the_reset(clock):
+    limiter = RateLimiter()
+    limiter.update({'X-RateLimit-Remaining' : '0', 'X-RateLimit-Reset' : '30'})
+
+    assert limiter.try_acquire() == pytest.approx(30)
+
+    clock.return_value = 131.0
+    assert limiter.try_acquire() == 0
+
+
+def test_update_follows_retry_after(clock):
+    limiter = RateLimiter()
+    limiter.update({'Retry-After' : '2.5'})
+    assert limiter.try_acquire() == pytest.approx(2.5)
+
+    # Missing and malformed headers are ignored:
+    limiter.update({'X-RateLimit-Limit' : 'unknown', 'Retry-After' : None})
+    assert limiter.rate == 15
+
+    clock.return_value = 103.0
+    assert limiter.try_acquire() == 0
+
+
+def test_backoff_delay_is_capped():
+    for current_try in range(10):
+        delay = backoff_delay(current_try, base = 1, cap = 60)
+        assert min(60, 2 ** current_try) / 2.0 <= delay <= min(60, 2 ** current_try)
+
+
+class StubResponse(object):
+    def __init__(self, status_code, payload = None, headers = None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.payload = payload
+        self.headers = headers or {}
+        self.text = json.dumps(payload)
+        self.reason = 'stub'
+
+    def json(self):
+        return self.payload
+
+
+class StubSession(object):
+    '''
+    Stands in for the requests session: answers the release and ID lookups, optionally failing the first posts.
+    Every request waits on the barrier, if given, so they only return if enough of them are sent at once.
+    '''
+    def __init__(self, failures = 0, barrier = None, release = 110, offline = False):
+        self.failures = failures
+        self.barrier = barrier
+        self.release = release
+        self.offline = offline
+        self.posted = []
+        self.lock = threading.Lock()
+
+    def post(self, URL, headers = None, data = None, timeout = None):
+        if self.barrier is not None:
+            self.barrier.wait()
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return StubResponse(503, headers = {'Retry-After' : '0'})
+            IDs = json.loads(data)['ids']
+            self.posted.append(IDs)
+        return StubResponse(200, {ID : {'id' : ID} for ID in IDs}, {'X-RateLimit-Remaining' : '1000'})
+
+    def get(self, URL, headers = None, timeout = None):
+        if self.offline:
+            raise requests.ConnectionError('offline')
+        return StubResponse(200, {'releases' : [109, self.release]})
+
+
+def client(session, workers = 4, **options):
+    ensembl = REST.REST('https://rest.ensembl.org', workers = workers, rate_limiter = RateLimiter(rate = 1000, capacity = 1000), **options)
+    ensembl.session = session
+    return ensembl
+
+
+def test_chunks_are_posted_concurrently_and_merged_in_order():
+    IDs = ['ENSG%011d' % i for i in range(2500)]
+    session = StubSession(barrier = threading.Barrier(3, timeout = 5))
+
+    response = client(session).postID(IDs)
+
+    assert sorted(len(chunk) for chunk in session.posted) == [500, 1000, 1000]
+    assert list(response) == IDs
+
+
+def test_failed_requests_are_retried(monkeypatch):
+    monkeypatch.setattr(REST, 'backoff_delay', lambda current_try: 0)
+    session = StubSession(failures = 2)
+
+    response = client(session, workers = 1).postID(['ENSG00000000001'])
+
+    assert response == {'ENSG00000000001' : {'id' : 'ENSG00000000001'}}
+    assert session.posted == [['ENSG00000000001']]
+
+
+def test_responses_are_cached_for_the_release(tmp_path):
+    cache_file = str(tmp_path / 'responses.sqlite')
+    client(StubSession(), cache_file = cache_file).postID(['ENSG01', 'ENSG02'])
+
+    # Only the uncached ID is posted:
+    session = StubSession()
+    response = client(session, cache_file = cache_file).postID(['ENSG01', 'ENSG02', 'ENSG03'])
+    assert session.posted == [['ENSG03']]
+    assert list(response) == ['ENSG01', 'ENSG02', 'ENSG03']
+
+    # Cached responses of a new release are not used:
+    session = StubSession(release = 111)
+    client(session, cache_file = cache_file).postID(['ENSG01'])
+    assert session.posted == [['ENSG01']]
+
+
+def test_cached_release_is_used_offline(tmp_path):
+    cache_file = str(tmp_path / 'responses.sqlite')
+
+    # Evicting responses from the full cache does not remove the cached release:
+    online = client(StubSession(), cache_file = cache_file, cache_size = 1)
+    assert online.getEnsemblRelease() == 110
+    online.postID(['ENSG01', 'ENSG02'])
+
+    assert client(StubSession(offline = True), cache_file = cache_file).getEnsemblRelease() == 110
@@ -0,0 +1,163 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('cx_Oracle')
+from scripts.document_types import trait
+from scripts.ols.EFOGraph import EFOGraph
+
+from tests.oracle_stub import Connection
+
+
+# disease <- cancer <- lung cancer, asthma has no descendants, EFO_0009999 is not in the release:
+obo_content = '''format-version: 1.2
+ontology: efo
+
+[Term]
+id: EFO:0000408
+name: disease
+
+[Term]
+id: EFO:0000311
+name: cancer
+synonym: "malignant neoplasm" EXACT []
+is_a: EFO:0000408 ! disease
+
+[Term]
+id: EFO:0001071
+name: lung cancer
+def: "A cancer of the lung." []
+is_a: EFO:0000311 ! cancer
+
+[Term]
+id: EFO:0000270
+name: asthma
+is_a: EFO:0000408 ! disease
+'''
+
+EFO = 'http://www.ebi.ac.uk/efo/EFO_'
+
+
+def trait_tables():
+    '''
+    Studies and associations shared by several traits, a study without accession and an unpublished study.
+    '''
+    return {
+        'EFO_TRAIT': pd.DataFrame({
+            'ID': [1, 2, 3, 4, 5],
+            'TRAIT': ['disease', 'cancer', 'lung cancer', 'asthma', 'new trait'],
+            'URI': [EFO + '0000408', EFO + '0000311', EFO + '0001071', EFO + '0000270', EFO + '0009999'],
+            'SHORT_FORM': ['EFO_0000408', 'EFO_0000311', 'EFO_0001071', 'EFO_0000270', 'EFO_0009999'],
+        }),
+        'HOUSEKEEPING': pd.DataFrame({'ID': [1, 2], 'IS_PUBLISHED': [1, 0]}),
+        'STUDY': pd.DataFrame({
+            'ID': [1, 2, 3, 4, 5, 6],
+            'ACCESSION_ID': ['GCST1', 'GCST2', 'GCST3', None, 'GCST5', 'GCST6'],
+            'HOUSEKEEPING_ID': [1, 1, 1, 1, 1, 2],
+        }),
+        'STUDY_EFO_TRAIT': pd.DataFrame({'STUDY_ID': [1, 1, 2, 3, 3, 4, 5, 5, 6],
+                                         'EFO_TRAIT_ID': [2, 3, 3, 3, 4, 3, 5, 1, 1]}),
+        'ASSOCIATION': pd.DataFrame({'ID': [11, 12, 13, 14, 15], 'STUDY_ID': [1, 2, 3, 3, 5]}),
+        'ASSOCIATION_EFO_TRAIT': pd.DataFrame({'ASSOCIATION_ID': [11, 11, 12, 13, 14, 15],
+                                               'EFO_TRAIT_ID': [2, 3, 3, 3, 4, 5]}),
+        'DISEASE_TRAIT': pd.DataFrame({'ID': [1, 2, 3], 'TRAIT': ['Lung cancer', 'Lung adenocarcinoma', 'Asthma']}),
+        'STUDY_DISEASE_TRAIT': pd.DataFrame({'STUDY_ID': [1, 2, 3, 5], 'DISEASE_TRAIT_ID': [1, 2, 3, 3]}),
+    }
+
+
+@pytest.fixture
+def connection():
+    connection = Connection(trait_tables())
+    yield connection
+    connection.close()
+
+
+@pytest.fixture
+def efo_file(tmp_path):
+    filename = str(tmp_path / 'efo.obo')
+    with open(filename, 'w') as f:
+        f.write(obo_content)
+    return filename
+
+
+def count(cursor, efos, count_type):
+    '''
+    The count of distinct studies or associations of the terms, as queried for every trait
+    by the original implementation.
+    '''
+    in_vars = ','.join(':%d' % i for i in range(len(efos)))
+    sql = {
+        'study': """
+            SELECT COUNT(DISTINCT (S.ACCESSION_ID))
+            FROM STUDY S, EFO_TRAIT ET, STUDY_EFO_TRAIT SETR
+            WHERE S.ID=SETR.STUDY_ID and SETR.EFO_TRAIT_ID=ET.ID
+                and ET.SHORT_FORM in ( {} )
+        """,
+        'association': """
+            SELECT COUNT(DISTINCT(A.ID))
+            FROM ASSOCIATION_EFO_TRAIT AET, EFO_TRAIT ET, ASSOCIATION A
+            WHERE AET.EFO_TRAIT_ID=ET.ID and AET.ASSOCIATION_ID=A.ID
+                and ET.SHORT_FORM in ( {} )
+        """,
+    }[count_type].format(in_vars)
+
+    cursor.execute(sql, {str(i): efo for i, efo in enumerate(efos)})
+    return cursor.fetchone()[0]
+
+
+def test_rolled_up_counts_match_per_trait_queries(connection, efo_file):
+    documents = {document['shortForm'][0]: document for document in trait.get_trait_data(connection, efo_file = efo_file)}
+    assert sorted(documents) == ['EFO_0000270', 'EFO_0000311', 'EFO_0000408', 'EFO_0001071', 'EFO_0009999']
+
+    efo = EFOGraph(efo_file)
+    cursor = connection.cursor()
+    for short_form, document in documents.items():
+        iri = efo.get_iri(short_form)
+        # The term and its descendants that are annotations:
+        efos = [short_form] + [descendant for descendant in (efo.get_descendant_short_forms(iri) if iri else [])
+                               if descendant in documents]
+
+        assert document['termStudyCount'] == count(cursor, [short_form], 'study')
+        assert document['studyCount'] == count(cursor, efos, 'study')
+        if len(efos) > 1:
+            assert document['associationCount'] == count(cursor, efos, 'association')
+
+    # Studies and associations shared by the descendants are counted once, the study without accession is not counted:
+    assert documents['EFO_0000408']['studyCount'] == 5
+    assert documents['EFO_0000408']['associationCount'] == 4
+    assert documents['EFO_0001071']['studyCount'] == 3
+
+
+def test_prefetched_counts_and_reported_traits_match_per_trait_queries(connection, efo_file):
+    association_count_sql = """
+        SELECT COUNT(A.ID)
+        FROM EFO_TRAIT ET, ASSOCIATION_EFO_TRAIT AET, ASSOCIATION A
+        WHERE ET.ID=AET.EFO_TRAIT_ID AND AET.ASSOCIATION_ID=A.ID
+              AND ET.SHORT_FORM= :trait_id
+    """
+    reported_trait_sql = """
+        SELECT DISTINCT DT.TRAIT AS REPORTED_DISEASE_TRAIT
+        FROM STUDY S, EFO_TRAIT ET, DISEASE_TRAIT DT, STUDY_EFO_TRAIT SETR, STUDY_DISEASE_TRAIT SDT
+        WHERE S.ID=SETR.STUDY_ID and SETR.EFO_TRAIT_ID=ET.ID
+        and S.ID=SDT.STUDY_ID and SDT.DISEASE_TRAIT_ID=DT.ID
+        and ET.ID= :trait_id
+    """
+
+    documents = list(trait.get_trait_data(connection, efo_file = efo_file))
+
+    # The database is queried once for all the traits:
+    assert len(connection.executed) == 5
+
+    cursor = connection.cursor()
+    for document in documents:
+        cursor.execute(association_count_sql, {'trait_id': document['shortForm'][0]})
+        assert document['termAssociationCount'] == cursor.fetchone()[0]
+
+        cursor.execute(reported_trait_sql, {'trait_id': int(document['id'].split(':')[1])})
+        reported_traits = [row[0] for row in cursor.fetchall()]
+        assert sorted(document['reportedTrait']) == sorted(reported_traits)
+        assert document['reportedTrait_s'] == ', '.join(document['reportedTrait'])
+
+    by_id = {document['id']: document for document in documents}
+    assert sorted(by_id['trait:3']['reportedTrait']) == ['Asthma', 'Lung adenocarcinoma', 'Lung cancer']
+    assert by_id['trait:2']['reportedTrait'] == ['Lung cancer']
+    assert by_id['trait:1']['termAssociationCount'] == 0
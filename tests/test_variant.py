@@ -0,0 +1,196 @@
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('gwas_db_connect')
+from scripts.document_types import variant
+
+from tests.oracle_stub import Connection
+
+# The stub connection is not an SQLAlchemy connectable, just like cx_Oracle's:
+pytestmark = pytest.mark.filterwarnings('ignore:pandas only supports SQLAlchemy')
+
+
+def variant_tables():
+    '''
+    A handful of variants covering the document cases: overlapping and flanking genes, merged rsIDs,
+    missing and non-standard locations, variants without associations.
+    The variant table is not ordered by ID, so the output order can be checked.
+    '''
+    return {
+        'SINGLE_NUCLEOTIDE_POLYMORPHISM': pd.DataFrame({
+            'ID': [5, 1, 2, 3, 4, 20],
+            'RS_ID': ['rs5', 'rs1', 'rs2', 'rs3', 'rs4', 'rs20'],
+            'FUNCTIONAL_CLASS': ['intron_variant', 'missense_variant', 'intergenic_variant', None, None, 'intron_variant'],
+        }),
+        'LOCATION': pd.DataFrame({
+            'ID': [101, 102, 105, 120],
+            'CHROMOSOME_NAME': ['1', '2', 'CHR_HSCHR6', '2'],
+            'CHROMOSOME_POSITION': [100, 200, 300, 250],
+            'REGION_ID': [1, 2, 2, 2],
+        }),
+        'SNP_LOCATION': pd.DataFrame({'SNP_ID': [1, 2, 5, 20], 'LOCATION_ID': [101, 102, 105, 120]}),
+        'REGION': pd.DataFrame({'ID': [1, 2], 'NAME': ['1p36.33', '2q11.1']}),
+        'SNP_MERGED_SNP': pd.DataFrame({'SNP_ID_MERGED': [2], 'SNP_ID_CURRENT': [20]}),
+        'GENE': pd.DataFrame({'ID': [1, 2, 3, 4], 'GENE_NAME': ['GENEA', 'GENEB', 'GENEC', 'GENED']}),
+        'GENOMIC_CONTEXT': pd.DataFrame(
+            [(1, 1, 1, 101, 0, 0, 0, 1, 0, 'Ensembl'),
+             (2, 1, 2, 101, 0, 1, 1, 0, 500, 'Ensembl'),
+             (3, 1, 3, 101, 0, 0, 0, 1, 0, 'NCBI'),
+             (4, 2, 2, 102, 0, 1, 1, 1, 10, 'Ensembl'),
+             (5, 2, 3, 102, 0, 1, 1, 0, 20, 'Ensembl'),
+             (6, 2, 4, 102, 1, 0, 1, 1, 5, 'Ensembl'),
+             (7, 5, 1, 105, 0, 0, 0, 1, 0, 'Ensembl')],
+            columns = ['ID', 'SNP_ID', 'GENE_ID', 'LOCATION_ID', 'IS_DOWNSTREAM', 'IS_UPSTREAM',
+                       'IS_INTERGENIC', 'IS_CLOSEST_GENE', 'DISTANCE', 'SOURCE']),
+        'ASSOCIATION_SNP_VIEW': pd.DataFrame({'ASSOCIATION_ID': [11, 12, 13, 14, 15, 16], 'SNP_ID': [1, 2, 5, 5, 4, 1]}),
+        'ASSOCIATION': pd.DataFrame({'ID': [11, 12, 13, 14, 15, 16], 'STUDY_ID': [1, 1, 2, 3, 1, 1]}),
+        'GENE_ENSEMBL_GENE': pd.DataFrame({'GENE_ID': [1, 2], 'ENSEMBL_GENE_ID': [1, 2]}),
+        'ENSEMBL_GENE': pd.DataFrame({'ID': [1, 2], 'ENSEMBL_GENE_ID': ['ENSG01', 'ENSG02']}),
+        'GENE_ENTREZ_GENE': pd.DataFrame({'GENE_ID': [1, 4], 'ENTREZ_GENE_ID': [1, 2]}),
+        'ENTREZ_GENE': pd.DataFrame({'ID': [1, 2], 'ENTREZ_GENE_ID': ['101', '104']}),
+    }
+
+
+@pytest.fixture
+def connection():
+    connection = Connection(variant_tables())
+    yield connection
+    connection.close()
+
+
+def dump(documents):
+    return [json.dumps(document, sort_keys = True, default = int) for document in documents]
+
+
+def test_documents_follow_the_variant_table(connection):
+    documents = list(variant.get_variant_data(connection))
+
+    # Variants without associations (3 and 20) are dropped:
+    assert [document['id'] for document in documents] == ['variant:5', 'variant:1', 'variant:2', 'variant:4']
+
+    by_id = {document['id']: document for document in documents}
+    assert by_id['variant:1']['mappedGenes'] == ['GENEA|ENSG01|101']
+    assert by_id['variant:1']['chromosomePosition'] == 100
+    assert by_id['variant:2']['title'] == 'rs20 (rs2)'
+    assert by_id['variant:2']['description'].startswith('2:200|2q11.1|Intergenic variant|')
+    assert sorted(by_id['variant:2']['mappedGenes']) == ['GENEB|ENSG02', 'GENED|104']
+    assert by_id['variant:4']['mappedGenes'] == ['intergenic']
+    assert by_id['variant:4']['description'] == 'NA:NA|NA|None|intergenic'
+    assert 'chromosomeName' not in by_id['variant:5']
+
+
+def test_limit_is_applied_to_the_variant_table(connection):
+    # As in the per variant extraction, the limit selects rows of the variant table before
+    # dropping the ones without associations:
+    documents = list(variant.get_variant_data(connection, limit = 4))
+    assert [document['id'] for document in documents] == ['variant:5', 'variant:1', 'variant:2']
+
+
+@pytest.mark.parametrize('limit', [0, 2, 4])
+def test_bulk_documents_match_per_variant_documents(connection, limit):
+    per_variant = dump(variant.get_variant_data(connection, limit = limit))
+    bulk = dump(variant.get_variant_data(connection, limit = limit, bulk = True))
+
+    assert bulk == per_variant
+
+
+def test_counts_match_per_variant_queries(connection):
+    # The per variant count queries of the baseline extraction:
+    association_count_sql = """
+        SELECT asv.SNP_ID, COUNT(asv.ASSOCIATION_ID) AS count
+        FROM ASSOCIATION_SNP_VIEW asv
+        WHERE asv.SNP_ID = :snp_id
+        group by asv.SNP_ID
+    """
+    study_count_sql = """
+        SELECT COUNT(DISTINCT(A.STUDY_ID)) AS count
+        FROM ASSOCIATION_SNP_VIEW ASV, ASSOCIATION A
+        WHERE ASV.ASSOCIATION_ID = A.ID
+          AND ASV.SNP_ID = :snp_id
+    """
+
+    counts = variant.variant_sqls(connection).get_snp_counts().set_index('SNP_ID')
+    assert sorted(counts.index) == [1, 2, 4, 5]
+
+    for snp_id in [1, 2, 3, 4, 5, 20]:
+        association_count = pd.read_sql(association_count_sql, connection, params = {'snp_id': snp_id})
+        study_count = pd.read_sql(study_count_sql, connection, params = {'snp_id': snp_id})
+        if len(association_count) == 0:
+            assert snp_id not in counts.index
+            continue
+
+        assert counts.loc[snp_id, 'ASSOCIATION_COUNT'] == association_count.COUNT[0]
+        assert counts.loc[snp_id, 'STUDY_COUNT'] == study_count.COUNT[0]
+
+
+def test_mapped_gene_labels_match_the_mapping_table(connection):
+    variant_cls = variant.variant_sqls(connection)
+    gene_map_df = variant_cls.gene_map_df
+    all_mapped_genes = variant_cls.get_all_mapped_genes()
+
+    for snp_id in [1, 2, 4, 5]:
+        mapped_genes = variant_cls.get_mapped_genes(snp_id)
+        assert all_mapped_genes.get(snp_id, ['intergenic']) == mapped_genes
+
+        if mapped_genes == ['intergenic']:
+            continue
+
+        # The labels as formatted by filtering the mapping table for every variant:
+        names = [label.split('|')[0] for label in mapped_genes]
+        expected = gene_map_df.loc[gene_map_df.GENE_NAME.isin(names)].apply(lambda row: "|".join(filter(None, row.tolist())), axis = 1).tolist()
+        assert mapped_genes == expected
+
+
+class InlinePool(object):
+    '''
+    Runs the shards in the test process, in place of the pool of spawned workers.
+    '''
+    def __init__(self, workers, initializer, initargs):
+        initializer(*initargs)
+
+    def apply_async(self, function, args):
+        result = function(*args)
+        return SimpleNamespace(get = lambda: result)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+@pytest.fixture
+def inline_workers(connection, monkeypatch):
+    monkeypatch.setattr(variant.multiprocessing, 'get_context', lambda method: SimpleNamespace(Pool = InlinePool))
+    monkeypatch.setattr(variant.multiprocessing.util, 'Finalize', mock.Mock())
+    monkeypatch.setattr(variant.DBConnection, 'gwasCatalogDbConnector',
+                        lambda database: SimpleNamespace(connection = connection, close = lambda: None), raising = False)
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_sharded_documents_match_single_process_documents(connection, inline_workers, bulk):
+    single = list(variant.get_variant_data(connection, bulk = bulk))
+    del connection.executed[:]
+
+    sharded = list(variant.get_sharded_variant_data(connection, 'TEST', 2, bulk = bulk, shard_size = 2))
+
+    # The shards are returned in the order of the IDs:
+    assert dump(sharded) == dump(sorted(single, key = lambda document: int(document['id'].split(':')[1])))
+
+    # The parent process reads the variant IDs only, the counts are grouped within the ID range:
+    assert connection.executed[0] == variant.variant_sqls.snp_id_sql
+    count_queries = [sql for sql in connection.executed if 'GROUP BY' in sql]
+    assert len(count_queries) == 3
+    assert all(sql.index('BETWEEN') < sql.index('GROUP BY') for sql in count_queries)
+
+
+def test_sharded_limit_selects_the_lowest_IDs(connection, inline_workers):
+    documents = list(variant.get_sharded_variant_data(connection, 'TEST', 2, limit = 3, shard_size = 2))
+    assert [document['id'] for document in documents] == ['variant:1', 'variant:2']